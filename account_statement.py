@@ -20,6 +20,10 @@ import string
 import sqlite3
 import datetime
 import atexit
+import time
+import random
+import heapq
+import signal
 _urllib_version = False
 try:
     import urllib2
@@ -38,12 +42,22 @@ try:
 except ImportError:
     from io import StringIO
 import gzip
+import math
+import statistics
+import json
+import collections
+import itertools
+import http.server
+import hashlib
+import csv
+import codecs
 import zlib
 from subprocess import Popen
 try:
     from urlparse import urljoin # Python2
 except ImportError:
     from urllib.parse import urljoin # Python3
+import urllib.parse
 
 import requests
 from socket import error as SocketError
@@ -52,6 +66,12 @@ import errno
 import smtplib
 from email.mime.text import MIMEText
 
+# optional, only required for the 'analyze' command and the analysis in the notification
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 #_htmlparser_version = False
 #try:
 #    import html.parser
@@ -69,6 +89,53 @@ import html as htmlescape
 # start with 'info', can be overriden by '-q' later on
 logging.basicConfig(level = logging.INFO,
 		    format = '%(levelname)s: %(message)s')
+# the HTTP libraries only log warnings, set once instead of for every request
+logging.getLogger("urllib3").setLevel(logging.WARNING)
+logging.getLogger("requests.packages.urllib3").setLevel(logging.WARNING)
+logging.getLogger("httplib").setLevel(logging.WARNING)
+
+# account and phase which is currently processed, added to the JSON log entries
+log_context = {'account': None, 'phase': None}
+
+
+
+
+
+#######################################################################
+# JsonLogFormatter class
+
+class JsonLogFormatter(logging.Formatter):
+
+    # format()
+    #
+    # format a log record as one JSON line
+    # 'account' and 'phase' are taken from the record (extra), or from the current log context
+    #
+    # parameter:
+    #  - self
+    #  - log record
+    # return:
+    #  - JSON line
+    def format(self, record):
+        entry = collections.OrderedDict()
+        entry['ts'] = self.formatTime(record, '%Y-%m-%dT%H:%M:%S')
+        entry['level'] = record.levelname
+        entry['message'] = record.getMessage()
+        for field in ['account', 'phase']:
+            value = getattr(record, field, log_context[field])
+            if (value is not None):
+                entry[field] = value
+        if (getattr(record, 'duration', None) is not None):
+            entry['duration'] = round(record.duration, 4)
+        if (record.exc_info):
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry)
+
+
+
+# end JsonLogFormatter class
+#######################################################################
 
 
 
@@ -86,6 +153,7 @@ class Config:
         self.argument_parser = False
         self.configfile = False
         self.config = False
+        self.categorizer = None
         self.output_help = True
 
         if (os.environ.get('HOME') is None):
@@ -143,11 +211,27 @@ class Config:
                                          add_help = False)
         self.argument_parser = parser
         parser.add_argument('--help', default = False, dest = 'help', action = 'store_true', help = 'show this help')
-        parser.add_argument('-c', '--config', default = '', dest = 'config', help = 'configuration file')
+        parser.add_argument('-c', '--config', default = [], dest = 'config', action = 'append',
+                            help = 'configuration file or directory with configuration files, can be specified multiple times')
         # store_true: store "True" if specified, otherwise store "False"
         # store_false: store "False" if specified, otherwise store "True"
         parser.add_argument('-v', '--verbose', default = False, dest = 'verbose', action = 'store_true', help = 'be more verbose')
         parser.add_argument('-q', '--quiet', default = False, dest = 'quiet', action = 'store_true', help = 'run quietly')
+        parser.add_argument('--log-format', default = 'text', dest = 'log_format', choices = ['text', 'json'], help = 'log output as text (default) or as JSON lines')
+        parser.add_argument('--daemon', default = False, dest = 'daemon', action = 'store_true', help = 'keep running, fetch accounts according to their schedule')
+        parser.add_argument('--report-only', default = False, dest = 'report_only', action = 'store_true', help = 'do not log in, send the notification from the stored data')
+        parser.add_argument('--resume', default = False, dest = 'resume', action = 'store_true', help = 'only process the accounts which failed or did not run in the last run')
+        parser.add_argument('--from', default = None, dest = 'from_value', help = "start date for 'backfill' (YYYY-MM-DD), or first sequence number for 'tail' (<database>:<seq>,... with several database files)")
+        parser.add_argument('--follow', default = False, dest = 'follow', action = 'store_true', help = "'tail': keep waiting for new entries")
+        parser.add_argument('--days', default = 28, dest = 'days', type = int, help = "number of days for 'stats' (default: 28)")
+        parser.add_argument('--format', default = 'text', dest = 'format', choices = ['text', 'csv'], help = "output format for 'analyze' (default: text)")
+        parser.add_argument('command', default = 'fetch', nargs = '?', choices = ['fetch', 'maintenance', 'backfill', 'serve', 'stats', 'categorize', 'analyze', 'tail'],
+                            help = "'fetch' (default): retrieve account data, 'maintenance': prune and compact the database, " +
+                                   "'backfill': retrieve the account history starting at --from, " +
+                                   "'serve': local HTTP/JSON API for queries, 'stats': run statistics and trends, " +
+                                   "'categorize': apply the category rules to all statements, " +
+                                   "'analyze': report over the full transaction history (requires NumPy), " +
+                                   "'tail': print the change feed as JSON lines, starting at --from")
 
 
         # parse parameters
@@ -169,12 +253,59 @@ class Config:
             print("Error: configfile is required")
             sys.exit(1)
 
+        if (args.command == 'backfill'):
+            try:
+                args.from_value = datetime.datetime.strptime(str(args.from_value), '%Y-%m-%d').date()
+            except ValueError:
+                self.print_help()
+                print("")
+                print("Error: 'backfill' requires a valid --from date (YYYY-MM-DD)")
+                sys.exit(1)
+
+        if (args.command == 'tail'):
+            # every database file has its own sequence numbers: database file name -> first sequence number
+            # a plain number (key None) is only valid with one database file, see tail_change_log()
+            try:
+                if (args.from_value is None):
+                    args.from_value = {}
+                elif (':' not in args.from_value):
+                    args.from_value = {None: int(args.from_value)}
+                else:
+                    args.from_value = dict([(name, int(seq)) for name, seq in
+                                            [cursor.rsplit(':', 1) for cursor in args.from_value.split(',')]])
+            except ValueError:
+                self.print_help()
+                print("")
+                print("Error: 'tail' requires a sequence number (or <database>:<seq>,...) for --from")
+                sys.exit(1)
+
+        if (args.report_only is True and (args.daemon is True or args.command != 'fetch')):
+            self.print_help()
+            print("")
+            print("Error: --report-only can only be used for 'fetch', without --daemon")
+            sys.exit(1)
+
+        if (args.resume is True and (args.daemon is True or args.command != 'fetch')):
+            self.print_help()
+            print("")
+            print("Error: --resume can only be used for 'fetch', without --daemon")
+            sys.exit(1)
+
+        if (args.command == 'analyze' and numpy is None):
+            print("")
+            print("Error: 'analyze' requires NumPy")
+            sys.exit(1)
+
         if (args.verbose is True):
             logging.getLogger().setLevel(logging.DEBUG)
 
         if (args.quiet is True):
             logging.getLogger().setLevel(logging.ERROR)
 
+        if (args.log_format == 'json'):
+            for handler in logging.getLogger().handlers:
+                handler.setFormatter(JsonLogFormatter())
+
         self.__cmdline_read = 1
         self.arguments = args
 
@@ -182,41 +313,62 @@ class Config:
 
 
 
-    # load_config()
+    # config_files()
     #
-    # load configuration file (YAML)
+    # expand the --config arguments into a list of config files
+    # a directory adds all *.yaml and *.yml files in it
     #
     # parameter:
     #  - self
     # return:
-    #  none
-    def load_config(self):
-        if not (self.arguments.config):
-            return
+    #  - list with config files
+    def config_files(self):
+        files = []
+        for entry in self.arguments.config:
+            if (os.path.isdir(entry)):
+                for filename in sorted(os.listdir(entry)):
+                    if (filename.endswith('.yaml') or filename.endswith('.yml')):
+                        files.append(os.path.join(entry, filename))
+            else:
+                files.append(entry)
+
+        return files
+
+
 
-        logging.debug("config file: " + self.arguments.config)
+    # load_config_file()
+    #
+    # load and verify a single configuration file (YAML)
+    #
+    # parameter:
+    #  - self
+    #  - config file name
+    # return:
+    #  - dictionary with the config file content
+    def load_config_file(self, filename):
+        logging.debug("config file: " + filename)
 
-        if (self.arguments.config and os.path.isfile(self.arguments.config) is False):
+        if (os.path.isfile(filename) is False):
             self.print_help()
             print("")
-            print("Error: --config is not a file")
+            print("Error: --config is not a file: " + filename)
             sys.exit(1)
 
         # the config file holds sensitive information, make sure it's not group/world readable
-        st = os.stat(self.arguments.config)
+        st = os.stat(filename)
         if (st.st_mode & stat.S_IRGRP or st.st_mode & stat.S_IROTH):
             self.print_help()
             print("")
-            print("Error: --config must not be group or world readable")
+            print("Error: --config must not be group or world readable: " + filename)
             sys.exit(1)
 
 
         try:
-            with open(self.arguments.config, 'r') as ymlcfg:
+            with open(filename, 'r') as ymlcfg:
                 config_file = yaml.safe_load(ymlcfg)
         except:
             print("")
-            print("Error loading config file")
+            print("Error loading config file: " + filename)
             sys.exit(1)
 
         # verify all account entries
@@ -234,6 +386,63 @@ class Config:
                 print("Error: 'enabled' is invalid, in entry: " + str(account))
                 print(config_file['accounts'][account]['enabled'])
                 errors_in_config = True
+            # the HTML page is parsed by default, with 'csv' the CSV export is used if available
+            # (existing statements are recognized in both formats, see tests/test_turnovers.py)
+            if ('turnovers_format' not in config_file['accounts'][account]):
+                config_file['accounts'][account]['turnovers_format'] = 'html'
+            if (config_file['accounts'][account]['turnovers_format'] not in ['csv', 'html']):
+                print("")
+                print("Error: 'turnovers_format' must be 'csv' or 'html', in entry: " + str(account))
+                errors_in_config = True
+            # append the analysis report to the notification
+            if ('analysis' not in config_file['accounts'][account]):
+                config_file['accounts'][account]['analysis'] = False
+            if (config_file['accounts'][account]['analysis'] != True and config_file['accounts'][account]['analysis'] != False):
+                print("")
+                print("Error: 'analysis' is invalid, in entry: " + str(account))
+                errors_in_config = True
+            # minimum age of the stored data before logging in again, in minutes (0: always log in)
+            if ('fetch_interval' not in config_file['accounts'][account]):
+                config_file['accounts'][account]['fetch_interval'] = 0
+            fetch_interval = config_file['accounts'][account]['fetch_interval']
+            if (isinstance(fetch_interval, bool) or not isinstance(fetch_interval, int) or fetch_interval < 0):
+                print("")
+                print("Error: 'fetch_interval' is invalid, in entry: " + str(account))
+                errors_in_config = True
+            # alert when the balance drops below this value (optional)
+            if ('min_balance' not in config_file['accounts'][account]):
+                config_file['accounts'][account]['min_balance'] = None
+            min_balance = config_file['accounts'][account]['min_balance']
+            if (min_balance is not None and (isinstance(min_balance, bool) or not isinstance(min_balance, (int, float)))):
+                print("")
+                print("Error: 'min_balance' is invalid, in entry: " + str(account))
+                errors_in_config = True
+            # monthly limits for the debits, per category or for all debits (no category)
+            if ('budgets' not in config_file['accounts'][account] or config_file['accounts'][account]['budgets'] is None):
+                config_file['accounts'][account]['budgets'] = []
+            if (not isinstance(config_file['accounts'][account]['budgets'], list)):
+                print("")
+                print("Error: 'budgets' must be a list, in entry: " + str(account))
+                errors_in_config = True
+                config_file['accounts'][account]['budgets'] = []
+            for budget in config_file['accounts'][account]['budgets']:
+                if (not isinstance(budget, dict) or isinstance(budget.get('limit'), bool) or
+                    not isinstance(budget.get('limit'), (int, float)) or budget['limit'] < 0):
+                    print("")
+                    print("Error: every budget needs a positive 'limit', in entry: " + str(account))
+                    errors_in_config = True
+                    continue
+                if ('category' not in budget or budget['category'] is None):
+                    budget['category'] = ''
+                budget['category'] = str(budget['category'])
+            # schedule for daemon mode, in minutes
+            if ('interval' not in config_file['accounts'][account]):
+                config_file['accounts'][account]['interval'] = 1440
+            interval = config_file['accounts'][account]['interval']
+            if (isinstance(interval, bool) or not isinstance(interval, int) or interval < 1):
+                print("")
+                print("Error: 'interval' is invalid, in entry: " + str(account))
+                errors_in_config = True
 
         if (errors_in_config is True):
             sys.exit(1)
@@ -244,15 +453,299 @@ class Config:
             t = config_file['sender_address']
         except KeyError:
             print("")
-            print("Error: missing 'sender_address' in config file")
+            print("Error: missing 'sender_address' in config file: " + filename)
+            config_file['sender_address'] = None
+
+        # the website of the bank, can point to a test server (see mock_bank.py)
+        if ('bank_url' not in config_file):
+            config_file['bank_url'] = 'https://www.' + 'deutsche' + '-' + 'bank' + '.de/'
+        if (urllib.parse.urlsplit(str(config_file['bank_url'])).scheme not in ['http', 'https']):
+            print("")
+            print("Error: 'bank_url' must be a http:// or https:// URL, in config file: " + filename)
+            sys.exit(1)
+
+        # every account keeps the sender address and the bank URL of its own config file
+        for account in config_file['accounts']:
+            if ('sender_address' not in config_file['accounts'][account]):
+                config_file['accounts'][account]['sender_address'] = config_file['sender_address']
+            if ('bank_url' not in config_file['accounts'][account]):
+                config_file['accounts'][account]['bank_url'] = config_file['bank_url']
+            # needed for the database file with 'shard: config'
+            config_file['accounts'][account]['config_file'] = filename
+
+        # a relative database location is relative to the directory of the config file,
+        # not to the current directory (which is different for cron jobs)
+        if (isinstance(config_file.get('database'), dict)):
+            for check in ['file', 'directory']:
+                location = config_file['database'].get(check)
+                if (isinstance(location, str) and len(location) > 0):
+                    location = os.path.expanduser(location)
+                    if (os.path.isabs(location) is False):
+                        location = os.path.join(os.path.dirname(os.path.abspath(filename)), location)
+                    config_file['database'][check] = location
+
+        return config_file
+
+
+
+    # load_config()
+    #
+    # load all configuration files, and merge the accounts
+    # global settings can be specified in any of the config files, but only with one value
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def load_config(self):
+        if not (self.arguments.config):
+            return
+
+        config_file = None
+        for filename in self.config_files():
+            next_config = self.load_config_file(filename)
+            if (config_file is None):
+                config_file = next_config
+                continue
+            for account in next_config['accounts']:
+                if (account in config_file['accounts']):
+                    print("")
+                    print("Error: account '" + str(account) + "' is specified in multiple config files")
+                    sys.exit(1)
+                config_file['accounts'][account] = next_config['accounts'][account]
+            # the other sections are global: a later config file can add a section,
+            # but must not specify a different setting
+            for section in next_config:
+                if (section in ['accounts', 'sender_address', 'bank_url']):
+                    continue
+                if (section not in config_file):
+                    config_file[section] = next_config[section]
+                elif (config_file[section] != next_config[section]):
+                    print("")
+                    print("Error: '" + str(section) + "' in config file " + filename + " differs from a previous config file")
+                    sys.exit(1)
+
+        if (config_file is None):
+            print("")
+            print("Error: no config file found")
+            sys.exit(1)
+
+
+        # database location is optional, fill in defaults
+        # 'shard': 'none' keeps all accounts in 'file', 'account' and 'config' use one file
+        # per account or per config file in 'directory'
+        database_defaults = {'file': '~/.db_accounts',
+                             'shard': 'none',
+                             'directory': None}
+        if ('database' not in config_file or config_file['database'] is None):
+            config_file['database'] = {}
+        for check in database_defaults:
+            if (check not in config_file['database']):
+                config_file['database'][check] = database_defaults[check]
+        if (not isinstance(config_file['database']['file'], str) or len(config_file['database']['file']) == 0):
+            print("")
+            print("Error: 'file' in 'database' must be a file name")
+            sys.exit(1)
+        if (config_file['database']['shard'] not in ['none', 'account', 'config']):
+            print("")
+            print("Error: 'shard' in 'database' must be 'none', 'account' or 'config'")
+            sys.exit(1)
+        if (config_file['database']['directory'] is None):
+            config_file['database']['directory'] = config_file['database']['file'] + '.d'
+        if (not isinstance(config_file['database']['directory'], str) or len(config_file['database']['directory']) == 0):
+            print("")
+            print("Error: 'directory' in 'database' must be a directory name")
+            sys.exit(1)
+        config_file['database']['file'] = os.path.expanduser(config_file['database']['file'])
+        config_file['database']['directory'] = os.path.expanduser(config_file['database']['directory'])
+
+        # every account knows its database file
+        shards = {}
+        for account in config_file['accounts']:
+            if (config_file['database']['shard'] == 'none'):
+                config_file['accounts'][account]['database_file'] = config_file['database']['file']
+                continue
+            if (config_file['database']['shard'] == 'account'):
+                shard = str(account)
+            else:
+                shard = os.path.splitext(os.path.basename(config_file['accounts'][account]['config_file']))[0]
+            database_file = os.path.join(config_file['database']['directory'], re.sub(r'[^A-Za-z0-9_.-]', '_', shard) + '.db')
+            # different names must not end up in the same file
+            if (shards.setdefault(database_file, shard) != shard):
+                print("")
+                print("Error: '" + str(shard) + "' and '" + str(shards[database_file]) + "' use the same database file: " + database_file)
+                sys.exit(1)
+            config_file['accounts'][account]['database_file'] = database_file
+
+
+        # database maintenance settings are optional, fill in defaults
+        maintenance_defaults = {'balance_keep_all_days': 90,
+                                'balance_keep_daily_days': 730,
+                                'change_log_keep_days': 0,
+                                'vacuum_pages': 256}
+        if ('maintenance' not in config_file or config_file['maintenance'] is None):
+            config_file['maintenance'] = {}
+        for check in maintenance_defaults:
+            if (check not in config_file['maintenance']):
+                config_file['maintenance'][check] = maintenance_defaults[check]
+            value = config_file['maintenance'][check]
+            if (isinstance(value, bool) or not isinstance(value, int) or value < 0):
+                print("")
+                print("Error: '" + str(check) + "' in 'maintenance' must be a positive number")
+                sys.exit(1)
+
+
+        # backfill settings are optional, fill in defaults
+        if ('backfill' not in config_file or config_file['backfill'] is None):
+            config_file['backfill'] = {}
+        if ('chunk_days' not in config_file['backfill']):
+            config_file['backfill']['chunk_days'] = 85
+        chunk_days = config_file['backfill']['chunk_days']
+        if (isinstance(chunk_days, bool) or not isinstance(chunk_days, int) or chunk_days < 1):
+            print("")
+            print("Error: 'chunk_days' in 'backfill' must be a positive number")
+            sys.exit(1)
+
+
+        # query API settings are optional, fill in defaults
+        serve_defaults = {'listen': '127.0.0.1',
+                          'port': 8089,
+                          'cache_entries': 256}
+        if ('serve' not in config_file or config_file['serve'] is None):
+            config_file['serve'] = {}
+        for check in serve_defaults:
+            if (check not in config_file['serve']):
+                config_file['serve'][check] = serve_defaults[check]
+        for check in ['port', 'cache_entries']:
+            value = config_file['serve'][check]
+            if (isinstance(value, bool) or not isinstance(value, int) or value < 1):
+                print("")
+                print("Error: '" + str(check) + "' in 'serve' must be a positive number")
+                sys.exit(1)
+
+
+        # daemon settings are optional, fill in defaults
+        if ('daemon' not in config_file or config_file['daemon'] is None):
+            config_file['daemon'] = {}
+        if ('jitter' not in config_file['daemon']):
+            config_file['daemon']['jitter'] = 60
+        jitter = config_file['daemon']['jitter']
+        if (isinstance(jitter, bool) or not isinstance(jitter, int) or jitter < 0):
+            print("")
+            print("Error: 'jitter' in 'daemon' must be a positive number")
+            sys.exit(1)
+
+
+        # adaptive fetching is optional, fill in defaults
+        adaptive_defaults = {'enabled': False,
+                             'min_probability': 0.1,
+                             'min_samples': 8,
+                             'max_staleness': 2880}
+        if ('adaptive' not in config_file or config_file['adaptive'] is None):
+            config_file['adaptive'] = {}
+        for check in adaptive_defaults:
+            if (check not in config_file['adaptive']):
+                config_file['adaptive'][check] = adaptive_defaults[check]
+        if (config_file['adaptive']['enabled'] != True and config_file['adaptive']['enabled'] != False):
+            print("")
+            print("Error: 'enabled' in 'adaptive' must be true or false")
+            sys.exit(1)
+        for check in ['min_samples', 'max_staleness']:
+            value = config_file['adaptive'][check]
+            if (isinstance(value, bool) or not isinstance(value, int) or value < 1):
+                print("")
+                print("Error: '" + str(check) + "' in 'adaptive' must be a positive number")
+                sys.exit(1)
+        min_probability = config_file['adaptive']['min_probability']
+        if (isinstance(min_probability, bool) or not isinstance(min_probability, (int, float)) or min_probability < 0 or min_probability > 1):
+            print("")
+            print("Error: 'min_probability' in 'adaptive' must be between 0 and 1")
+            sys.exit(1)
+
+
+        # anomaly detection for new debits, optional, fill in defaults
+        anomalies_defaults = {'enabled': True,
+                              'min_samples': 5,
+                              'threshold': 3.0,
+                              'min_difference': 10.0,
+                              'new_payee_amount': 500.0}
+        if ('anomalies' not in config_file or config_file['anomalies'] is None):
+            config_file['anomalies'] = {}
+        for check in anomalies_defaults:
+            if (check not in config_file['anomalies']):
+                config_file['anomalies'][check] = anomalies_defaults[check]
+        if (config_file['anomalies']['enabled'] != True and config_file['anomalies']['enabled'] != False):
+            print("")
+            print("Error: 'enabled' in 'anomalies' must be true or false")
+            sys.exit(1)
+        min_samples = config_file['anomalies']['min_samples']
+        if (isinstance(min_samples, bool) or not isinstance(min_samples, int) or min_samples < 2):
+            print("")
+            print("Error: 'min_samples' in 'anomalies' must be at least 2")
+            sys.exit(1)
+        for check in ['threshold', 'min_difference', 'new_payee_amount']:
+            value = config_file['anomalies'][check]
+            if (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+                print("")
+                print("Error: '" + str(check) + "' in 'anomalies' must be a positive number")
+                sys.exit(1)
+
+
+        # categorization rules are optional, and compiled once per load
+        if ('categories' not in config_file or config_file['categories'] is None):
+            config_file['categories'] = []
+        if (not isinstance(config_file['categories'], list)):
+            print("")
+            print("Error: 'categories' must be a list of rules")
+            sys.exit(1)
+        for rule in config_file['categories']:
+            if (not isinstance(rule, dict) or not isinstance(rule.get('category'), str) or len(rule['category']) == 0):
+                print("")
+                print("Error: every rule in 'categories' needs a 'category': " + str(rule))
+                sys.exit(1)
+            fields = [field for field in Categorizer.fields if field in rule]
+            if (len(fields) == 0):
+                print("")
+                print("Error: rule for category '" + str(rule['category']) + "' needs one of: " + ', '.join(Categorizer.fields))
+                sys.exit(1)
+            for field in fields:
+                values = rule[field] if isinstance(rule[field], list) else [rule[field]]
+                for value in values:
+                    if (not isinstance(value, str) or len(value.strip()) == 0):
+                        print("")
+                        print("Error: '" + str(field) + "' in rule for category '" + str(rule['category']) + "' must be a non-empty text")
+                        sys.exit(1)
+        categorizer = Categorizer(config_file['categories'])
 
 
         self.configfile = config_file
+        self.categorizer = categorizer
         self.__configfile_read = 1
 
         return
 
 
+
+    # database_files()
+    #
+    # return the database files of all accounts
+    #
+    # parameter:
+    #  - self
+    #  - True: only files which already exist
+    # return:
+    #  - list with database files
+    def database_files(self, existing = False):
+        files = sorted(set([self.configfile['accounts'][account]['database_file'] for account in self.configfile['accounts']]))
+        if (len(files) == 0):
+            # no accounts configured, the reports still work on the main file
+            files = [self.configfile['database']['file']]
+        if (existing is True):
+            files = [database_file for database_file in files if os.path.isfile(database_file)]
+
+        return files
+
+
 # end Config class
 #######################################################################
 
@@ -265,12 +758,50 @@ class Config:
 
 class Database:
 
-    def __init__(self, config):
+    # day of the booking as sortable text (YYYYMMDD), the dates are stored as DD.MM.YYYY
+    # queries must use exactly this expression to use the 'account_statements_booking_order' index
+    booking_day = "(substr(date_of_bookkeeping, 7, 4) || substr(date_of_bookkeeping, 4, 2) || substr(date_of_bookkeeping, 1, 2))"
+
+    def __init__(self, config, database_file, read_only = False, attach = None):
         self.config = config
 
-        # database defaults to a hardcoded file
-        self.connection = sqlite3.connect(os.path.join(os.environ.get('HOME'), '.db_accounts'))
+        # the file is set in the 'database' section of the config file (one file, or one per account/config file)
+        self.database_file = database_file
+        # schema name -> database file, reports over all accounts use the attached files as well
+        self.schemas = collections.OrderedDict()
+        self.schemas['main'] = database_file
+        # read only connections for the attached files, see shard_database()
+        self.shards = {}
+        if (read_only is True):
+            # readers never change the schema, and never block on a missing file
+            if (os.path.isfile(self.database_file) is False):
+                logging.error("Database does not exist: " + self.database_file)
+                sys.exit(1)
+            self.connection = sqlite3.connect('file:' + self.database_file + '?mode=ro', uri = True)
+            self.connection.row_factory = sqlite3.Row
+            atexit.register(self.exit_handler)
+            for attach_file in (attach or []):
+                schema = 'shard' + str(len(self.schemas))
+                try:
+                    self.connection.execute("ATTACH DATABASE ? AS " + schema, ['file:' + attach_file + '?mode=ro'])
+                except sqlite3.OperationalError as e:
+                    # SQLite limits the number of attached files (usually 10)
+                    logging.error("Can't attach database " + attach_file + ": " + str(e))
+                    sys.exit(1)
+                self.schemas[schema] = attach_file
+            return
+
+        # the directory for 'shard' (a file name without directory is in the current directory)
+        if (os.path.dirname(self.database_file) != '' and os.path.isdir(os.path.dirname(self.database_file)) is False):
+            os.makedirs(os.path.dirname(self.database_file), mode = 0o700)
+        self.connection = sqlite3.connect(self.database_file)
         self.connection.row_factory = sqlite3.Row
+        # (iban, bic, creditor_id) -> counterparty ID, filled on first use
+        self.counterparties = None
+        # a new database starts with incremental vacuum enabled,
+        # this setting only has an effect before the first table is created
+        if (self.execute_one("SELECT COUNT(*) AS cnt FROM sqlite_master", [])['cnt'] == 0):
+            self.run_query("PRAGMA auto_vacuum = INCREMENTAL")
         # debugging
         #self.drop_tables()
         self.init_tables()
@@ -285,6 +816,44 @@ class Database:
 
 
 
+    # shard_database()
+    #
+    # return the database for one of the schemas, queries for a single account run there
+    #
+    # parameter:
+    #  - self
+    #  - schema name ('main', or an attached file)
+    # return:
+    #  - database object
+    def shard_database(self, schema):
+        if (schema == 'main'):
+            return self
+        if (schema not in self.shards):
+            self.shards[schema] = Database(self.config, self.schemas[schema], read_only = True)
+
+        return self.shards[schema]
+
+
+
+    # union_query()
+    #
+    # run a query on every schema (the main file and all attached files), and combine the results
+    #
+    # parameter:
+    #  - self
+    #  - query for one schema, '{schema}' is replaced with the schema name
+    #  - list with parameters for one schema
+    #  - ORDER BY clause for the combined result
+    # return:
+    #  - list with result rows
+    def union_query(self, query, param, order):
+        parts = [query.replace('{schema}', schema) for schema in self.schemas]
+        query = "SELECT * FROM (" + "\n UNION ALL\n".join(parts) + ") ORDER BY " + order
+
+        return self.execute_query(query, param * len(parts))
+
+
+
     # get_account_id()
     #
     # retrieve database ID for account, create if necessary
@@ -335,22 +904,202 @@ class Database:
     # return:
     #  none
     def init_tables(self):
-        if (self.table_exist('bank_accounts') is False):
+        # one lookup for all tables, instead of one query per table
+        query = "SELECT name FROM sqlite_master WHERE type='table'"
+        tables = set([row['name'] for row in self.execute_query(query, [])])
+
+        if ('bank_accounts' not in tables):
             logging.debug("need to create table bank_accounts")
             self.table_bank_accounts()
 
-        if (self.table_exist('account_balance') is False):
+        if ('account_balance' not in tables):
             logging.debug("need to create table account_balance")
             self.table_account_balance()
 
-        if (self.table_exist('account_statements') is False):
+        if ('account_statements' not in tables):
             logging.debug("need to create table account_statements")
             self.table_account_statements()
 
-        if (self.table_exist('user_information') is False):
+        if ('counterparties' not in tables):
+            logging.debug("need to create table counterparties")
+            self.table_counterparties()
+
+        if ('user_information' not in tables):
             logging.debug("need to create table user_information")
             self.table_user_information()
 
+        if ('backfill_state' not in tables):
+            logging.debug("need to create table backfill_state")
+            self.table_backfill_state()
+
+        if ('turnovers_fingerprints' not in tables):
+            logging.debug("need to create table turnovers_fingerprints")
+            self.table_turnovers_fingerprints()
+
+        if ('bank_access_logs' not in tables):
+            logging.debug("need to create table bank_access_logs")
+            self.table_bank_access_logs()
+
+        if ('recurring_payments' not in tables):
+            logging.debug("need to create table recurring_payments")
+            self.table_recurring_payments()
+
+        if ('fetch_statistics' not in tables):
+            logging.debug("need to create table fetch_statistics")
+            self.table_fetch_statistics()
+
+        if ('change_log' not in tables):
+            logging.debug("need to create table change_log")
+            self.table_change_log()
+
+        if ('run_state' not in tables):
+            logging.debug("need to create table run_state")
+            self.table_run_state()
+
+        if ('amount_statistics' not in tables):
+            logging.debug("need to create table amount_statistics")
+            self.table_amount_statistics()
+
+        if ('monthly_spending' not in tables):
+            logging.debug("need to create table monthly_spending")
+            self.table_monthly_spending()
+
+        if ('threshold_alerts' not in tables):
+            logging.debug("need to create table threshold_alerts")
+            self.table_threshold_alerts()
+
+        # migrations first, new indexes can depend on migrated columns
+        self.init_migrations()
+        self.init_indexes()
+
+
+
+    # init_migrations()
+    #
+    # update the data in existing databases, the schema version
+    # is kept in 'user_version'
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def init_migrations(self):
+        version = self.execute_one("PRAGMA user_version", [])[0]
+
+        if (version < 1):
+            # credit amounts were stored in the German format ('1.234,56'), as text
+            logging.debug("migrate credit amounts to numbers")
+            query = """UPDATE account_statements
+                          SET amount = CAST(REPLACE(REPLACE(amount, '.', ''), ',', '.') AS NUMERIC)
+                        WHERE typeof(amount) = 'text'"""
+            self.execute_one(query, [])
+            self.run_query("PRAGMA user_version = 1")
+
+        if (version < 2):
+            # category for the statements, new tables already have the column
+            columns = [column['name'] for column in self.execute_query("PRAGMA table_info(account_statements)", [])]
+            if ('category' not in columns):
+                logging.debug("add category to account_statements")
+                self.run_query("ALTER TABLE account_statements ADD COLUMN category TEXT")
+            self.run_query("PRAGMA user_version = 2")
+
+        if (version < 3):
+            # IBAN, BIC and creditor ID are moved into the 'counterparties' table,
+            # the statements table is rebuilt with a reference instead
+            columns = [column['name'] for column in self.execute_query("PRAGMA table_info(account_statements)", [])]
+            if ('iban' in columns):
+                logging.info("migrate account statements to counterparties, this can take a while")
+                self.run_query("DROP TABLE IF EXISTS account_statements_new")
+                self.table_account_statements('account_statements_new')
+                self.connection.executescript("""BEGIN;
+                    INSERT OR IGNORE INTO counterparties (iban, bic, creditor_id)
+                         SELECT DISTINCT iban, bic, creditor_id
+                           FROM account_statements;
+                    INSERT INTO account_statements_new
+                                (id, added_ts, date_of_bookkeeping, date_of_value, bank_account, intended_use,
+                                 intended_use2, counterparty, customer_reference, mandate_reference, amount,
+                                 currency, category)
+                         SELECT s.id, s.added_ts, s.date_of_bookkeeping, s.date_of_value, s.bank_account, s.intended_use,
+                                s.intended_use2, c.id, s.customer_reference, s.mandate_reference, s.amount,
+                                s.currency, s.category
+                           FROM account_statements s
+                           JOIN counterparties c
+                             ON c.iban = s.iban
+                            AND c.bic = s.bic
+                            AND c.creditor_id = s.creditor_id;
+                    DROP TABLE account_statements;
+                    ALTER TABLE account_statements_new RENAME TO account_statements;
+                    PRAGMA user_version = 3;
+                    COMMIT;""")
+                # the indexes were dropped with the old table, and are created again by init_indexes()
+                self.incremental_vacuum(None)
+            else:
+                self.run_query("PRAGMA user_version = 3")
+
+        if (version < 4):
+            # balance after every statement, new tables already have the column
+            columns = [column['name'] for column in self.execute_query("PRAGMA table_info(account_statements)", [])]
+            if ('running_balance' not in columns):
+                logging.debug("add running_balance to account_statements")
+                self.run_query("ALTER TABLE account_statements ADD COLUMN running_balance NUMERIC")
+            # the index is required for the calculation
+            self.run_query("""CREATE INDEX IF NOT EXISTS account_statements_booking_order
+                                       ON account_statements (bank_account, """ + self.booking_day + """, id)""")
+            for account in self.execute_query("SELECT id FROM bank_accounts", []):
+                self.repair_running_balance(account['id'])
+            self.run_query("PRAGMA user_version = 4")
+
+        if (version < 5):
+            # the counterparty index is extended for the recurring payments
+            self.run_query("DROP INDEX IF EXISTS account_statements_counterparty")
+            self.run_query("""CREATE INDEX IF NOT EXISTS account_statements_recurring
+                                       ON account_statements (bank_account, counterparty, mandate_reference, """ + self.booking_day + """)""")
+            # detect the recurring payments in the existing statements
+            for account in self.execute_query("SELECT id FROM bank_accounts", []):
+                self.update_recurring_payments(account['id'])
+            self.run_query("PRAGMA user_version = 5")
+
+        if (version < 6):
+            # flags from the anomaly detection, new tables already have the column
+            columns = [column['name'] for column in self.execute_query("PRAGMA table_info(account_statements)", [])]
+            if ('anomaly' not in columns):
+                logging.debug("add anomaly to account_statements")
+                self.run_query("ALTER TABLE account_statements ADD COLUMN anomaly TEXT")
+            # the existing statements are the baseline for the anomaly detection
+            for account in self.execute_query("SELECT id FROM bank_accounts", []):
+                self.rebuild_amount_statistics(account['id'])
+            self.run_query("PRAGMA user_version = 6")
+
+        if (version < 7):
+            # the monthly counters for the budgets start with the existing statements
+            for account in self.execute_query("SELECT id FROM bank_accounts", []):
+                self.rebuild_monthly_spending(account['id'])
+            self.run_query("PRAGMA user_version = 7")
+
+
+
+    # init_indexes()
+    #
+    # create all missing indexes
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def init_indexes(self):
+        # used by the 'stats' command
+        self.run_query("""CREATE INDEX IF NOT EXISTS bank_access_logs_start
+                                   ON bank_access_logs (start_ts)""")
+        # used when comparing new bookings with existing statements
+        self.run_query("""CREATE INDEX IF NOT EXISTS account_statements_bookkeeping
+                                   ON account_statements (bank_account, date_of_bookkeeping)""")
+        # used by the payee report, and for the recurring payments
+        self.run_query("""CREATE INDEX IF NOT EXISTS account_statements_recurring
+                                   ON account_statements (bank_account, counterparty, mandate_reference, """ + self.booking_day + """)""")
+        # statements in booking order, used for the running balance
+        self.run_query("""CREATE INDEX IF NOT EXISTS account_statements_booking_order
+                                   ON account_statements (bank_account, """ + self.booking_day + """, id)""")
+
 
 
     # drop_tables()
@@ -382,6 +1131,46 @@ class Database:
             logging.debug("drop table user_information")
             self.drop_table('user_information')
 
+        if (self.table_exist('backfill_state') is True):
+            logging.debug("drop table backfill_state")
+            self.drop_table('backfill_state')
+
+        if (self.table_exist('turnovers_fingerprints') is True):
+            logging.debug("drop table turnovers_fingerprints")
+            self.drop_table('turnovers_fingerprints')
+
+        if (self.table_exist('counterparties') is True):
+            logging.debug("drop table counterparties")
+            self.drop_table('counterparties')
+
+        if (self.table_exist('recurring_payments') is True):
+            logging.debug("drop table recurring_payments")
+            self.drop_table('recurring_payments')
+
+        if (self.table_exist('fetch_statistics') is True):
+            logging.debug("drop table fetch_statistics")
+            self.drop_table('fetch_statistics')
+
+        if (self.table_exist('change_log') is True):
+            logging.debug("drop table change_log")
+            self.drop_table('change_log')
+
+        if (self.table_exist('run_state') is True):
+            logging.debug("drop table run_state")
+            self.drop_table('run_state')
+
+        if (self.table_exist('amount_statistics') is True):
+            logging.debug("drop table amount_statistics")
+            self.drop_table('amount_statistics')
+
+        if (self.table_exist('monthly_spending') is True):
+            logging.debug("drop table monthly_spending")
+            self.drop_table('monthly_spending')
+
+        if (self.table_exist('threshold_alerts') is True):
+            logging.debug("drop table threshold_alerts")
+            self.drop_table('threshold_alerts')
+
 
 
 
@@ -528,10 +1317,11 @@ class Database:
     #
     # parameter:
     #  - self
+    #  - table name (optional, used by migrations)
     # return:
     #  none
-    def table_account_statements(self):
-        query = """CREATE TABLE account_statements (
+    def table_account_statements(self, table = 'account_statements'):
+        query = """CREATE TABLE """ + table + """ (
                 id INTEGER PRIMARY KEY NOT NULL,
                 added_ts DATETIME DEFAULT CURRENT_TIMESTAMP,
                 date_of_bookkeeping DATE NOT NULL,
@@ -539,14 +1329,38 @@ class Database:
                 bank_account INTEGER NOT NULL,
                 intended_use TEXT NOT NULL,
                 intended_use2 TEXT NOT NULL,
-                iban TEXT NOT NULL,
-                bic TEXT NOT NULL,
+                counterparty INTEGER NOT NULL,
                 customer_reference TEXT NOT NULL,
                 mandate_reference TEXT NOT NULL,
-                creditor_id TEXT NOT NULL,
                 amount NUMERIC NOT NULL,
                 currency TEXT NOT NULL,
-                FOREIGN KEY (bank_account) REFERENCES bank_accounts(id)
+                category TEXT,
+                running_balance NUMERIC,
+                anomaly TEXT,
+                FOREIGN KEY (bank_account) REFERENCES bank_accounts(id),
+                FOREIGN KEY (counterparty) REFERENCES counterparties(id)
+                )"""
+        self.run_query(query)
+
+
+
+    # table_counterparties()
+    #
+    # create the 'counterparties' table
+    # every IBAN/BIC/creditor ID combination is stored only once
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def table_counterparties(self):
+        query = """CREATE TABLE counterparties (
+                id INTEGER PRIMARY KEY NOT NULL,
+                added_ts DATETIME DEFAULT CURRENT_TIMESTAMP,
+                iban TEXT NOT NULL,
+                bic TEXT NOT NULL,
+                creditor_id TEXT NOT NULL,
+                UNIQUE (iban, bic, creditor_id)
                 )"""
         self.run_query(query)
 
@@ -573,143 +1387,2749 @@ class Database:
 
 
 
-    # save_account_amount()
+    # table_backfill_state()
     #
-    # save current account balance
+    # create the 'backfill_state' table
     #
     # parameter:
     #  - self
-    #  - account id
-    #  - balance
-    #  - currency
     # return:
     #  none
-    def save_account_amount(self, account_id, bank_balance, bank_balance_currency):
-        query = """INSERT INTO account_balance
-                               (bank_account, account_balance, account_balance_currency)
-                        VALUES (?, ?, ?)"""
-        self.execute_one(query, [account_id, bank_balance, bank_balance_currency])
+    def table_backfill_state(self):
+        query = """CREATE TABLE backfill_state (
+                id INTEGER PRIMARY KEY NOT NULL,
+                added_ts DATETIME DEFAULT CURRENT_TIMESTAMP,
+                bank_account INTEGER NOT NULL UNIQUE,
+                from_date DATE NOT NULL,
+                next_date DATE NOT NULL,
+                FOREIGN KEY (bank_account) REFERENCES bank_accounts(id)
+                )"""
+        self.run_query(query)
 
 
 
-    # save_account_transactions()
+    # table_turnovers_fingerprints()
     #
-    # save transactions, verify if transactions have been seen before
+    # create the 'turnovers_fingerprints' table
     #
     # parameter:
     #  - self
-    #  - account ID
-    #  - list with transactions
     # return:
     #  none
-    def save_account_transactions(self, account_id, bookings):
-        for transaction in bookings:
-            transaction['bank_account'] = account_id
-            query = """SELECT *
-                         FROM account_statements
-                        WHERE bank_account = ?
-                          AND date_of_bookkeeping = ?
-                          AND date_of_value = ?
-                          AND intended_use = ?
-                          AND intended_use2 = ?
-                          AND iban = ?
-                          AND bic = ?
-                          AND customer_reference = ?
+    def table_turnovers_fingerprints(self):
+        query = """CREATE TABLE turnovers_fingerprints (
+                id INTEGER PRIMARY KEY NOT NULL,
+                added_ts DATETIME DEFAULT CURRENT_TIMESTAMP,
+                bank_account INTEGER NOT NULL UNIQUE,
+                fingerprint TEXT NOT NULL,
+                FOREIGN KEY (bank_account) REFERENCES bank_accounts(id)
+                )"""
+        self.run_query(query)
+
+
+
+    # table_bank_access_logs()
+    #
+    # create the 'bank_access_logs' table
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def table_bank_access_logs(self):
+        query = """CREATE TABLE bank_access_logs (
+                id INTEGER PRIMARY KEY NOT NULL,
+                added_ts DATETIME DEFAULT CURRENT_TIMESTAMP,
+                bank_account INTEGER NOT NULL,
+                start_ts DATETIME NOT NULL,
+                end_ts DATETIME NOT NULL,
+                duration REAL NOT NULL,
+                http_time REAL NOT NULL,
+                http_bytes INTEGER NOT NULL,
+                http_steps TEXT NOT NULL,
+                bookings_parsed INTEGER NOT NULL,
+                bookings_inserted INTEGER NOT NULL,
+                bookings_skipped INTEGER NOT NULL,
+                db_time REAL NOT NULL,
+                smtp_time REAL NOT NULL,
+                outcome TEXT NOT NULL,
+                FOREIGN KEY (bank_account) REFERENCES bank_accounts(id)
+                )"""
+        self.run_query(query)
+
+
+
+    # table_recurring_payments()
+    #
+    # create the 'recurring_payments' table
+    # one entry per direct debit mandate (or creditor), which is charged regularly
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def table_recurring_payments(self):
+        query = """CREATE TABLE recurring_payments (
+                id INTEGER PRIMARY KEY NOT NULL,
+                added_ts DATETIME DEFAULT CURRENT_TIMESTAMP,
+                bank_account INTEGER NOT NULL,
+                counterparty INTEGER NOT NULL,
+                mandate_reference TEXT NOT NULL,
+                last_statement INTEGER NOT NULL,
+                last_date DATE NOT NULL,
+                period_days INTEGER NOT NULL,
+                expected_amount NUMERIC NOT NULL,
+                currency TEXT NOT NULL,
+                next_due DATE NOT NULL,
+                status TEXT NOT NULL,
+                UNIQUE (bank_account, counterparty, mandate_reference),
+                FOREIGN KEY (bank_account) REFERENCES bank_accounts(id),
+                FOREIGN KEY (counterparty) REFERENCES counterparties(id),
+                FOREIGN KEY (last_statement) REFERENCES account_statements(id)
+                )"""
+        self.run_query(query)
+
+
+
+    # table_fetch_statistics()
+    #
+    # create the 'fetch_statistics' table
+    # number of fetches, and fetches which found new bookings, per weekday and hour (local time)
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def table_fetch_statistics(self):
+        query = """CREATE TABLE fetch_statistics (
+                id INTEGER PRIMARY KEY NOT NULL,
+                bank_account INTEGER NOT NULL,
+                weekday INTEGER NOT NULL,
+                hour INTEGER NOT NULL,
+                fetches REAL NOT NULL,
+                productive REAL NOT NULL,
+                UNIQUE (bank_account, weekday, hour),
+                FOREIGN KEY (bank_account) REFERENCES bank_accounts(id)
+                )"""
+        self.run_query(query)
+
+
+
+    # table_change_log()
+    #
+    # create the 'change_log' table
+    # append only feed of new statements and balance changes, for other systems
+    # AUTOINCREMENT: sequence numbers are never reused, even after pruning
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def table_change_log(self):
+        query = """CREATE TABLE change_log (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                added_ts DATETIME DEFAULT CURRENT_TIMESTAMP,
+                bank_account INTEGER NOT NULL,
+                type TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                FOREIGN KEY (bank_account) REFERENCES bank_accounts(id)
+                )"""
+        self.run_query(query)
+
+
+
+    # table_amount_statistics()
+    #
+    # create the 'amount_statistics' table
+    # number, mean and sum of squared differences (M2) of the debits,
+    # per counterparty and per category, updated with every new batch of statements
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def table_amount_statistics(self):
+        query = """CREATE TABLE amount_statistics (
+                id INTEGER PRIMARY KEY NOT NULL,
+                bank_account INTEGER NOT NULL,
+                type TEXT NOT NULL,
+                key TEXT NOT NULL,
+                samples INTEGER NOT NULL,
+                mean REAL NOT NULL,
+                m2 REAL NOT NULL,
+                UNIQUE (bank_account, type, key),
+                FOREIGN KEY (bank_account) REFERENCES bank_accounts(id)
+                )"""
+        self.run_query(query)
+
+
+
+    # table_monthly_spending()
+    #
+    # create the 'monthly_spending' table
+    # sum of the debits per month and category ('' for all debits), counter for the budgets
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def table_monthly_spending(self):
+        query = """CREATE TABLE monthly_spending (
+                id INTEGER PRIMARY KEY NOT NULL,
+                bank_account INTEGER NOT NULL,
+                month TEXT NOT NULL,
+                category TEXT NOT NULL,
+                amount NUMERIC NOT NULL,
+                UNIQUE (bank_account, month, category),
+                FOREIGN KEY (bank_account) REFERENCES bank_accounts(id)
+                )"""
+        self.run_query(query)
+
+
+
+    # table_threshold_alerts()
+    #
+    # create the 'threshold_alerts' table
+    # crossed balance thresholds and budgets, until they are reported
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def table_threshold_alerts(self):
+        query = """CREATE TABLE threshold_alerts (
+                id INTEGER PRIMARY KEY NOT NULL,
+                added_ts DATETIME DEFAULT CURRENT_TIMESTAMP,
+                bank_account INTEGER NOT NULL,
+                type TEXT NOT NULL,
+                month TEXT,
+                category TEXT,
+                value NUMERIC NOT NULL,
+                threshold NUMERIC NOT NULL,
+                currency TEXT NOT NULL,
+                reported INTEGER NOT NULL DEFAULT 0,
+                FOREIGN KEY (bank_account) REFERENCES bank_accounts(id)
+                )"""
+        self.run_query(query)
+
+
+
+    # table_run_state()
+    #
+    # create the 'run_state' table
+    # state of every account in the last run, used by --resume
+    # the account name is used, because an account can fail before it has an ID
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def table_run_state(self):
+        query = """CREATE TABLE run_state (
+                account TEXT PRIMARY KEY NOT NULL,
+                status TEXT NOT NULL,
+                phase TEXT,
+                updated_ts DATETIME DEFAULT CURRENT_TIMESTAMP
+                )"""
+        self.run_query(query)
+
+
+
+    # save_account_amount()
+    #
+    # save current account balance
+    # a changed balance is added to the change log, and a balance which drops
+    # below the threshold to the alerts, in the same transaction
+    #
+    # parameter:
+    #  - self
+    #  - account id
+    #  - balance
+    #  - currency
+    #  - alert threshold for the balance (optional)
+    # return:
+    #  none
+    def save_account_amount(self, account_id, bank_balance, bank_balance_currency, min_balance = None):
+        previous = self.last_account_balance(account_id)
+        cur = self.connection.cursor()
+        query = """INSERT INTO account_balance
+                               (bank_account, account_balance, account_balance_currency)
+                        VALUES (?, ?, ?)"""
+        cur.execute(query, [account_id, bank_balance, bank_balance_currency])
+        if (previous is None or float(previous['account_balance']) != float(bank_balance) or
+            previous['account_balance_currency'] != bank_balance_currency):
+            payload = {'id': cur.lastrowid, 'account_balance': float(bank_balance), 'account_balance_currency': bank_balance_currency}
+            cur.execute("INSERT INTO change_log (bank_account, type, payload) VALUES (?, 'balance', ?)",
+                        [account_id, json.dumps(payload)])
+        if (min_balance is not None and float(bank_balance) < min_balance and
+            (previous is None or float(previous['account_balance']) >= min_balance)):
+            query = """INSERT INTO threshold_alerts (bank_account, type, value, threshold, currency)
+                            VALUES (?, 'balance', ?, ?, ?)"""
+            cur.execute(query, [account_id, float(bank_balance), min_balance, bank_balance_currency])
+        self.connection.commit()
+
+
+
+    # save_account_transactions()
+    #
+    # save transactions, verify if transactions have been seen before
+    # the bookings are read in batches into a temporary table, and then
+    # compared with the existing statements in one bulk query
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    #  - dictionary with account data: 'bookings' (read only once), and the balance as
+    #    anchor for the running balance (the balance can be set while the bookings are read)
+    #    if the bookings turn out to be 'unchanged', nothing is saved
+    #  - list with budgets, crossed budgets are added to the alerts (optional)
+    #  - False: the caller updates the running balance later (see repair_running_balance())
+    # return:
+    #  - list with the IDs of the new statements
+    def save_account_transactions(self, account_id, account_data, budgets = None, running_balance = True):
+        cur = self.connection.cursor()
+        cur.execute("""CREATE TEMP TABLE IF NOT EXISTS new_statements (
+                       seq INTEGER NOT NULL,
+                       date_of_bookkeeping DATE NOT NULL,
+                       date_of_value DATE NOT NULL,
+                       intended_use TEXT NOT NULL,
+                       intended_use2 TEXT NOT NULL,
+                       counterparty INTEGER NOT NULL,
+                       customer_reference TEXT NOT NULL,
+                       mandate_reference TEXT NOT NULL,
+                       amount NUMERIC NOT NULL,
+                       currency TEXT NOT NULL
+                       )""")
+        cur.execute("DELETE FROM temp.new_statements")
+
+        # only one batch of bookings is in memory, the parser creates the next batch on demand
+        bookings = iter(account_data['bookings'])
+        seq = 0
+        while True:
+            rows = []
+            for booking in itertools.islice(bookings, 1000):
+                counterparty = self.counterparty_id(booking.iban, booking.bic, booking.creditor_id)
+                rows.append([seq, booking.date_of_bookkeeping, booking.date_of_value,
+                             booking.intended_use, booking.intended_use2, counterparty,
+                             booking.customer_reference, booking.mandate_reference,
+                             booking.amount, booking.currency])
+                seq += 1
+            if (len(rows) == 0):
+                break
+            cur.executemany("""INSERT INTO temp.new_statements
+                                           (seq, date_of_bookkeeping, date_of_value, intended_use,
+                                            intended_use2, counterparty, customer_reference, mandate_reference,
+                                            amount, currency)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+        if (account_data['unchanged'] is True):
+            # same bookings and balance as in the last run, no need to compare them
+            cur.execute("DELETE FROM temp.new_statements")
+            self.connection.commit()
+            return []
+        if (seq == 0):
+            return []
+
+        match = """s.bank_account = ?
+                   AND s.date_of_bookkeeping = n.date_of_bookkeeping
+                   AND s.date_of_value = n.date_of_value
+                   AND s.intended_use = n.intended_use
+                   AND s.intended_use2 = n.intended_use2
+                   AND s.counterparty = n.counterparty
+                   AND s.customer_reference = n.customer_reference
+                   AND s.mandate_reference = n.mandate_reference
+                   AND s.amount = n.amount
+                   AND s.currency = n.currency"""
+
+        query = """SELECT n.seq
+                     FROM temp.new_statements n
+                     JOIN account_statements s
+                       ON """ + match + """
+                 GROUP BY n.seq
+                   HAVING COUNT(*) > 1"""
+        cur.execute(query, [account_id])
+        if (cur.fetchone() is not None):
+            # this is theoretically possible, but in practive more likely an error
+            self.connection.rollback()
+            logging.error("Found account booking statement multiple times in the database")
+            sys.exit(1)
+
+        cur.execute("SELECT COALESCE(MAX(id), 0) FROM account_statements")
+        last_id = cur.fetchone()[0]
+
+        # identical bookings in the same batch are only written once
+        query = """INSERT INTO account_statements
+                               (date_of_bookkeeping, date_of_value, bank_account, intended_use,
+                                intended_use2, counterparty, customer_reference, mandate_reference,
+                                amount, currency)
+                        SELECT n.date_of_bookkeeping, n.date_of_value, ?, n.intended_use,
+                               n.intended_use2, n.counterparty, n.customer_reference, n.mandate_reference,
+                               n.amount, n.currency
+                          FROM temp.new_statements n
+                         WHERE NOT EXISTS (SELECT 1
+                                             FROM account_statements s
+                                            WHERE """ + match + """)
+                      GROUP BY n.date_of_bookkeeping, n.date_of_value, n.intended_use,
+                               n.intended_use2, n.counterparty, n.customer_reference, n.mandate_reference,
+                               n.amount, n.currency
+                      ORDER BY MIN(n.seq)"""
+        cur.execute(query, [account_id, account_id])
+
+        # the new statements, their categories and the change log are committed together
+        query = """SELECT s.*, c.iban, c.bic, c.creditor_id
+                     FROM account_statements s
+                     JOIN counterparties c
+                       ON c.id = s.counterparty
+                    WHERE s.bank_account = ?
+                      AND s.id > ?
+                 ORDER BY s.id ASC"""
+        cur.execute(query, [account_id, last_id])
+        result = cur.fetchall()
+        categories = []
+        changes = []
+        # new debits per month and category, for the budget counters
+        spending = collections.defaultdict(float)
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        for transaction in result:
+            if (debug is True):
+                logging.debug("Write booking entry: %s/%s: %s %s (%s)", transaction['date_of_bookkeeping'], transaction['date_of_value'],
+                              transaction['amount'], transaction['currency'], transaction['intended_use'])
+            category = self.config.categorizer.categorize(transaction)
+            if (category is not None):
+                categories.append([category, transaction['id']])
+            payload = dict(transaction)
+            payload['category'] = category
+            del payload['counterparty']
+            del payload['running_balance']
+            del payload['anomaly']
+            changes.append([account_id, json.dumps(payload)])
+            if (float(transaction['amount']) < 0):
+                month = transaction['date_of_bookkeeping'][6:10] + '-' + transaction['date_of_bookkeeping'][3:5]
+                spending[(month, '')] -= float(transaction['amount'])
+                if (category is not None):
+                    spending[(month, category)] -= float(transaction['amount'])
+        if (len(categories) > 0):
+            cur.executemany("UPDATE account_statements SET category = ? WHERE id = ?", categories)
+        cur.executemany("INSERT INTO change_log (bank_account, type, payload) VALUES (?, 'statement', ?)", changes)
+        if (len(spending) > 0):
+            self.add_monthly_spending(cur, account_id, spending, budgets or [], result[0]['currency'])
+        self.connection.commit()
+
+        if (len(result) > 0 and running_balance is True):
+            # the balance of the account is the anchor for the newest statement: a statement which
+            # is booked late (before the newest statement) changes the running balance of the later ones
+            self.repair_running_balance(account_id, account_data['bank_balance'])
+
+        return [transaction['id'] for transaction in result]
+
+
+
+    # add_monthly_spending()
+    #
+    # add new debits to the monthly counters, and add an alert for every budget
+    # of the current month which is crossed by the new debits
+    # runs in the transaction of the caller
+    #
+    # parameter:
+    #  - self
+    #  - cursor
+    #  - account ID
+    #  - dictionary (month, category) -> sum of the new debits
+    #  - list with budgets
+    #  - currency
+    # return:
+    #  none
+    def add_monthly_spending(self, cur, account_id, spending, budgets, currency):
+        current_month = datetime.date.today().strftime('%Y-%m')
+        limits = [budget for budget in budgets if ((current_month, budget['category']) in spending)]
+        if (len(limits) > 0):
+            cur.execute("SELECT category, amount FROM monthly_spending WHERE bank_account = ? AND month = ?",
+                        [account_id, current_month])
+            before = dict([(row['category'], float(row['amount'])) for row in cur.fetchall()])
+            for budget in limits:
+                old = before.get(budget['category'], 0.0)
+                new = old + spending[(current_month, budget['category'])]
+                if (old <= budget['limit'] < new):
+                    query = """INSERT INTO threshold_alerts (bank_account, type, month, category, value, threshold, currency)
+                                    VALUES (?, 'budget', ?, ?, ?, ?, ?)"""
+                    cur.execute(query, [account_id, current_month, budget['category'], round(new, 2), budget['limit'], currency])
+
+        query = """INSERT INTO monthly_spending (bank_account, month, category, amount)
+                        VALUES (?, ?, ?, ?)
+                   ON CONFLICT (bank_account, month, category) DO UPDATE
+                           SET amount = amount + excluded.amount"""
+        cur.executemany(query, [[account_id, key[0], key[1], round(value, 2)] for key, value in spending.items()])
+
+
+
+    # rebuild_monthly_spending()
+    #
+    # calculate the monthly counters for the budgets from all statements of an account
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    # return:
+    #  none
+    def rebuild_monthly_spending(self, account_id):
+        cur = self.connection.cursor()
+        cur.execute("DELETE FROM monthly_spending WHERE bank_account = ?", [account_id])
+        month = "substr(date_of_bookkeeping, 7, 4) || '-' || substr(date_of_bookkeeping, 4, 2)"
+        query = """INSERT INTO monthly_spending (bank_account, month, category, amount)
+                          SELECT bank_account, """ + month + """, '', ROUND(-SUM(amount), 2)
+                            FROM account_statements
+                           WHERE bank_account = ?
+                             AND amount < 0
+                        GROUP BY 2
+                       UNION ALL
+                          SELECT bank_account, """ + month + """, category, ROUND(-SUM(amount), 2)
+                            FROM account_statements
+                           WHERE bank_account = ?
+                             AND amount < 0
+                             AND category IS NOT NULL
+                        GROUP BY 2, 3"""
+        cur.execute(query, [account_id, account_id])
+        self.connection.commit()
+
+
+
+    # unreported_threshold_alerts()
+    #
+    # return the threshold alerts which are not yet reported, and mark them as reported
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    # return:
+    #  - list with alerts
+    def unreported_threshold_alerts(self, account_id):
+        query = """SELECT *
+                     FROM threshold_alerts
+                    WHERE bank_account = ?
+                      AND reported = 0
+                 ORDER BY id ASC"""
+        result = self.execute_query(query, [account_id])
+        if (len(result) > 0):
+            self.execute_one("UPDATE threshold_alerts SET reported = 1 WHERE bank_account = ? AND id <= ?",
+                             [account_id, result[-1]['id']])
+
+        return result
+
+
+
+    # update_running_balance()
+    #
+    # calculate the running balance backwards, for all statements up to a position
+    # in booking order, starting from the next statement after this position
+    # if there is no later statement, the balance of the account is the anchor
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    #  - position: booking day (YYYYMMDD) and statement ID
+    #  - current balance of the account (optional)
+    # return:
+    #  - number of changed statements
+    def update_running_balance(self, account_id, position, bank_balance = None):
+        query = """SELECT amount, running_balance
+                     FROM account_statements
+                    WHERE bank_account = ?
+                      AND """ + self.booking_day + """ >= ?
+                      AND (""" + self.booking_day + """ > ? OR id > ?)
+                 ORDER BY """ + self.booking_day + """ ASC, id ASC
+                    LIMIT 1"""
+        following = self.execute_one(query, [account_id, position[0], position[0], position[1]])
+        if (following is None):
+            if (bank_balance is None):
+                logging.debug("No anchor for the running balance, account: " + str(account_id))
+                return 0
+            balance = round(float(bank_balance), 2)
+        elif (following['running_balance'] is None):
+            return 0
+        else:
+            balance = round(float(following['running_balance']) - float(following['amount']), 2)
+
+        query = """SELECT id, amount, running_balance
+                     FROM account_statements
+                    WHERE bank_account = ?
+                      AND """ + self.booking_day + """ <= ?
+                      AND (""" + self.booking_day + """ < ? OR id <= ?)
+                 ORDER BY """ + self.booking_day + """ DESC, id DESC"""
+        updates = []
+        for transaction in self.execute_query(query, [account_id, position[0], position[0], position[1]]):
+            if (transaction['running_balance'] is None or round(float(transaction['running_balance']), 2) != balance):
+                updates.append([balance, transaction['id']])
+            balance = round(balance - float(transaction['amount']), 2)
+        if (len(updates) > 0):
+            self.connection.executemany("UPDATE account_statements SET running_balance = ? WHERE id = ?", updates)
+            self.connection.commit()
+
+        return len(updates)
+
+
+
+    # repair_running_balance()
+    #
+    # recalculate the running balance of all statements, anchored to the last known balance
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    #  - current balance of the account (optional, default: the last known balance)
+    # return:
+    #  - number of statements which had a wrong (drifted) or missing running balance
+    def repair_running_balance(self, account_id, bank_balance = None):
+        if (bank_balance is None):
+            balance = self.last_account_balance(account_id)
+            if (balance is None):
+                return 0
+            bank_balance = balance['account_balance']
+        query = """SELECT """ + self.booking_day + """ AS day, id
+                     FROM account_statements
+                    WHERE bank_account = ?
+                 ORDER BY """ + self.booking_day + """ DESC, id DESC
+                    LIMIT 1"""
+        newest = self.execute_one(query, [account_id])
+        if (newest is None):
+            return 0
+
+        return self.update_running_balance(account_id, (newest['day'], newest['id']), bank_balance)
+
+
+
+    # balance_at()
+    #
+    # return the balance at the end of a day, from the running balance
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    #  - date (datetime.date)
+    # return:
+    #  - row with 'date_of_bookkeeping', 'running_balance' and 'currency', or None
+    def balance_at(self, account_id, date):
+        query = """SELECT date_of_bookkeeping, running_balance, currency
+                     FROM account_statements
+                    WHERE bank_account = ?
+                      AND """ + self.booking_day + """ <= ?
+                 ORDER BY """ + self.booking_day + """ DESC, id DESC
+                    LIMIT 1"""
+
+        return self.execute_one(query, [account_id, date.strftime('%Y%m%d')])
+
+
+
+    # statement_history()
+    #
+    # return day, amount, counterparty and running balance of all statements, in booking order
+    # the columns are returned as lists, read in one query
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    # return:
+    #  - list with days (YYYYMMDD), amounts, counterparty IDs, running balances, and the currency
+    def statement_history(self, account_id):
+        query = """SELECT CAST(""" + self.booking_day + """ AS INTEGER), amount, counterparty, running_balance, currency
+                     FROM account_statements
+                    WHERE bank_account = ?
+                 ORDER BY """ + self.booking_day + """ ASC, id ASC"""
+        cur = self.connection.cursor()
+        # plain tuples, no sqlite3.Row per statement
+        cur.row_factory = None
+        cur.execute(query, [account_id])
+        rows = cur.fetchall()
+        if (len(rows) == 0):
+            return [], [], [], [], None
+
+        days, amounts, counterparties, balances, currencies = zip(*rows)
+
+        return days, amounts, counterparties, balances, currencies[-1]
+
+
+
+    # counterparty_details()
+    #
+    # return IBAN, BIC and creditor ID for a list of counterparties
+    #
+    # parameter:
+    #  - self
+    #  - list with counterparty IDs
+    # return:
+    #  - dictionary with counterparty ID -> row
+    def counterparty_details(self, counterparty_ids):
+        if (len(counterparty_ids) == 0):
+            return {}
+        query = """SELECT id, iban, bic, creditor_id
+                     FROM counterparties
+                    WHERE id IN (""" + ', '.join(['?'] * len(counterparty_ids)) + """)"""
+
+        return dict([(row['id'], row) for row in self.execute_query(query, list(counterparty_ids))])
+
+
+
+    # update_recurring_payments()
+    #
+    # detect recurring payments in the groups (mandate, or creditor) of the new statements
+    # only the last statements of every affected group are read
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    #  - list with IDs of the new statements (optional, default: all statements)
+    # return:
+    #  - list with alerts for charges with an unusual amount
+    def update_recurring_payments(self, account_id, statement_ids = None):
+        if (statement_ids is not None and len(statement_ids) == 0):
+            return []
+        query = """SELECT DISTINCT s.counterparty, s.mandate_reference
+                     FROM account_statements s
+                     JOIN counterparties c
+                       ON c.id = s.counterparty
+                    WHERE s.bank_account = ?
+                      AND s.amount < 0
+                      AND (s.mandate_reference != '' OR c.creditor_id != '')"""
+        param = [account_id]
+        if (statement_ids is not None):
+            # new statements always have consecutive IDs
+            first_id = min(statement_ids)
+            last_id = max(statement_ids)
+            query += " AND s.id BETWEEN ? AND ?"
+            param += [first_id, last_id]
+        groups = self.execute_query(query, param)
+
+        alerts = []
+        for group in groups:
+            query = """SELECT *
+                         FROM recurring_payments
+                        WHERE bank_account = ?
+                          AND counterparty = ?
+                          AND mandate_reference = ?"""
+            previous = self.execute_one(query, [account_id, group['counterparty'], group['mandate_reference']])
+
+            # the last 12 intervals are enough to find the period and the expected amount
+            query = """SELECT id, date_of_bookkeeping, amount, currency
+                         FROM account_statements
+                        WHERE bank_account = ?
+                          AND counterparty = ?
                           AND mandate_reference = ?
-                          AND creditor_id = ?
-                          AND amount = ?
-                          AND currency= ?"""
-            result = self.execute_query(query, [account_id, transaction['date_of_bookkeeping'], transaction['date_of_value'],
-                                                transaction['intended_use'], transaction['intended_use2'], transaction['iban'],
-                                                transaction['bic'], transaction['customer_reference'], transaction['mandate_reference'],
-                                                transaction['creditor_id'], transaction['amount'], transaction['currency']])
-            if (len(result) > 1):
-                # this is theoretically possible, but in practive more likely an error
-                logging.error("Found account booking statement multiple times in the database")
-                sys.exit(1)
+                          AND amount < 0
+                     ORDER BY """ + self.booking_day + """ DESC, id DESC
+                        LIMIT 13"""
+            history = self.execute_query(query, [account_id, group['counterparty'], group['mandate_reference']])
+            if (len(history) < 3):
+                continue
+            days = [datetime.datetime.strptime(row['date_of_bookkeeping'], '%d.%m.%Y').date() for row in history]
+            intervals = [(days[i] - days[i + 1]).days for i in range(len(days) - 1)]
+            period = int(statistics.median(intervals))
+            if (period < 5):
+                # several charges per week are not a regular payment
+                continue
+            tolerance = max(3, period // 5)
+            if (len([interval for interval in intervals if abs(interval - period) <= tolerance]) * 3 < len(intervals) * 2):
+                continue
+            expected = round(statistics.median([float(row['amount']) for row in history]), 2)
+
+            # new charges are compared with the amount which was expected before
+            if (previous is not None and statement_ids is not None):
+                for row in history:
+                    if (row['id'] < first_id or row['id'] > last_id):
+                        continue
+                    difference = abs(float(row['amount']) - float(previous['expected_amount']))
+                    if (difference > max(1.0, abs(float(previous['expected_amount'])) * 0.1)):
+                        alerts.append({'type': 'unusual', 'counterparty': group['counterparty'],
+                                       'mandate_reference': group['mandate_reference'],
+                                       'date': row['date_of_bookkeeping'], 'amount': row['amount'],
+                                       'expected_amount': previous['expected_amount'], 'currency': row['currency']})
+
+            query = """INSERT OR REPLACE INTO recurring_payments
+                                   (bank_account, counterparty, mandate_reference, last_statement, last_date,
+                                    period_days, expected_amount, currency, next_due, status)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'ok')"""
+            self.execute_one(query, [account_id, group['counterparty'], group['mandate_reference'], history[0]['id'],
+                                     days[0].isoformat(), period, expected, history[0]['currency'],
+                                     (days[0] + datetime.timedelta(days = period)).isoformat()])
+
+        if (len(alerts) > 0):
+            details = self.counterparty_details([alert['counterparty'] for alert in alerts])
+            for alert in alerts:
+                alert['iban'] = details[alert['counterparty']]['iban']
+                alert['creditor_id'] = details[alert['counterparty']]['creditor_id']
+
+        return alerts
+
+
+
+    # check_recurring_payments()
+    #
+    # find recurring payments which are overdue, every payment is only reported once
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    # return:
+    #  - list with alerts for missing charges
+    def check_recurring_payments(self, account_id):
+        query = """SELECT r.*, c.iban, c.creditor_id
+                     FROM recurring_payments r
+                     JOIN counterparties c
+                       ON c.id = r.counterparty
+                    WHERE r.bank_account = ?
+                      AND r.status = 'ok'
+                      AND date(r.next_due, '+' || MAX(3, r.period_days / 5) || ' days') < date('now')"""
+        alerts = []
+        for payment in self.execute_query(query, [account_id]):
+            alerts.append({'type': 'missing', 'counterparty': payment['counterparty'],
+                           'mandate_reference': payment['mandate_reference'], 'iban': payment['iban'],
+                           'creditor_id': payment['creditor_id'],
+                           'date': datetime.datetime.strptime(payment['next_due'], '%Y-%m-%d').strftime('%d.%m.%Y'),
+                           'amount': None, 'expected_amount': payment['expected_amount'], 'currency': payment['currency']})
+            self.execute_one("UPDATE recurring_payments SET status = 'missing' WHERE id = ?", [payment['id']])
+
+        return alerts
+
+
+
+    # rebuild_amount_statistics()
+    #
+    # calculate the baseline for the anomaly detection from all debits of an account
+    # debits without any counterparty information (IBAN, BIC, creditor ID) only count for the category
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    # return:
+    #  none
+    def rebuild_amount_statistics(self, account_id):
+        cur = self.connection.cursor()
+        cur.execute("DELETE FROM amount_statistics WHERE bank_account = ?", [account_id])
+        query = """INSERT INTO amount_statistics (bank_account, type, key, samples, mean, m2)
+                          SELECT s.bank_account, 'counterparty', CAST(s.counterparty AS TEXT), COUNT(*), AVG(s.amount),
+                                 MAX(SUM(s.amount * s.amount) - COUNT(*) * AVG(s.amount) * AVG(s.amount), 0)
+                            FROM account_statements s
+                            JOIN counterparties c
+                              ON c.id = s.counterparty
+                           WHERE s.bank_account = ?
+                             AND s.amount < 0
+                             AND (c.iban != '' OR c.bic != '' OR c.creditor_id != '')
+                        GROUP BY s.counterparty"""
+        cur.execute(query, [account_id])
+        query = """INSERT INTO amount_statistics (bank_account, type, key, samples, mean, m2)
+                          SELECT bank_account, 'category', category, COUNT(*), AVG(amount),
+                                 MAX(SUM(amount * amount) - COUNT(*) * AVG(amount) * AVG(amount), 0)
+                            FROM account_statements
+                           WHERE bank_account = ?
+                             AND amount < 0
+                             AND category IS NOT NULL
+                        GROUP BY category"""
+        cur.execute(query, [account_id])
+        self.connection.commit()
+
+
+
+    # score_statements()
+    #
+    # flag new debits with an unusual amount (compared to the counterparty, or to the category
+    # if the counterparty has too few debits), duplicate charges, and high debits to a new payee
+    # the new statements are scored against the baseline before they are added to it
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    #  - list with IDs of the new statements
+    #  - settings from the 'anomalies' section
+    #  - True: flag the statements, False: only add them to the baseline (old statements)
+    # return:
+    #  - number of flagged statements
+    def score_statements(self, account_id, statement_ids, settings, score = True):
+        if (len(statement_ids) == 0):
+            return 0
+        # new statements always have consecutive IDs
+        first_id = min(statement_ids)
+        last_id = max(statement_ids)
+        cur = self.connection.cursor()
+        query = """SELECT s.id, s.counterparty, s.category, s.amount, s.date_of_bookkeeping,
+                            (c.iban != '' OR c.bic != '' OR c.creditor_id != '') AS known
+                       FROM account_statements s
+                       JOIN counterparties c
+                         ON c.id = s.counterparty
+                      WHERE s.bank_account = ?
+                        AND s.id BETWEEN ? AND ?
+                        AND s.amount < 0"""
+        cur.execute(query, [account_id, first_id, last_id])
+        debits = cur.fetchall()
+        if (len(debits) == 0):
+            return 0
+
+        flags = []
+        baseline = {}
+        if (score is True):
+            cur.execute("SELECT type, key, samples, mean, m2 FROM amount_statistics WHERE bank_account = ?", [account_id])
+            for row in cur:
+                baseline[(row['type'], row['key'])] = row
+        if (len(baseline) == 0):
+            # first statements of the account, everything would be new
+            score = False
+
+        if (score is True):
+            # same payee and same amount as another debit, booked within 3 days
+            # (identical bookings are already removed when they are saved)
+            # the new statements are read by ID (CROSS JOIN keeps this order), the other
+            # debits by payee and by the range of booking days, both use an index
+            days = [datetime.datetime.strptime(debit['date_of_bookkeeping'], '%d.%m.%Y').date() for debit in debits]
+            first_day = (min(days) - datetime.timedelta(days = 3)).strftime('%Y%m%d')
+            last_day = (max(days) + datetime.timedelta(days = 3)).strftime('%Y%m%d')
+            query = """SELECT DISTINCT n.id
+                           FROM account_statements n
+                     CROSS JOIN account_statements o
+                             ON o.bank_account = n.bank_account
+                            AND o.counterparty = n.counterparty
+                            AND o.mandate_reference = n.mandate_reference
+                            AND o.amount = n.amount
+                            AND o.id != n.id
+                          WHERE n.id BETWEEN ? AND ?
+                            AND +n.bank_account = ?
+                            AND n.amount < 0
+                            AND """ + self.booking_day.replace('date_of_bookkeeping', 'o.date_of_bookkeeping') + """ BETWEEN ? AND ?
+                            AND ABS(julianday(substr(o.date_of_bookkeeping, 7, 4) || '-' || substr(o.date_of_bookkeeping, 4, 2) || '-' || substr(o.date_of_bookkeeping, 1, 2)) -
+                                    julianday(substr(n.date_of_bookkeeping, 7, 4) || '-' || substr(n.date_of_bookkeeping, 4, 2) || '-' || substr(n.date_of_bookkeeping, 1, 2))) <= 3"""
+            cur.execute(query, [first_id, last_id, account_id, first_day, last_day])
+            duplicates = set([row[0] for row in cur])
+
+            for debit in debits:
+                reasons = []
+                amount = float(debit['amount'])
+                counterparty = baseline.get(('counterparty', str(debit['counterparty']))) if (debit['known'] == 1) else None
+                reference = counterparty
+                if ((reference is None or reference['samples'] < settings['min_samples']) and debit['category'] is not None):
+                    reference = baseline.get(('category', debit['category']))
+                if (reference is not None and reference['samples'] >= settings['min_samples']):
+                    deviation = math.sqrt(reference['m2'] / (reference['samples'] - 1))
+                    if (amount < reference['mean'] - max(settings['threshold'] * deviation, settings['min_difference'])):
+                        reasons.append('amount')
+                if (debit['id'] in duplicates):
+                    reasons.append('duplicate')
+                if (debit['known'] == 1 and counterparty is None and -amount >= settings['new_payee_amount']):
+                    reasons.append('new_payee')
+                if (len(reasons) > 0):
+                    flags.append([','.join(reasons), debit['id']])
+            cur.executemany("UPDATE account_statements SET anomaly = ? WHERE id = ?", flags)
+
+        # add the new debits to the baseline: statistics of the batch, merged with the stored values
+        batches = collections.defaultdict(list)
+        for debit in debits:
+            if (debit['known'] == 1):
+                batches[('counterparty', str(debit['counterparty']))].append(float(debit['amount']))
+            if (debit['category'] is not None):
+                batches[('category', debit['category'])].append(float(debit['amount']))
+        updates = []
+        for key, amounts in batches.items():
+            mean = sum(amounts) / len(amounts)
+            m2 = sum([(amount - mean) * (amount - mean) for amount in amounts])
+            updates.append([account_id, key[0], key[1], len(amounts), mean, m2])
+        query = """INSERT INTO amount_statistics (bank_account, type, key, samples, mean, m2)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (bank_account, type, key) DO UPDATE
+                           SET samples = samples + excluded.samples,
+                               mean = (samples * mean + excluded.samples * excluded.mean) / (samples + excluded.samples),
+                               m2 = m2 + excluded.m2 + (excluded.mean - mean) * (excluded.mean - mean) *
+                                    samples * excluded.samples / (samples + excluded.samples)"""
+        cur.executemany(query, updates)
+        self.connection.commit()
+
+        return len(flags)
+
+
+
+    # recurring_payments()
+    #
+    # return all recurring payments of an account
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    # return:
+    #  - list with recurring payments
+    def recurring_payments(self, account_id):
+        query = """SELECT c.iban, c.creditor_id, r.mandate_reference, r.period_days, r.expected_amount,
+                          r.currency, r.last_date, r.next_due, r.status
+                     FROM recurring_payments r
+                     JOIN counterparties c
+                       ON c.id = r.counterparty
+                    WHERE r.bank_account = ?
+                 ORDER BY r.next_due"""
+
+        return self.execute_query(query, [account_id])
+
+
+
+    # counterparty_id()
+    #
+    # retrieve the ID of a counterparty, create if necessary
+    # all known counterparties are kept in memory
+    #
+    # parameter:
+    #  - self
+    #  - IBAN
+    #  - BIC
+    #  - creditor ID
+    # return:
+    #  - counterparty ID
+    def counterparty_id(self, iban, bic, creditor_id):
+        if (self.counterparties is None):
+            self.counterparties = {}
+            for row in self.execute_query("SELECT id, iban, bic, creditor_id FROM counterparties", []):
+                self.counterparties[(row['iban'], row['bic'], row['creditor_id'])] = row['id']
+
+        key = (iban, bic, creditor_id)
+        if (key not in self.counterparties):
+            query = """INSERT INTO counterparties
+                                   (iban, bic, creditor_id)
+                            VALUES (?, ?, ?)"""
+            cur = self.connection.cursor()
+            cur.execute(query, [iban, bic, creditor_id])
+            # committed right away, the cache must never hold an ID which is rolled back later
+            self.connection.commit()
+            self.counterparties[key] = cur.lastrowid
+
+        return self.counterparties[key]
+
+
+
+    # recategorize()
+    #
+    # apply the categorization rules to all existing statements
+    # the table is read in batches, only changed categories are written
+    #
+    # parameter:
+    #  - self
+    #  - categorizer object
+    #  - number of statements per batch (optional)
+    # return:
+    #  - number of statements, number of changed statements
+    def recategorize(self, categorizer, batch_size = 5000):
+        query = """SELECT s.id, s.intended_use, s.intended_use2, c.iban, c.creditor_id, s.mandate_reference, s.category
+                     FROM account_statements s
+                     JOIN counterparties c
+                       ON c.id = s.counterparty
+                    WHERE s.id > ?
+                 ORDER BY s.id ASC
+                    LIMIT ?"""
+        last_id = 0
+        total = 0
+        changed = 0
+        while True:
+            result = self.execute_query(query, [last_id, batch_size])
             if (len(result) == 0):
-                query = """INSERT INTO account_statements
-                                       (date_of_bookkeeping, date_of_value, bank_account, intended_use,
-                                        intended_use2, iban, bic, customer_reference, mandate_reference,
-                                        creditor_id, amount, currency)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
-                self.execute_one(query, [transaction['date_of_bookkeeping'], transaction['date_of_value'], account_id,
-                                         transaction['intended_use'], transaction['intended_use2'], transaction['iban'],
-                                         transaction['bic'], transaction['customer_reference'], transaction['mandate_reference'],
-                                         transaction['creditor_id'], transaction['amount'], transaction['currency']])
-                logging.debug("Write booking entry: " + str(transaction['date_of_bookkeeping']) + '/' +
-                              str(transaction['date_of_value']) + ': ' + str(transaction['amount']) +
-                              ' ' + str(transaction['currency']) + ' (' + str(transaction['intended_use']) + ')')
+                break
+            updates = []
+            for transaction in result:
+                category = categorizer.categorize(transaction)
+                if (category != transaction['category']):
+                    updates.append([category, transaction['id']])
+            if (len(updates) > 0):
+                self.connection.executemany("UPDATE account_statements SET category = ? WHERE id = ?", updates)
+                self.connection.commit()
+            total += len(result)
+            changed += len(updates)
+            last_id = result[-1]['id']
+            logging.debug("Categorized statements up to id: " + str(last_id))
+
+        return total, changed
+
+
+
+    # change_log_entries()
+    #
+    # return the change log entries starting at a sequence number
+    # the entries are read from an open cursor, not loaded into memory
+    #
+    # parameter:
+    #  - self
+    #  - first sequence number
+    #  - schema name (every database file has its own sequence)
+    # return:
+    #  - cursor with 'seq', 'added_ts', 'account', 'type' and 'payload'
+    def change_log_entries(self, first_seq, schema = 'main'):
+        query = """SELECT l.seq, l.added_ts, a.name AS account, l.type, l.payload
+                     FROM """ + schema + """.change_log l
+                     JOIN """ + schema + """.bank_accounts a
+                       ON a.id = l.bank_account
+                    WHERE l.seq >= ?
+                 ORDER BY l.seq ASC"""
+        cur = self.connection.cursor()
+        cur.execute(query, [first_seq])
+
+        return cur
+
+
+
+    # prune_change_log()
+    #
+    # remove old change log entries
+    #
+    # parameter:
+    #  - self
+    #  - keep entries for this many days (0: keep all)
+    # return:
+    #  - number of deleted entries
+    def prune_change_log(self, keep_days):
+        if (keep_days == 0):
+            return 0
+        cur = self.connection.cursor()
+        cur.execute("DELETE FROM change_log WHERE added_ts < datetime('now', ?)", ['-%d days' % int(keep_days)])
+        self.connection.commit()
+
+        return cur.rowcount
+
+
+
+    # save_access_log()
+    #
+    # store the telemetry of one run
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    #  - telemetry object
+    # return:
+    #  none
+    def save_access_log(self, account_id, telemetry):
+        # an error can leave an open transaction behind
+        self.connection.rollback()
+        query = """INSERT INTO bank_access_logs
+                               (bank_account, start_ts, end_ts, duration, http_time, http_bytes, http_steps,
+                                bookings_parsed, bookings_inserted, bookings_skipped, db_time, smtp_time, outcome)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+        self.execute_one(query, [account_id, telemetry.start_ts.strftime('%Y-%m-%d %H:%M:%S'),
+                                 telemetry.end_ts.strftime('%Y-%m-%d %H:%M:%S'), telemetry.duration,
+                                 sum([step['duration'] for step in telemetry.http_steps]),
+                                 sum([step['bytes'] for step in telemetry.http_steps]),
+                                 json.dumps(telemetry.http_steps),
+                                 telemetry.bookings_parsed, telemetry.bookings_inserted,
+                                 telemetry.bookings_parsed - telemetry.bookings_inserted,
+                                 telemetry.db_time, telemetry.smtp_time, str(telemetry.outcome)])
+
+
+
+    # access_logs()
+    #
+    # return the logged runs of the last days
+    #
+    # parameter:
+    #  - self
+    #  - number of days
+    # return:
+    #  - list with runs, including account 'name' and 'week' (YYYY-WW)
+    def access_logs(self, days):
+        query = """SELECT l.*, a.name, strftime('%Y-%W', l.start_ts) AS week
+                     FROM {schema}.bank_access_logs l
+                     JOIN {schema}.bank_accounts a
+                       ON a.id = l.bank_account
+                    WHERE l.start_ts >= datetime('now', ?)"""
+
+        return self.union_query(query, ['-%d days' % int(days)], "name, start_ts")
+
+
+
+    # turnovers_fingerprint()
+    #
+    # return the fingerprint of the last retrieved turnovers
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    # return:
+    #  - fingerprint, or None
+    def turnovers_fingerprint(self, account_id):
+        query = """SELECT fingerprint
+                     FROM turnovers_fingerprints
+                    WHERE bank_account = ?"""
+        result = self.execute_one(query, [account_id])
+        if (result is None):
+            return None
+
+        return result['fingerprint']
+
+
+
+    # save_turnovers_fingerprint()
+    #
+    # store the fingerprint of the retrieved turnovers
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    #  - fingerprint
+    # return:
+    #  none
+    def save_turnovers_fingerprint(self, account_id, fingerprint):
+        query = """INSERT OR REPLACE INTO turnovers_fingerprints
+                               (bank_account, fingerprint)
+                        VALUES (?, ?)"""
+        self.execute_one(query, [account_id, fingerprint])
+
+
+
+    # last_statement_id()
+    #
+    # return the ID of the newest statement for an account
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    # return:
+    #  - statement ID, or None
+    def last_statement_id(self, account_id):
+        query = """SELECT MAX(id) AS id
+                     FROM account_statements
+                    WHERE bank_account = ?"""
+
+        return self.execute_one(query, [account_id])['id']
+
+
+
+    # minutes_since_last_fetch()
+    #
+    # return the age of the last balance retrieved from the bank
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    # return:
+    #  - age in minutes, or None if the account was never fetched
+    def minutes_since_last_fetch(self, account_id):
+        query = """SELECT (julianday('now') - julianday(MAX(added_ts))) * 1440 AS age
+                     FROM account_balance
+                    WHERE bank_account = ?"""
+
+        return self.execute_one(query, [account_id])['age']
+
+
+
+    # start_run()
+    #
+    # start a new run, all accounts of the run are pending
+    # the state of other accounts (other config files, same database) is kept for their --resume
+    #
+    # parameter:
+    #  - self
+    #  - list with account names (from config file)
+    # return:
+    #  none
+    def start_run(self, accounts):
+        query = """INSERT INTO run_state (account, status)
+                        VALUES (?, 'pending')
+                   ON CONFLICT (account) DO UPDATE
+                           SET status = excluded.status,
+                               phase = NULL,
+                               updated_ts = CURRENT_TIMESTAMP"""
+        cur = self.connection.cursor()
+        cur.executemany(query, [[account] for account in accounts])
+        self.connection.commit()
+
+
+
+    # save_run_state()
+    #
+    # record the result of an account in the current run
+    #
+    # parameter:
+    #  - self
+    #  - account name (from config file)
+    #  - status ('ok' or 'failed')
+    #  - phase in which the account failed, or None
+    # return:
+    #  none
+    def save_run_state(self, account, status, phase = None):
+        query = """INSERT INTO run_state (account, status, phase)
+                        VALUES (?, ?, ?)
+                   ON CONFLICT (account) DO UPDATE
+                           SET status = excluded.status,
+                               phase = excluded.phase,
+                               updated_ts = CURRENT_TIMESTAMP"""
+        self.execute_one(query, [account, status, phase])
+
+
+
+    # finished_accounts()
+    #
+    # return the accounts which were processed successfully in the last run
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  - set with account names
+    def finished_accounts(self):
+        result = self.execute_query("SELECT account FROM run_state WHERE status = 'ok'", [])
+
+        return set([row['account'] for row in result])
+
+
+
+    # save_fetch_statistics()
+    #
+    # count a fetch in the statistics for its weekday and hour
+    # the counts are halved when they get large, so that old behaviour fades out
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    #  - time of the fetch (datetime, local time)
+    #  - True if the fetch found new bookings
+    # return:
+    #  none
+    def save_fetch_statistics(self, account_id, fetch_time, productive):
+        query = """INSERT INTO fetch_statistics
+                               (bank_account, weekday, hour, fetches, productive)
+                        VALUES (?, ?, ?, 1, ?)
+                   ON CONFLICT (bank_account, weekday, hour) DO UPDATE
+                           SET fetches = CASE WHEN fetches >= 64 THEN fetches / 2 ELSE fetches END + 1,
+                               productive = CASE WHEN fetches >= 64 THEN productive / 2 ELSE productive END + excluded.productive"""
+        self.execute_one(query, [account_id, fetch_time.weekday(), fetch_time.hour, 1 if (productive is True) else 0])
+
+
+
+    # fetch_probability()
+    #
+    # estimate how likely a fetch at this time finds new bookings
+    # uses the same weekday and hour if there are enough samples,
+    # otherwise the same weekday, otherwise all fetches of the account
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    #  - time of the fetch (datetime, local time)
+    #  - minimum number of fetches for an estimate
+    # return:
+    #  - probability (0 - 1), or None if there are not enough samples
+    def fetch_probability(self, account_id, fetch_time, min_samples):
+        query = """SELECT SUM(CASE WHEN weekday = ? AND hour = ? THEN fetches ELSE 0 END) AS slot_fetches,
+                          SUM(CASE WHEN weekday = ? AND hour = ? THEN productive ELSE 0 END) AS slot_productive,
+                          SUM(CASE WHEN weekday = ? THEN fetches ELSE 0 END) AS day_fetches,
+                          SUM(CASE WHEN weekday = ? THEN productive ELSE 0 END) AS day_productive,
+                          SUM(fetches) AS all_fetches,
+                          SUM(productive) AS all_productive
+                     FROM fetch_statistics
+                    WHERE bank_account = ?"""
+        weekday = fetch_time.weekday()
+        result = self.execute_one(query, [weekday, fetch_time.hour, weekday, fetch_time.hour, weekday, weekday, account_id])
+        for scope in ['slot', 'day', 'all']:
+            if (result[scope + '_fetches'] is not None and result[scope + '_fetches'] >= min_samples):
+                return result[scope + '_productive'] / result[scope + '_fetches']
+
+        return None
+
+
+
+    # last_seen_statement()
+    #
+    # return the ID of the last statement which was sent in a notification
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    # return:
+    #  - statement ID, or None
+    def last_seen_statement(self, account_id):
+        query = """SELECT last_seen_statement
+                     FROM user_information
+                    WHERE bank_account = ?"""
+        result = self.execute_one(query, [account_id])
+        if (result is None):
+            return None
+
+        return result['last_seen_statement']
+
+
+
+    # set_last_seen_statement()
+    #
+    # move the "unseen" pointer
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    #  - statement ID
+    # return:
+    #  none
+    def set_last_seen_statement(self, account_id, statement_id):
+        if (statement_id is None):
+            return
+        if (self.last_seen_statement(account_id) is None):
+            query = """INSERT INTO user_information
+                                   (last_seen_statement, bank_account)
+                            VALUES (?, ?)"""
+        else:
+            query = """UPDATE user_information
+                          SET last_seen_statement = ?
+                        WHERE bank_account = ?"""
+        self.execute_one(query, [statement_id, account_id])
+
+
+
+    # backfill_checkpoint()
+    #
+    # return the date where an interrupted backfill continues
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    #  - start date of the backfill (datetime.date)
+    # return:
+    #  - next date (datetime.date), or None
+    def backfill_checkpoint(self, account_id, from_date):
+        query = """SELECT next_date
+                     FROM backfill_state
+                    WHERE bank_account = ?
+                      AND from_date = ?"""
+        result = self.execute_one(query, [account_id, from_date.isoformat()])
+        if (result is None):
+            return None
+
+        return datetime.datetime.strptime(result['next_date'], '%Y-%m-%d').date()
+
+
+
+    # save_backfill_checkpoint()
+    #
+    # remember the progress of a backfill
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    #  - start date of the backfill (datetime.date)
+    #  - next date (datetime.date)
+    # return:
+    #  none
+    def save_backfill_checkpoint(self, account_id, from_date, next_date):
+        self.delete_backfill_checkpoint(account_id)
+        query = """INSERT INTO backfill_state
+                               (bank_account, from_date, next_date)
+                        VALUES (?, ?, ?)"""
+        self.execute_one(query, [account_id, from_date.isoformat(), next_date.isoformat()])
+
+
+
+    # delete_backfill_checkpoint()
+    #
+    # remove the backfill progress for an account
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    # return:
+    #  none
+    def delete_backfill_checkpoint(self, account_id):
+        query = """DELETE FROM backfill_state
+                    WHERE bank_account = ?"""
+        self.execute_one(query, [account_id])
+
+
+
+    # unseen_transactions()
+    #
+    # return unseen transactions, move "unseen" pointer
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    # return:
+    #  - list with previously unseen transactions
+    def unseen_transactions(self, account_id):
+        # first get pointer to last transaction
+        query = """SELECT *
+                     FROM user_information
+                    WHERE bank_account = ?"""
+        result = self.execute_one(query, [account_id])
+        if (result is None):
+            # no previous entry, read all statements and then create an entry
+            query = """SELECT s.*, c.iban, c.bic, c.creditor_id
+                         FROM account_statements s
+                         JOIN counterparties c
+                           ON c.id = s.counterparty
+                        WHERE s.bank_account = ?
+                     ORDER BY s.id ASC"""
+            result2 = self.execute_query(query, [account_id])
+            if (len(result2) > 0):
+                query = """INSERT INTO user_information
+                                       (bank_account, last_seen_statement)
+                                VALUES (?, ?)"""
+                self.execute_one(query, [account_id, result2[-1]['id']])
+        else:
+            # existing previous entry, read only new statements and update the entry
+            query = """SELECT s.*, c.iban, c.bic, c.creditor_id
+                         FROM account_statements s
+                         JOIN counterparties c
+                           ON c.id = s.counterparty
+                        WHERE s.bank_account = ?
+                          AND s.id > ?
+                     ORDER BY s.id ASC"""
+            result2 = self.execute_query(query, [account_id, result['last_seen_statement']])
+            if (len(result2) > 0 and result2[-1]['id'] != result['last_seen_statement']):
+                query = """UPDATE user_information
+                              SET last_seen_statement = ?
+                            WHERE id = ?"""
+                self.execute_one(query, [result2[-1]['id'], account_id])
+
+        return result2
+
+
+
+    # last_account_balance()
+    #
+    # return the latest account balance available in the database
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    # return:
+    #  - last available entry
+    def last_account_balance(self, account_id):
+        query = """SELECT *
+                     FROM account_balance
+                    WHERE bank_account = ?
+                 ORDER BY id desc
+                    LIMIT 1"""
+
+        return self.execute_one(query, [account_id])
+
+
+
+    # data_version()
+    #
+    # return a value which changes whenever another connection commits data, to any of the schemas
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  - data version
+    def data_version(self):
+        return tuple([self.execute_one("PRAGMA " + schema + ".data_version", [])[0] for schema in self.schemas])
+
+
+
+    # list_accounts()
+    #
+    # return all accounts in the database (and the attached files)
+    # the IDs are only unique within a schema
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  - list with accounts, including the 'shard' (schema name)
+    def list_accounts(self):
+        query = """SELECT id, name, account_number, sub_account, branch_code, '{schema}' AS shard
+                     FROM {schema}.bank_accounts"""
+
+        return self.union_query(query, [], "name")
+
+
+
+    # find_account()
+    #
+    # return the database ID and the schema for an account name, without creating the account
+    #
+    # parameter:
+    #  - self
+    #  - account name
+    # return:
+    #  - account with 'id' and 'shard' (schema name), or None
+    def find_account(self, account):
+        query = """SELECT id, '{schema}' AS shard
+                     FROM {schema}.bank_accounts
+                    WHERE name = ?"""
+        result = self.union_query(query, [account], "shard")
+        if (len(result) == 0):
+            return None
+
+        return result[0]
+
+
+
+    # last_transactions()
+    #
+    # return the newest transactions, by booking day
+    # (a backfill adds older bookings with higher IDs)
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    #  - maximum number of transactions
+    # return:
+    #  - list with transactions, newest first
+    def last_transactions(self, account_id, limit):
+        # same order as the 'account_statements_booking_order' index
+        query = """SELECT s.*, c.iban, c.bic, c.creditor_id
+                     FROM account_statements s
+                     JOIN counterparties c
+                       ON c.id = s.counterparty
+                    WHERE s.bank_account = ?
+                 ORDER BY """ + self.booking_day + """ DESC, s.id DESC
+                    LIMIT ?"""
+
+        return self.execute_query(query, [account_id, limit])
+
+
+
+    # payee_totals()
+    #
+    # return number of statements and sum per counterparty
+    # statements without IBAN and creditor ID (e.g. card payments) are skipped
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    # return:
+    #  - list with 'iban', 'bic', 'creditor_id', 'statements', 'total', 'currency',
+    #    and 'intended_use' of the latest statement
+    def payee_totals(self, account_id):
+        # grouped by the integer reference, the texts are only joined for the result
+        query = """SELECT c.iban, c.bic, c.creditor_id, t.statements, t.total, t.currency, s.intended_use
+                     FROM (SELECT counterparty, currency, COUNT(*) AS statements,
+                                  SUM(amount) AS total, MAX(id) AS last_id
+                             FROM account_statements
+                            WHERE bank_account = ?
+                         GROUP BY counterparty, currency) t
+                     JOIN counterparties c
+                       ON c.id = t.counterparty
+                     JOIN account_statements s
+                       ON s.id = t.last_id
+                    WHERE c.iban != ''
+                       OR c.creditor_id != ''
+                 ORDER BY t.total ASC"""
+
+        return self.execute_query(query, [account_id])
+
+
+
+    # monthly_totals()
+    #
+    # return incoming and outgoing amounts per month
+    #
+    # parameter:
+    #  - self
+    #  - account ID
+    # return:
+    #  - list with 'month' (YYYY-MM), 'incoming', 'outgoing' and 'currency'
+    def monthly_totals(self, account_id):
+        # the dates are stored in the German format (DD.MM.YYYY)
+        query = """SELECT substr(date_of_bookkeeping, 7, 4) || '-' || substr(date_of_bookkeeping, 4, 2) AS month,
+                          ROUND(SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END), 2) AS incoming,
+                          ROUND(SUM(CASE WHEN amount < 0 THEN amount ELSE 0 END), 2) AS outgoing,
+                          currency
+                     FROM account_statements
+                    WHERE bank_account = ?
+                 GROUP BY month, currency
+                 ORDER BY month"""
+
+        return self.execute_query(query, [account_id])
+
+
+
+    # database_size()
+    #
+    # return the size of the database
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  - dictionary with 'size' (bytes) and 'free' (bytes in unused pages)
+    def database_size(self):
+        page_size = self.execute_one("PRAGMA page_size", [])[0]
+        page_count = self.execute_one("PRAGMA page_count", [])[0]
+        freelist_count = self.execute_one("PRAGMA freelist_count", [])[0]
+
+        return {'size': page_size * page_count, 'free': page_size * freelist_count}
+
+
+
+    # incremental_vacuum()
+    #
+    # release a bounded number of free pages back to the filesystem
+    # only works if 'auto_vacuum' is set to 'INCREMENTAL'
+    #
+    # parameter:
+    #  - self
+    #  - maximum number of pages to release (None: all free pages)
+    # return:
+    #  none
+    def incremental_vacuum(self, pages):
+        if (pages is None):
+            query = "PRAGMA incremental_vacuum"
+        elif (pages > 0):
+            query = "PRAGMA incremental_vacuum(%d)" % int(pages)
+        else:
+            return
+        # the pragma releases one page per step, execute() only steps once
+        # executescript() runs the statement to completion
+        self.connection.executescript(query)
+
+
+
+    # prune_account_balance()
+    #
+    # thin out old balance snapshots according to the retention rules:
+    # all snapshots are kept for 'keep_all_days', afterwards only the last
+    # snapshot per day is kept, and after 'keep_daily_days' only the
+    # last snapshot per month
+    #
+    # parameter:
+    #  - self
+    #  - number of days to keep all snapshots
+    #  - number of days to keep one snapshot per day (0: forever)
+    # return:
+    #  - number of deleted snapshots
+    def prune_account_balance(self, keep_all_days, keep_daily_days):
+        cur = self.connection.cursor()
+
+        query = """DELETE FROM account_balance
+                    WHERE added_ts < datetime('now', ?)
+                      AND id NOT IN (SELECT MAX(id)
+                                       FROM account_balance
+                                   GROUP BY bank_account, date(added_ts))"""
+        cur.execute(query, ['-%d days' % int(keep_all_days)])
+        deleted = cur.rowcount
+
+        if (keep_daily_days > 0):
+            query = """DELETE FROM account_balance
+                        WHERE added_ts < datetime('now', ?)
+                          AND id NOT IN (SELECT MAX(id)
+                                           FROM account_balance
+                                       GROUP BY bank_account, strftime('%Y-%m', added_ts))"""
+            cur.execute(query, ['-%d days' % int(max(keep_all_days, keep_daily_days))])
+            deleted += cur.rowcount
+
+        self.connection.commit()
+        return deleted
+
+
+
+    # maintenance()
+    #
+    # prune old data, compact the database and update the planner statistics
+    #
+    # parameter:
+    #  - self
+    #  - dictionary with maintenance settings from the config file
+    # return:
+    #  none
+    def maintenance(self, settings):
+        size_before = self.database_size()
+        logging.info("Database size before maintenance: " + human_size(size_before['size']) +
+                     " (" + human_size(size_before['free']) + " free)")
+
+        deleted = self.prune_account_balance(settings['balance_keep_all_days'], settings['balance_keep_daily_days'])
+        logging.info("Removed " + str(deleted) + " old balance snapshots")
+
+        deleted = self.prune_change_log(settings['change_log_keep_days'])
+        if (deleted > 0):
+            logging.info("Removed " + str(deleted) + " old change log entries")
+
+        for account in self.list_accounts():
+            repaired = self.repair_running_balance(account['id'])
+            if (repaired > 0):
+                logging.info("Repaired running balance of " + str(repaired) + " statements, account: " + str(account['name']))
+
+        if (self.execute_one("PRAGMA auto_vacuum", [])[0] != 2):
+            # switching an existing database to incremental vacuum requires one full VACUUM
+            logging.info("Enable incremental vacuum for the database")
+            self.run_query("PRAGMA auto_vacuum = INCREMENTAL")
+            self.run_query("VACUUM")
+        else:
+            self.incremental_vacuum(None)
+
+        self.run_query("ANALYZE")
+
+        size_after = self.database_size()
+        logging.info("Database size after maintenance: " + human_size(size_after['size']) +
+                     " (" + human_size(size_after['free']) + " free)")
+
+
+
+
+# end Database class
+#######################################################################
+
+
+
+
+
+#######################################################################
+# Scheduler class
+
+class Scheduler:
+
+    def __init__(self, jitter):
+        self.jitter = jitter
+        # heap with (due time, account name)
+        self.queue = []
+        self.intervals = {}
+
+
+
+    def __len__(self):
+        return len(self.queue)
+
+
+
+    # load()
+    #
+    # (re)build the schedule from the accounts in the config file
+    # accounts which are already scheduled keep their due time
+    #
+    # parameter:
+    #  - self
+    #  - dictionary with accounts from the config file
+    # return:
+    #  none
+    def load(self, accounts):
+        previous = {}
+        for due, account in self.queue:
+            previous[account] = due
+
+        self.queue = []
+        self.intervals = {}
+        now = time.time()
+        for account in accounts:
+            if (accounts[account]['enabled'] != True):
+                logging.debug("Account '" + str(account) + "' is disabled in config")
+                continue
+            self.intervals[account] = accounts[account]['interval'] * 60
+            if (account in previous):
+                due = min(previous[account], now + self.intervals[account])
+            else:
+                # spread the first runs, not all accounts log in at the same second
+                due = now + random.uniform(0, self.jitter)
+            heapq.heappush(self.queue, (due, account))
+
+
+
+    # due_account()
+    #
+    # remove and return the next account which is due
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  - account name, or None if no account is due
+    def due_account(self):
+        if (len(self.queue) == 0 or self.queue[0][0] > time.time()):
+            return None
+        return heapq.heappop(self.queue)[1]
+
+
+
+    # seconds_until_next()
+    #
+    # return the time until the next account is due
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  - seconds
+    def seconds_until_next(self):
+        if (len(self.queue) == 0):
+            return 60.0
+        return self.queue[0][0] - time.time()
+
+
+
+    # reschedule()
+    #
+    # schedule the next run for an account
+    #
+    # parameter:
+    #  - self
+    #  - account name
+    # return:
+    #  none
+    def reschedule(self, account):
+        if (account not in self.intervals):
+            # account was removed or disabled during a reload
+            return
+        due = time.time() + self.intervals[account] + random.uniform(0, self.jitter)
+        heapq.heappush(self.queue, (due, account))
+
+
+
+# end Scheduler class
+#######################################################################
+
+
+
+
+
+#######################################################################
+# Mailer class
+
+class Mailer:
+
+    def __init__(self):
+        # the SMTP connection is opened on first use, and shared by all accounts
+        self.connection = None
+
+
+
+    # send()
+    #
+    # send an email, open the SMTP connection if necessary
+    #
+    # parameter:
+    #  - self
+    #  - sender address
+    #  - list with recipients
+    #  - message (string)
+    # return:
+    #  none
+    def send(self, sender, recipients, message):
+        if (self.connection is None):
+            self.connection = smtplib.SMTP('localhost')
+        try:
+            self.connection.sendmail(sender, recipients, message)
+        except smtplib.SMTPServerDisconnected:
+            # the server closed an idle connection, try once with a new connection
+            self.connection = smtplib.SMTP('localhost')
+            self.connection.sendmail(sender, recipients, message)
+
+
+
+    # close()
+    #
+    # close the SMTP connection
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def close(self):
+        if (self.connection is None):
+            return
+        try:
+            self.connection.quit()
+        except smtplib.SMTPServerDisconnected:
+            pass
+        self.connection = None
+
+
+
+# end Mailer class
+#######################################################################
+
+
+
+
+
+#######################################################################
+# QueryCache class
+
+class QueryCache:
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        # least recently used entry first
+        self.entries = collections.OrderedDict()
+
+
+
+    # get()
+    #
+    # return a cached entry, and mark it as recently used
+    #
+    # parameter:
+    #  - self
+    #  - key
+    # return:
+    #  - entry, or None
+    def get(self, key):
+        if (key not in self.entries):
+            return None
+        self.entries.move_to_end(key)
+
+        return self.entries[key]
+
+
+
+    # put()
+    #
+    # add an entry, remove the least recently used entry if the cache is full
+    #
+    # parameter:
+    #  - self
+    #  - key
+    #  - entry
+    # return:
+    #  none
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while (len(self.entries) > self.max_entries):
+            self.entries.popitem(last = False)
+
+
+
+    # clear()
+    #
+    # remove all entries
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def clear(self):
+        self.entries.clear()
+
+
+
+# end QueryCache class
+#######################################################################
+
+
+
+
+
+#######################################################################
+# RunTelemetry class
+
+class RunTelemetry:
+
+    def __init__(self):
+        self.start_ts = datetime.datetime.utcnow()
+        self.end_ts = None
+        self.start = time.time()
+        self.duration = None
+        # list with 'step', 'duration' and 'bytes' for every HTTP request
+        self.http_steps = []
+        self.bookings_parsed = 0
+        self.bookings_inserted = 0
+        self.db_time = 0.0
+        self.smtp_time = 0.0
+        self.outcome = None
+
+
+
+    # add_http_step()
+    #
+    # record one HTTP request
+    #
+    # parameter:
+    #  - self
+    #  - name of the step
+    #  - duration in seconds
+    #  - downloaded bytes
+    # return:
+    #  none
+    def add_http_step(self, step, duration, size):
+        self.http_steps.append({'step': step, 'duration': round(duration, 4), 'bytes': size})
+
+
+
+    # finish()
+    #
+    # end the run
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def finish(self):
+        self.end_ts = datetime.datetime.utcnow()
+        self.duration = time.time() - self.start
+
+
+
+# end RunTelemetry class
+#######################################################################
+
+
+
+
+
+#######################################################################
+# Categorizer class
+
+class Categorizer:
+
+    # fields which can be used in a rule
+    fields = ['intended_use', 'iban', 'creditor_id', 'mandate_reference']
+
+    # rules are checked in the order of the config file, the first matching rule wins
+    # all keywords are compiled into one automaton (Aho-Corasick), and hash maps for the exact matches
+    def __init__(self, rules):
+        # rule index -> category
+        self.categories = []
+        # field -> normalized value -> rule index
+        self.exact = {'iban': {}, 'creditor_id': {}, 'mandate_reference': {}}
+        # lowercase keyword -> rule index
+        self.keywords = {}
+        # keyword automaton: transitions, fallback state, and lowest rule index ending in a state
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]
+
+        for rule in rules:
+            index = len(self.categories)
+            self.categories.append(rule['category'])
+            for field in self.fields:
+                if (field not in rule):
+                    continue
+                values = rule[field] if isinstance(rule[field], list) else [rule[field]]
+                for value in values:
+                    if (field == 'intended_use'):
+                        self.keywords.setdefault(value.lower(), index)
+                    else:
+                        self.exact[field].setdefault(self.normalize(value), index)
+
+        self.build_automaton()
+
+
+
+    # build_automaton()
+    #
+    # compile all keywords into the automaton
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def build_automaton(self):
+        for keyword in self.keywords:
+            state = 0
+            for char in keyword:
+                if (char not in self.goto[state]):
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state] = self.keywords[keyword]
+
+        # breadth first: the fallback of a state is the longest suffix which is also a prefix of a keyword
+        queue = collections.deque(self.goto[0].values())
+        while (len(queue) > 0):
+            state = queue.popleft()
+            for char in self.goto[state]:
+                next_state = self.goto[state][char]
+                fallback = self.fail[state]
+                while (fallback > 0 and char not in self.goto[fallback]):
+                    fallback = self.fail[fallback]
+                fallback = self.goto[fallback].get(char, 0)
+                self.fail[next_state] = fallback
+                # keywords which end in the fallback state end here as well
+                inherited = self.output[fallback]
+                if (inherited is not None and (self.output[next_state] is None or inherited < self.output[next_state])):
+                    self.output[next_state] = inherited
+                queue.append(next_state)
+
+
+
+    # normalize()
+    #
+    # normalize an IBAN, creditor ID or mandate reference for the exact match
+    #
+    # parameter:
+    #  - self
+    #  - value
+    # return:
+    #  - value in uppercase, without spaces
+    def normalize(self, value):
+        return str(value).replace(' ', '').upper()
+
+
+
+    # categorize()
+    #
+    # find the category for a statement
+    #
+    # parameter:
+    #  - self
+    #  - statement (dictionary or database row)
+    # return:
+    #  - category, or None if no rule matches
+    def categorize(self, statement):
+        best = None
+        for field in self.exact:
+            if (len(self.exact[field]) == 0 or len(statement[field]) == 0):
+                continue
+            index = self.exact[field].get(self.normalize(statement[field]))
+            if (index is not None and (best is None or index < best)):
+                best = index
+
+        if (len(self.keywords) > 0 and best != 0):
+            goto = self.goto
+            fail = self.fail
+            output = self.output
+            state = 0
+            for char in (str(statement['intended_use']) + "\n" + str(statement['intended_use2'])).lower():
+                while (state > 0 and char not in goto[state]):
+                    state = fail[state]
+                state = goto[state].get(char, 0)
+                index = output[state]
+                if (index is not None and (best is None or index < best)):
+                    best = index
+                    if (best == 0):
+                        break
+
+        if (best is None):
+            return None
+
+        return self.categories[best]
+
+
+
+# end Categorizer class
+#######################################################################
+
+
+
+
+
+#######################################################################
+# Booking class
+
+class Booking:
+
+    # one booking from the turnovers page, all values are strings
+    # slots instead of a dictionary: large pages create many bookings
+    __slots__ = ('date_of_bookkeeping', 'date_of_value', 'intended_use', 'intended_use2', 'iban', 'bic',
+                 'customer_reference', 'mandate_reference', 'creditor_id', 'amount', 'currency')
+
+    def __init__(self, date_of_bookkeeping, date_of_value, intended_use, intended_use2, iban, bic,
+                 customer_reference, mandate_reference, creditor_id, amount, currency):
+        self.date_of_bookkeeping = date_of_bookkeeping
+        self.date_of_value = date_of_value
+        self.intended_use = intended_use
+        self.intended_use2 = intended_use2
+        self.iban = iban
+        self.bic = bic
+        self.customer_reference = customer_reference
+        self.mandate_reference = mandate_reference
+        self.creditor_id = creditor_id
+        self.amount = amount
+        self.currency = currency
+
+
+
+# end Booking class
+#######################################################################
+
+
+
+
+
+#######################################################################
+# BookingStream class
+
+class BookingStream:
+
+    # bookings are parsed while they are read (only once), the number is known afterwards
+    def __init__(self, bookings):
+        self.bookings = bookings
+        self.count = 0
+
+
+
+    # __iter__()
+    #
+    # return the bookings, one by one
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  - generator with booking objects
+    def __iter__(self):
+        for booking in self.bookings:
+            self.count += 1
+            yield booking
+
+
+
+# end BookingStream class
+#######################################################################
+
+
+
+
+
+#######################################################################
+# TurnoversParser class
+
+class TurnoversParser:
+
+    def __init__(self, previous_fingerprint = None):
+        self.account_data = {}
+        self.account_data['bank_balance'] = None
+        self.account_data['bank_balance_currency'] = None
+        self.account_data['bookings'] = None
+        self.account_data['fingerprint'] = None
+        self.account_data['unchanged'] = False
+        # fingerprint of the bookings and the balance, without session tokens
+        self.fingerprint = hashlib.sha256()
+        self.previous_fingerprint = previous_fingerprint
+        # checked once, not for every booking
+        self.debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        # bookings which are parsed, but not yet returned
+        self.parsed = collections.deque()
+        # 'before': searching the bookings, 'start': in the start comment,
+        # 'header': skipping the table header, 'bookings': in the bookings, 'after': done
+        self.state = 'before'
+        # incomplete line from the last chunk
+        self.buffer = ''
+        # content outside of the bookings, needed for the balance
+        self.outside = []
+        self.header = ''
+        # logical line, waiting for the next line to decide if both belong together
+        self.pending = None
+        self.reset_booking()
+
+
+
+    # feed()
+    #
+    # add the next chunk of the page
+    #
+    # parameter:
+    #  - self
+    #  - text chunk
+    # return:
+    #  none
+    def feed(self, chunk):
+        self.buffer += chunk
+        end = self.buffer.rfind("\n")
+        if (end == -1):
+            return
+        lines = self.buffer[:end + 1]
+        self.buffer = self.buffer[end + 1:]
+        for line in lines.splitlines(True):
+            self.process_line(line)
+
+
+
+    # parse()
+    #
+    # parse the page while it is downloaded
+    # the bookings are returned while the chunks arrive, the balance, the fingerprint
+    # and 'unchanged' are set once all bookings are read
+    #
+    # parameter:
+    #  - self
+    #  - iterable with text chunks
+    # return:
+    #  - dictionary with account data
+    def parse(self, chunks):
+        self.account_data['bookings'] = BookingStream(self.stream(chunks))
+
+        return self.account_data
+
+
+
+    # stream()
+    #
+    # feed the chunks, and return every booking as soon as it is parsed
+    #
+    # parameter:
+    #  - self
+    #  - iterable with text chunks
+    # return:
+    #  - generator with booking objects
+    def stream(self, chunks):
+        for chunk in chunks:
+            self.feed(chunk)
+            while (len(self.parsed) > 0):
+                yield self.parsed.popleft()
+        self.finish()
+        self.flush_bookings()
+        while (len(self.parsed) > 0):
+            yield self.parsed.popleft()
+
+
+
+    # close()
+    #
+    # finish parsing after the last chunk (if all chunks are fed with feed())
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  - dictionary with account data
+    def close(self):
+        self.finish()
+        self.flush_bookings()
+        if (self.account_data['unchanged'] is True):
+            self.parsed.clear()
+        self.account_data['bookings'] = BookingStream(self.bookings())
+
+        return self.account_data
+
+
+
+    # finish()
+    #
+    # process the rest of the page, extract the balance and calculate the fingerprint
+    # if the fingerprint is the same as before, the bookings are marked as 'unchanged'
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def finish(self):
+        if (len(self.buffer) > 0):
+            self.process_line(self.buffer)
+            self.buffer = ''
+
+        if (self.state == 'header'):
+            # the page ended before the header was found
+            self.end_header(True)
+        if (self.state != 'after'):
+            logging.error("")
+            logging.error("Missing bookings in retrieved data")
+            sys.exit(1)
+
+        self.extract_balance(''.join(self.outside))
+        self.outside = []
+
+        self.fingerprint.update(("\n" + str(self.account_data['bank_balance']) + " " +
+                                 str(self.account_data['bank_balance_currency'])).encode('utf-8'))
+        self.account_data['fingerprint'] = self.fingerprint.hexdigest()
+        if (self.account_data['fingerprint'] == self.previous_fingerprint):
+            logging.debug("Bookings are unchanged")
+            self.account_data['unchanged'] = True
+
+
+
+    # bookings()
+    #
+    # return the parsed bookings, every booking is released once it is returned
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  - generator with booking objects
+    def bookings(self):
+        while (len(self.parsed) > 0):
+            yield self.parsed.popleft()
+
+
+
+    # process_line()
+    #
+    # process one line of the page, according to the current state
+    #
+    # parameter:
+    #  - self
+    #  - line
+    # return:
+    #  none
+    def process_line(self, line):
+        if (self.state == 'before'):
+            start = re.search('<... Display bookedTurnovers', line)
+            if (start is None):
+                self.outside.append(line)
+                return
+            # the start comment has at least one more character before the '>'
+            self.outside.append(line[:start.end() + 1])
+            line = line[start.end() + 1:]
+            self.state = 'start'
+
+        if (self.state == 'start'):
+            end = line.find('>')
+            if (end == -1):
+                self.outside.append(line)
+                return
+            self.outside.append(line[:end + 1])
+            line = line[end + 1:]
+            self.state = 'header'
+
+        if (self.state == 'header'):
+            end = re.search('<... If there are no turnovers existent ', line)
+            if (end):
+                self.header += line[:end.start()]
+                self.outside.append(line[end.start():])
+                self.end_header(True)
+                return
+            self.header += line
+            self.end_header(False)
+            return
+
+        if (self.state == 'bookings'):
+            end = re.search('<... If there are no turnovers existent ', line)
+            if (end):
+                self.add_physical_line(line[:end.start()])
+                self.outside.append(line[end.start():])
+                self.end_bookings()
+                return
+            self.add_physical_line(line)
+            return
+
+        if (self.state == 'after'):
+            self.outside.append(line)
+
+
 
+    # end_header()
+    #
+    # skip the table header (headline and one more row)
+    # if the header is not found, all data is bookings
+    #
+    # parameter:
+    #  - self
+    #  - True if the end of the bookings is reached
+    # return:
+    #  none
+    def end_header(self, section_end):
+        header = re.search('<tr class="headline">.+?<\/tr>.*?<tr>.+?<\/tr>', self.header, re.DOTALL)
+        if (header):
+            data = self.header[header.end():]
+        elif (section_end is True or len(self.header) > 65536):
+            # no header found (or not at the beginning of the bookings)
+            data = self.header
+        else:
+            # wait for more lines
+            return
 
+        self.header = ''
+        self.state = 'bookings'
+        for line in data.splitlines(True):
+            self.add_physical_line(line)
+        if (section_end is True):
+            self.end_bookings()
 
-    # unseen_transactions()
+
+
+    # end_bookings()
     #
-    # return unseen transactions, move "unseen" pointer
+    # all lines with bookings are read
     #
     # parameter:
     #  - self
-    #  - account ID
     # return:
-    #  - list with previously unseen transactions
-    def unseen_transactions(self, account_id):
-        # first get pointer to last transaction
-        query = """SELECT *
-                     FROM user_information
-                    WHERE bank_account = ?"""
-        result = self.execute_one(query, [account_id])
-        if (result is None):
-            # no previous entry, read all statements and then create an entry
-            query = """SELECT *
-                         FROM account_statements
-                        WHERE bank_account = ?
-                     ORDER BY id ASC"""
-            result2 = self.execute_query(query, [account_id])
-            if (len(result2) > 0):
-                query = """INSERT INTO user_information
-                                       (bank_account, last_seen_statement)
-                                VALUES (?, ?)"""
-                self.execute_one(query, [account_id, result2[-1]['id']])
+    #  none
+    def end_bookings(self):
+        self.state = 'after'
+
+
+
+    # flush_bookings()
+    #
+    # parse the last logical line, and add the last booking
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def flush_bookings(self):
+        if (self.pending is not None):
+            self.parse_line(self.pending)
+            self.pending = None
+        # don't forget the last booking before finishing the data
+        self.finish_booking()
+
+
+
+    # add_physical_line()
+    #
+    # add a line of the bookings to the fingerprint, and parse it
+    #
+    # parameter:
+    #  - self
+    #  - line
+    # return:
+    #  none
+    def add_physical_line(self, line):
+        # debit and credit amount is split across several lines
+        # and "disturbed" by the "Lastschriftrueckgabe" (returning a direct debit) link
+        line = re.sub('<a href=.+?>Lastschrift.+?<\/a>', '', line)
+
+        # links and form targets carry session tokens, they are not part of the fingerprint
+        normalized = re.sub(r'\s+', ' ', re.sub('(href|action|src)="[^"]*"', '', line)).strip()
+        if (len(normalized) > 0):
+            self.fingerprint.update((normalized + "\n").encode('utf-8'))
+
+        self.join_physical_line(line)
+
+
+
+    # join_physical_line()
+    #
+    # combine physical lines into logical lines: the whitespace after
+    # opening and before closing <td> tags is removed, this joins
+    # amounts which are split across several lines
+    #
+    # parameter:
+    #  - self
+    #  - line
+    # return:
+    #  none
+    def join_physical_line(self, line):
+        if (self.pending is None):
+            self.pending = line
+            return
+
+        if (re.search('<td[^>]*$', self.pending)):
+            # the <td> tag continues on the next line
+            self.pending += line
+        elif (re.search(r'<td[^>]*>\s*$', self.pending) or line.lstrip().startswith('</td>')):
+            self.pending = self.pending.rstrip() + line.lstrip()
         else:
-            # existing previous entry, read only new statements and update the entry
-            query = """SELECT *
-                         FROM account_statements
-                        WHERE bank_account = ?
-                          AND id > ?
-                     ORDER BY id ASC"""
-            result2 = self.execute_query(query, [account_id, result['last_seen_statement']])
-            if (len(result2) > 0 and result2[-1]['id'] != result['last_seen_statement']):
-                query = """UPDATE user_information
-                              SET last_seen_statement = ?
-                            WHERE id = ?"""
-                self.execute_one(query, [result2[-1]['id'], account_id])
+            self.parse_line(self.pending)
+            self.pending = line
 
-        return result2
 
 
+    # reset_booking()
+    #
+    # start with an empty booking
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def reset_booking(self):
+        self.date_of_bookkeeping = None
+        self.date_of_value = None
+        self.intended_use = None
+        self.intended_use2 = ''
+        self.iban = ''
+        self.bic = ''
+        self.customer_reference = ''
+        self.mandate_reference = ''
+        self.creditor_id = ''
+        self.amount = None
+        self.currency = None
+
+
+
+    # finish_booking()
+    #
+    # add the current booking to the parsed bookings
+    #
+    # parameter:
+    #  - self
+    # return:
+    #  none
+    def finish_booking(self):
+        if (self.date_of_bookkeeping is None):
+            return
+
+        if (self.amount is None or self.currency is None):
+            logging.error("Could not extract currency or amount!")
+            sys.exit(1)
+        self.parsed.append(Booking(self.date_of_bookkeeping, self.date_of_value, self.intended_use, self.intended_use2,
+                                   self.iban, self.bic, self.customer_reference, self.mandate_reference,
+                                   self.creditor_id, self.amount, self.currency))
+        if (self.debug is True):
+            logging.debug("Found booking entry: %s/%s: %s %s (%s)", self.date_of_bookkeeping, self.date_of_value,
+                          self.amount, self.currency, self.intended_use)
+        self.reset_booking()
+
 
-    # last_account_balance()
+
+    # parse_line()
     #
-    # return the latest account balance available in the database
+    # extract booking fields from a logical line
     #
     # parameter:
     #  - self
-    #  - account ID
+    #  - line
     # return:
-    #  - last available entry
-    def last_account_balance(self, account_id):
-        query = """SELECT *
-                     FROM account_balance
-                    WHERE bank_account = ?
-                 ORDER BY id desc
-                    LIMIT 1"""
+    #  none
+    def parse_line(self, line):
+        line = re.sub('(<td.*?>)\s*', '\g<1>', line, flags = re.DOTALL | re.MULTILINE)
+        line = re.sub('\s*(<\/td>)', '\g<1>', line, flags = re.DOTALL | re.MULTILINE)
 
-        return self.execute_one(query, [account_id])
+        # here it get's complicated: the output can have rows and tables stacked
+        # there is no clear split pattern
+        # go through the data line by line, and search for 'headers="bTentry"' as pattern for a new entry
+        btentry = re.search('<td headers="bTentry".*?>([0-9\.]+)</td>', line)
+        if (btentry):
+            # first write entry with existing data, then start a new one
+            self.finish_booking()
+            # now get the date
+            self.date_of_bookkeeping = btentry.group(1)
 
+        btvalue = re.search('<td headers="bTvalue".*?>([0-9\.]+)</td>', line)
+        if (btvalue):
+            self.date_of_value = btvalue.group(1)
 
+        btpurpose = re.search('<td headers="bTpurpose".*?>(.*?)</td>', line, re.DOTALL)
+        if (btpurpose):
+            self.intended_use = htmlescape.unescape(btpurpose.group(1).strip())
 
+        btdebit = re.search('<td headers="bTdebit".*?>\s*([0-9\.\-,]+)\s*</td>', line)
+        if (btdebit):
+            self.amount = fix_punctation(btdebit.group(1))
 
-# end Database class
+        btcredit = re.search('<td headers="bTcredit".*?>\s*([0-9\.\-,]+)\s*</td>', line)
+        if (btcredit):
+            self.amount = fix_punctation(btcredit.group(1))
+
+        btcurrency = re.search('<td headers="bTcurrency".*?>(.*?)</td>', line)
+        if (btcurrency):
+            self.currency = btcurrency.group(1).strip()
+
+        btintended_use2 = re.search('<td.*?>Verwendungszweck</td><td.*?>(.+?)<\/td>', line)
+        if (btintended_use2):
+            self.intended_use2 = htmlescape.unescape(btintended_use2.group(1).strip())
+
+        btiban = re.search('<td.*?>IBAN</td><td.*?>(.+?)<\/td>', line)
+        if (btiban):
+            self.iban = btiban.group(1).strip()
+
+        btbic = re.search('<td.*?>BIC</td><td.*?>(.+?)<\/td>', line)
+        if (btbic):
+            self.bic = btbic.group(1).strip()
+
+        btcustomer_reference = re.search('<td.*?>Kundenreferenz</td><td.*?>(.+?)<\/td>', line)
+        if (btcustomer_reference):
+            self.customer_reference = btcustomer_reference.group(1).strip()
+
+        btmandate_reference = re.search('<td.*?>Mandatsreferenz</td><td.*?>(.+?)<\/td>', line)
+        if (btmandate_reference):
+            self.mandate_reference = btmandate_reference.group(1).strip()
+
+        btcreditor_id = re.search('<td.*?>Gl.*?ubiger ID</td><td.*?>(.+?)<\/td>', line)
+        if (btcreditor_id):
+            self.creditor_id = btcreditor_id.group(1).strip()
+
+
+
+    # extract_balance()
+    #
+    # extract the current balance from the content outside of the bookings
+    #
+    # parameter:
+    #  - self
+    #  - HTML content
+    # return:
+    #  none
+    def extract_balance(self, req_data):
+        current_amount = re.search('>Aktueller Kontostand<.+?class="balance credit"><strong>\s*([0-9,\.\-]+)\s*<\/strong>', req_data, re.DOTALL | re.MULTILINE)
+        if (current_amount):
+            #print(fix_punctation(current_amount.group(1)))
+            self.account_data['bank_balance'] = str(fix_punctation(current_amount.group(1)))
+        else:
+            logging.error("")
+            logging.error("Missing current amount in retrieved data")
+            sys.exit(1)
+
+
+        current_amount_currency = re.search('>Aktueller Kontostand<.+?class="balance credit">.+?<\/strong>.+?<strong.*?><acronym.*?>(.+?)<\/acronym', req_data, re.DOTALL | re.MULTILINE)
+        if (current_amount_currency):
+            self.account_data['bank_balance_currency'] = str(current_amount_currency.group(1))
+        else:
+            logging.error("")
+            logging.error("Missing current amount currency in retrieved data")
+            sys.exit(1)
+
+
+        if (self.account_data['bank_balance'] is None or self.account_data['bank_balance_currency'] is None):
+            logging.error("Could not extract current balance or currency")
+            sys.exit(1)
+
+        logging.debug("Current account balance: " + str(self.account_data['bank_balance']) + " " + str(self.account_data['bank_balance_currency']))
+
+
+
+# end TurnoversParser class
 #######################################################################
 
 
@@ -757,34 +4177,33 @@ def human_size(size_bytes):
 
 
 
-# get_url()
+# http_headers()
 #
-# GET a specific url, handle compression
+# return the HTTP headers for every request
 #
 # parameter:
-#  - url
-#  - requests object
-#  - data (optional, dictionary)
+#  none
 # return:
-#  - content of the link
-def get_url(url, session, data = None):
-
-    logging.getLogger("urllib3").setLevel(logging.WARNING)
-    logging.getLogger("requests.packages.urllib3").setLevel(logging.WARNING)
-    logging.getLogger("httplib").setLevel(logging.WARNING)
+#  - dictionary with headers
+def http_headers():
     # set language to 'German', all content will be rendered in German and all functionality is available
     headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:40.0) Gecko/20100101 Firefox/40.1',
                'Accept-Encoding': 'gzip, deflate',
                'Accept-Language' : 'de'}
 
-    if (data is None):
-        # GET request
-        rs = session.request('GET', url, headers = headers)
-    else:
-        # POST request
-        rs = session.request('POST', url, data = data, headers = headers)
+    return headers
 
 
+
+# check_http_status()
+#
+# verify the HTTP status of a response, exit on error
+#
+# parameter:
+#  - requests response
+# return:
+#  none
+def check_http_status(rs):
     if (rs.status_code != 200):
         if (rs.status_code == 400):
             logging.error("HTTPError = 400 (Bad Request)")
@@ -810,18 +4229,106 @@ def get_url(url, session, data = None):
             logging.error("HTTPError = " + str(rs.status_code) + "")
         sys.exit(1)
 
+
+
+# get_url()
+#
+# GET a specific url, handle compression
+#
+# parameter:
+#  - url
+#  - requests object
+#  - data (optional, dictionary)
+#  - telemetry object (optional)
+#  - name of the step, for the telemetry (optional)
+# return:
+#  - content of the link
+def get_url(url, session, data = None, telemetry = None, step = None):
+
+    log_context['phase'] = step
+    headers = http_headers()
+    start = time.time()
+
+    if (data is None):
+        # GET request
+        rs = session.request('GET', url, headers = headers)
+    else:
+        # POST request
+        rs = session.request('POST', url, data = data, headers = headers)
+
+    if (telemetry is not None):
+        telemetry.add_http_step(step, time.time() - start, len(rs.content))
+
+    check_http_status(rs)
+
     if (len(rs.text) == 0):
         logging.error("failed to download the url")
         sys.exit(1)
 
     data = rs.text
 
-    logging.debug("fetched " + human_size(len(data)))
+    if (logging.getLogger().isEnabledFor(logging.DEBUG)):
+        logging.debug("fetched %s", human_size(len(data)), extra = {'duration': time.time() - start})
 
     return data
 
 
 
+# get_url_stream()
+#
+# GET or POST a specific url, and return the content in decoded chunks
+# while it is downloaded
+#
+# parameter:
+#  - url
+#  - requests object
+#  - data (optional, dictionary)
+#  - telemetry object (optional)
+#  - name of the step, for the telemetry (optional)
+# return:
+#  - generator with text chunks
+def get_url_stream(url, session, data = None, telemetry = None, step = None):
+
+    log_context['phase'] = step
+    headers = http_headers()
+    start = time.time()
+
+    if (data is None):
+        # GET request
+        rs = session.request('GET', url, headers = headers, stream = True)
+    else:
+        # POST request
+        rs = session.request('POST', url, data = data, headers = headers, stream = True)
+
+    size = 0
+    try:
+        check_http_status(rs)
+
+        # iter_content() only decodes if the encoding is known, decode incrementally instead
+        decoder = codecs.getincrementaldecoder(rs.encoding or 'utf-8')(errors = 'replace')
+        for chunk in rs.iter_content(chunk_size = 16384):
+            size += len(chunk)
+            text = decoder.decode(chunk)
+            if (len(text) > 0):
+                yield text
+        text = decoder.decode(b'', final = True)
+        if (len(text) > 0):
+            yield text
+    finally:
+        rs.close()
+        if (telemetry is not None):
+            # includes the time for parsing, which runs while downloading
+            telemetry.add_http_step(step, time.time() - start, size)
+
+    if (size == 0):
+        logging.error("failed to download the url")
+        sys.exit(1)
+
+    if (logging.getLogger().isEnabledFor(logging.DEBUG)):
+        logging.debug("fetched %s", human_size(size), extra = {'duration': time.time() - start})
+
+
+
 # extract_form_data()
 #
 # extract fields from a HTML form
@@ -836,12 +4343,14 @@ def extract_form_data(form_content, base_url):
     data['action'] = None
     data['fields'] = {}
 
-    # first extract the target for the form
-    form_action = re.search('<form.+?action="(.+?)".*?>(.*)<\/form>', form_content, re.DOTALL)
-    if (form_action):
+    # first extract the target for the form, from the opening tag only
+    form_tag = html_opening_tag(form_content, form_content.find('<form'))
+    form_action = re.search('action="([^"]+)"', form_tag)
+    form_end = form_content.rfind('</form>')
+    if (form_action and form_end > -1):
         # and normalize it
         data['action'] = urljoin(base_url, str(form_action.group(1)))
-        form3_inner_content = str(form_action.group(2))
+        form3_inner_content = form_content[form_content.find('<form') + len(form_tag):form_end]
     else:
         # not finding a target is a problem
         logging.error("Can't extract action field from form!")
@@ -854,21 +4363,21 @@ def extract_form_data(form_content, base_url):
         # this assumes that the field is in one line
         line_hidden = re.search('<input type.*?=.*?"hidden".*?name.*?=.*?"(.+?)".*?value.*?="(.*?)"', line)
         if (line_hidden):
-            logging.debug("found   hidden: " + str(line_hidden.group(1)) + " = '" + str(line_hidden.group(2)) + "'")
+            logging.debug("found   hidden: %s = '%s'", line_hidden.group(1), line_hidden.group(2))
             data['fields'][str(line_hidden.group(1))] = str(line_hidden.group(2))
 
 
         # this assumes that the field is in one line
         line_text = re.search('<input type.*?=.*?"text".*?name.*?=.*?"(.+?)".*?value.*?="(.*?)"', line)
         if (line_text):
-            logging.debug("found     text: " + str(line_text.group(1)) + " = '" + str(line_text.group(2)) + "'")
+            logging.debug("found     text: %s = '%s'", line_text.group(1), line_text.group(2))
             data['fields'][str(line_text.group(1))] = str(line_text.group(2))
 
 
         # this assumes that the field is in one line
         line_password = re.search('<input type.*?=.*?"password".*?name.*?=.*?"(.+?)".*?value.*?="(.*?)"', line)
         if (line_password):
-            logging.debug("found password: " + str(line_password.group(1)) + " = '" + str(line_password.group(2)) + "'")
+            logging.debug("found password: %s = '%s'", line_password.group(1), line_password.group(2))
             data['fields'][str(line_password.group(1))] = str(line_password.group(2))
 
 
@@ -895,7 +4404,7 @@ def extract_form_data(form_content, base_url):
                     data['fields'][str(line_select.group(1))] = str(l3_select5.group(1))
                 else:
                     logging.error("Found select field (" + str(line_select.group(1)) + "), but no option field!")
-            logging.debug("found   select: " + str(line_select.group(1)) + " = '" + str(data['fields'][str(line_select.group(1))]) + "'")
+            logging.debug("found   select: %s = '%s'", line_select.group(1), data['fields'][str(line_select.group(1))])
 
 
         # this deals with multiple lines, but one radio field per line
@@ -904,7 +4413,7 @@ def extract_form_data(form_content, base_url):
             # if it's the 'checked' radio button, overwrite any previous value
             line_radio2 = re.search('<input type.*?=.*?"radio".*?name.*?=.*?"(.+?)".*?value.*?="(.*?)"[^>]+checked=', line)
             if (line_radio2):
-                logging.debug("found    radio: " + str(line_radio2.group(1)) + " = '" + str(line_radio2.group(2)) + "'")
+                logging.debug("found    radio: %s = '%s'", line_radio2.group(1), line_radio2.group(2))
                 data['fields'][str(line_radio2.group(1))] = str(line_radio2.group(2))
             else:
                 try:
@@ -912,20 +4421,23 @@ def extract_form_data(form_content, base_url):
                 except KeyError:
                     # no previous value stored, must be the first radio button
                     data['fields'][str(line_radio.group(1))] = str(line_radio.group(2))
-                    logging.debug("found    radio: " + str(line_radio.group(1)) + " = '" + str(line_radio.group(2)) + "'")
+                    logging.debug("found    radio: %s = '%s'", line_radio.group(1), line_radio.group(2))
 
     return data
 
 
 
-# retrieve_bank_account_data()
+# bank_login()
 #
-# log in into the website, and retrieve all bank account data
+# log in into the website, and open the form for the account turnovers
 #
 # parameter:
 #  - account data
 #  - requests handle
-def retrieve_bank_account_data(account, session):
+#  - telemetry object (optional)
+# return:
+#  - dictionary with 'action' as URL for the turnovers, and 'fields'
+def bank_login(account, session, telemetry = None):
 
     # Note: the following code is not very nice, because it has to deal with multiple requests
     #       (main website, banking website, login, account overview, data extract) and find the
@@ -935,17 +4447,19 @@ def retrieve_bank_account_data(account, session):
     #html = HTMLParser.HTMLParser()
     html = HTMLParser()
     # start on the main website, there is a link to the banking website
-    url = 'https://www.' + 'deutsche' + '-' + 'bank' + '.de/'
+    url = account['bank_url']
+    # the banking website uses the same scheme, only a test server runs on plain http
+    scheme = urllib.parse.urlsplit(url).scheme
 
 
     # fetch main website
-    req = get_url(url, session)
+    req = get_url(url, session, telemetry = telemetry, step = 'homepage')
     #print(req)
     # problem description:
     # although the regex is made non-greedy, Python still matches from the first <a>
     # "consuming" everything in front with a .* makes the regex run forever
-    # split by links, remove newlines, then search for the link
-    l_r = re.findall('<a.+?<\/a>', req, re.DOTALL)
+    # split by links (in one linear pass), remove newlines, then search for the link
+    l_r = [req[start:end] for start, end in find_tag_blocks(req, 'a')]
     if (l_r):
         l_r = [l.replace("\n", " ") for l in l_r]
         #logging.debug(l_r)
@@ -958,7 +4472,7 @@ def retrieve_bank_account_data(account, session):
         #print(l)
         #l_r2 = re.search('.+?href="(https:.+?trxm.*?)".*?title=".*?Online.Banking.*?">.*?Online\-Banking.*?<\/a>', l)
         #l_r2 = re.search('.*?title=".*?Online.Banking.*?".+?href="(https:.+?trxm.*?)">.*?Online\-Banking.*?<\/a>', l)
-        l_r2 = re.search('<a class="[a-z0-9 \-]*online.banking.theme[a-z0-9 \-]*" href="(https:.+?trxm.*?)"', l)
+        l_r2 = re.search('<a class="[a-z0-9 \-]*online.banking.theme[a-z0-9 \-]*" href="(' + scheme + ':.+?trxm.*?)"', l)
         if (l_r2):
             url_banking = l_r2.group(1)
             logging.debug("next link (2): " + url_banking)
@@ -976,21 +4490,20 @@ def retrieve_bank_account_data(account, session):
 
 
     # fetch Online Banking page
-    req_banking = get_url(url_banking, session)
+    req_banking = get_url(url_banking, session, telemetry = telemetry, step = 'banking')
     req_banking = remove_cookie_consent_box(req_banking)
     #req_banking = remove_search_box(req_banking)
     #print(req_banking)
 
     # the result should only have one <form> object
-    l_banking_r_forms = re.search('<form.+<form', req_banking, re.DOTALL)
-    if (l_banking_r_forms):
+    l_banking_r_forms = find_tag_blocks(req_banking, 'form')
+    if (len(find_tag_starts(req_banking, 'form')) > 1):
         logging.error("Found multiple forms in login page!")
         sys.exit(1)
 
 
-    l_banking_r_form = re.search('(<form.+?action=".+?".*?>.*<\/form>)', req_banking, re.DOTALL)
-    if (l_banking_r_form):
-        form_login_content = str(l_banking_r_form.group(1))
+    if (len(l_banking_r_forms) == 1 and 'action="' in html_opening_tag(req_banking, l_banking_r_forms[0][0])):
+        form_login_content = req_banking[l_banking_r_forms[0][0]:l_banking_r_forms[0][1]]
     else:
         logging.error("Can't extract form from login page!")
         sys.exit(1)
@@ -1024,15 +4537,17 @@ def retrieve_bank_account_data(account, session):
 
 
     # login into website
-    req_login = get_url(url_login, session, data_login['fields'])
+    req_login = get_url(url_login, session, data_login['fields'], telemetry, 'login')
     #print(req_login)
     #sys.exit(0)
 
 
     # need the link to "Konten"
     url_accounts = False
-    for line in form_login_content.splitlines(True):
-        l_accounts_r = re.search('<a href="(.+?)".*?>Konten<\/a>', req_login)
+    for start, end in find_tag_blocks(req_login, 'a'):
+        if (req_login.endswith('>Konten</a>', start, end) is False):
+            continue
+        l_accounts_r = re.match('<a href="([^"]+)"', req_login[start:end])
         if (l_accounts_r):
             url_accounts = urljoin(url_login, str(l_accounts_r.group(1)))
             break
@@ -1041,13 +4556,16 @@ def retrieve_bank_account_data(account, session):
         print("Can't identify link for 'Konten'")
         sys.exit(1)
     logging.debug("next link (4): " + url_accounts)
-    req_accounts = get_url(url_accounts, session)
+    req_accounts = get_url(url_accounts, session, telemetry = telemetry, step = 'accounts')
 
 
-    l_accounts_r_form = re.search('(<form.+?id="accountTurnoversForm".+?action=".+?".*?>.*?<\/form>)', req_accounts, re.DOTALL)
-    if (l_accounts_r_form):
-        form_accounts_content = str(l_accounts_r_form.group(1))
-    else:
+    form_accounts_content = None
+    for start, end in find_tag_blocks(req_accounts, 'form'):
+        form_tag = html_opening_tag(req_accounts, start)
+        if ('id="accountTurnoversForm"' in form_tag and 'action="' in form_tag):
+            form_accounts_content = req_accounts[start:end]
+            break
+    if (form_accounts_content is None):
         logging.error("Can't extract form from accounts page!")
         sys.exit(1)
 
@@ -1068,179 +4586,272 @@ def retrieve_bank_account_data(account, session):
             sys.exit(1)
 
     # set required values
-    data_accounts['fields']['periodDays'] = '85'
-    data_accounts['fields']['period'] = 'fixedRange'
     data_accounts['fields']['subaccountAndCurrency'] = "%02d" % account['sub_account']
 
+    return data_accounts
+
+
+
+# fetch_turnovers()
+#
+# submit the turnovers form, and parse the result while it is downloaded
+# with 'csv' the CSV export is used if the form offers it, the HTML page is the fallback
+#
+# parameter:
+#  - turnovers form (from bank_login())
+#  - requests handle
+#  - dictionary with form fields which are changed
+#  - preferred format: 'csv' or 'html'
+#  - fingerprint of the previous result (optional)
+#  - telemetry object (optional)
+# return:
+#  - dictionary with balance and bookings
+#    the balance, the fingerprint and 'unchanged' are set once all bookings are read
+def fetch_turnovers(data_accounts, session, fields, turnovers_format = 'html', previous_fingerprint = None, telemetry = None):
+    form_fields = dict(data_accounts['fields'])
+    form_fields.update(fields)
+
+    if (turnovers_format == 'csv' and 'outputFormat' in form_fields):
+        csv_fields = dict(form_fields)
+        csv_fields['outputFormat'] = 'csv'
+        chunks = get_url_stream(data_accounts['action'], session, csv_fields, telemetry, 'turnovers_csv')
+        account_data = parse_turnovers_csv(iter_lines(chunks), previous_fingerprint)
+        if (account_data is not None):
+            return account_data
+        # stop the download, the result is not a CSV file
+        chunks.close()
+        logging.debug("CSV export not available, use HTML page")
+
+    # the turnovers page is parsed while it is downloaded
+    parser = TurnoversParser(previous_fingerprint)
+    account_data = parser.parse(get_url_stream(data_accounts['action'], session, form_fields, telemetry, 'turnovers'))
+
+    #sys.exit(0)
+    return account_data
+
+
+
+# retrieve_bank_account_data()
+#
+# log in into the website, and retrieve all bank account data
+#
+# parameter:
+#  - account data
+#  - requests handle
+#  - fingerprint of the previous result (optional)
+#  - telemetry object (optional)
+# return:
+#  - dictionary with balance and bookings
+#    once all bookings are read, 'unchanged' is True if the fingerprint is the same as before
+def retrieve_bank_account_data(account, session, previous_fingerprint = None, telemetry = None):
+    data_accounts = bank_login(account, session, telemetry)
+
+    return fetch_turnovers(data_accounts, session, {'periodDays': '85', 'period': 'fixedRange'},
+                           account['turnovers_format'], previous_fingerprint, telemetry)
+
+
+
+# backfill_account()
+#
+# retrieve the account history starting at a specific date, in chunks
+# a checkpoint after every chunk allows to resume an interrupted backfill
+#
+# parameter:
+#  - config object
+#  - database object
+#  - account name (from config file)
+#  - requests session
+#  - start date (datetime.date)
+# return:
+#  none
+def backfill_account(config, database, account, session, from_date):
+    logging.info("Backfill account: " + str(account) + " (from " + from_date.isoformat() + ")")
+    account_id = database.get_account_id(account,
+                                         config.configfile['accounts'][account]['account_number'],
+                                         config.configfile['accounts'][account]['sub_account'],
+                                         config.configfile['accounts'][account]['branch_code'])
+    chunk_days = config.configfile['backfill']['chunk_days']
+    today = datetime.date.today()
+
+    chunk_start = database.backfill_checkpoint(account_id, from_date)
+    if (chunk_start is None):
+        chunk_start = from_date
+    else:
+        logging.info("Resume backfill at " + chunk_start.isoformat())
+    if (chunk_start > today):
+        logging.info("Backfill for account '" + str(account) + "' is already complete")
+        return
+
+    # old bookings must not show up as new bookings in the next notification
+    all_seen = (database.last_seen_statement(account_id) == database.last_statement_id(account_id))
+
+    session.cookies.clear()
+    data_accounts = bank_login(config.configfile['accounts'][account], session)
+
+    # verify that the form has all fields we need for a date range
+    for check in ['periodStartDay', 'periodStartMonth', 'periodStartYear', 'periodEndDay', 'periodEndMonth', 'periodEndYear']:
+        try:
+            t = data_accounts['fields'][check]
+        except KeyError:
+            print("")
+            print("Error: missing '" + str(check) + "' in data form")
+            sys.exit(1)
+
+    while (chunk_start <= today):
+        chunk_end = min(chunk_start + datetime.timedelta(days = chunk_days - 1), today)
+        logging.debug("Backfill chunk: " + chunk_start.isoformat() + " - " + chunk_end.isoformat())
+        account_data = fetch_turnovers(data_accounts, session,
+                                       {'period': 'dateRange',
+                                        'periodStartDay': "%02d" % chunk_start.day,
+                                        'periodStartMonth': "%02d" % chunk_start.month,
+                                        'periodStartYear': "%04d" % chunk_start.year,
+                                        'periodEndDay': "%02d" % chunk_end.day,
+                                        'periodEndMonth': "%02d" % chunk_end.month,
+                                        'periodEndYear': "%04d" % chunk_end.year},
+                                       config.configfile['accounts'][account]['turnovers_format'])
+        # the running balance is calculated once, after the last chunk
+        new_statements = database.save_account_transactions(account_id, account_data, running_balance = False)
+        # old charges are not reported, and not flagged
+        database.update_recurring_payments(account_id, new_statements)
+        database.score_statements(account_id, new_statements, config.configfile['anomalies'], False)
+        logging.info("Backfill " + chunk_start.isoformat() + " - " + chunk_end.isoformat() + ": " +
+                     str(account_data['bookings'].count) + " bookings, " + str(len(new_statements)) + " new")
+        chunk_start = chunk_end + datetime.timedelta(days = 1)
+        database.save_backfill_checkpoint(account_id, from_date, chunk_start)
+
+    # the last chunk ends today, its balance is the anchor for all statements
+    database.repair_running_balance(account_id, account_data['bank_balance'])
+    if (all_seen is True):
+        database.set_last_seen_statement(account_id, database.last_statement_id(account_id))
+    database.delete_backfill_checkpoint(account_id)
+    logging.info("Backfill for account '" + str(account) + "' is complete")
+
+
+
+# iter_lines()
+#
+# split text chunks into lines
+#
+# parameter:
+#  - iterable with text chunks
+# return:
+#  - generator with lines (including the line break)
+def iter_lines(chunks):
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        end = buffer.rfind("\n")
+        if (end == -1):
+            continue
+        for line in buffer[:end + 1].splitlines(True):
+            yield line
+        buffer = buffer[end + 1:]
+    if (len(buffer) > 0):
+        yield buffer
+
+
+
+# csv_column()
+#
+# return a value from a CSV row, by column name
+#
+# parameter:
+#  - list with values
+#  - dictionary with column positions
+#  - column name
+# return:
+#  - value, empty string if the column does not exist
+def csv_column(row, columns, name):
+    if (name not in columns or columns[name] >= len(row)):
+        return ''
 
-    req_data = get_url(url_data, session, data_accounts['fields'])
+    return row[columns[name]].strip()
 
-    #print(req_data)
 
 
-    # extract the booking data
+# parse_turnovers_csv()
+#
+# parse the CSV export of the account turnovers
+# the file starts with a few lines of general information, followed by
+# the header line ('Buchungstag;Wert;...'), the bookings and the balance
+#
+# parameter:
+#  - iterable with lines (a file object works as well)
+#  - fingerprint of the previous result (optional)
+# return:
+#  - dictionary with balance and bookings, None if this is not a CSV export
+#    the bookings are parsed while the lines are read, the balance, the fingerprint
+#    and 'unchanged' are set once all bookings are read
+def parse_turnovers_csv(lines, previous_fingerprint = None):
     account_data = {}
     account_data['bank_balance'] = None
     account_data['bank_balance_currency'] = None
-    bookings = re.search('<... Display bookedTurnovers.+?>(.+?)<... If there are no turnovers existent .+? shown above ..>', req_data, re.DOTALL)
-    if (bookings):
-        try:
-            bookings_data = str(bookings.group(1))
-        except UnicodeDecodeError:
-            bookings_data = str(bookings.group(1))
-        bookings = re.search('<tr class="headline">.+?<\/tr>.*?<tr>.+?<\/tr>(.+)$', bookings_data, re.DOTALL)
-        if (bookings):
-            try:
-                bookings_data = str(bookings.group(1))
-            except UnicodeDecodeError:
-                bookings_data = str(bookings.group(1))
-            #print(bookings_data)
-        account_data['bookings'] = []
-        # here it get's complicated: the output can have rows and tables stacked
-        # there is no clear split pattern
-        # go through the data line by line, and search for 'headers="bTentry"' as pattern for a new entry
-        # don't forget the last booking before finishing the data
-        date_of_bookkeeping = None
-        date_of_value = None
-        intended_use = None
-        intended_use2 = ''
-        iban = ''
-        bic = ''
-        customer_reference = ''
-        mandate_reference = ''
-        creditor_id = ''
-        amount = None
-        currency = None
-
-
-        # debit and credit amount is split across several lines
-        # and "disturbed" by the "Lastschriftrueckgabe" (returning a direct debit) link
-        bookings_data = re.sub('<a href=.+?>Lastschrift.+?<\/a>', '', bookings_data)
-        bookings_data = re.sub('(<td.*?>)\s*', '\g<1>', bookings_data, flags = re.DOTALL | re.MULTILINE)
-        bookings_data = re.sub('\s*(<\/td>)', '\g<1>', bookings_data, flags = re.DOTALL | re.MULTILINE)
-        #bookings_data = re.sub('(<\/a>)\s*([0-9\-\.,]+)', '\g<1>\g<2>', bookings_data, flags = re.DOTALL | re.MULTILINE)
-
-
-        for line in bookings_data.splitlines(True):
-            btentry = re.search('<td headers="bTentry".*?>([0-9\.]+)</td>', line)
-            if (btentry):
-                # first write entry with existing data
-                if (date_of_bookkeeping is not None):
-                    t = {}
-                    t['date_of_bookkeeping'] = date_of_bookkeeping
-                    t['date_of_value'] = date_of_value
-                    t['intended_use'] = intended_use
-                    t['intended_use2'] = intended_use2
-                    t['iban'] = iban
-                    t['bic'] = bic
-                    t['customer_reference'] = customer_reference
-                    t['mandate_reference'] = mandate_reference
-                    t['creditor_id'] = creditor_id
-                    t['amount'] = amount
-                    t['currency'] = currency
-                    if (amount is None or currency is None):
-                        logging.error("Could not extract currency or amount!")
-                        sys.exit(1)
-                    account_data['bookings'].append(t)
-                    #print("date_of_bookkeeping: " + str(date_of_bookkeeping))
-                    #print("date_of_value: " + str(date_of_value))
-                    #print("intended_use: " + str(intended_use))
-                    #print("intended_use2: " + str(intended_use2))
-                    #print("iban: " + str(iban))
-                    #print("bic: " + str(bic))
-                    #print("amount: " + str(amount))
-                    #print("currency: " + str(currency))
-                    #print("customer_reference: " + str(customer_reference))
-                    #print("mandate_reference: " + str(mandate_reference))
-                    #print("creditor_id: " + str(creditor_id))
-                    #print("")
-                    #print("")
-                    #print("")
-                    logging.debug("Found booking entry: " + str(date_of_bookkeeping) + '/' + str(date_of_value) + ': ' + str(amount) + ' ' + str(currency) + ' (' + str(intended_use) + ')')
-                    #sys.exit(0)
-                # then reset everything
-                date_of_bookkeeping = None
-                date_of_value = None
-                intended_use = None
-                intended_use2 = ''
-                iban = ''
-                bic = ''
-                customer_reference = ''
-                mandate_reference = ''
-                creditor_id = ''
-                amount = None
-                currency = None
-                # now get the date
-                date_of_bookkeeping = btentry.group(1)
-
-            btvalue = re.search('<td headers="bTvalue".*?>([0-9\.]+)</td>', line)
-            if (btvalue):
-                date_of_value = btvalue.group(1)
-
-            btpurpose = re.search('<td headers="bTpurpose".*?>(.*?)</td>', line, re.DOTALL)
-            if (btpurpose):
-                intended_use = htmlescape.unescape(btpurpose.group(1).strip())
-
-            btdebit = re.search('<td headers="bTdebit".*?>\s*([0-9\.\-,]+)\s*</td>', line)
-            if (btdebit):
-                amount = fix_punctation(btdebit.group(1))
-
-            btcredit = re.search('<td headers="bTcredit".*?>\s*([0-9\.\-,]+)\s*</td>', line)
-            if (btcredit):
-                amount = btcredit.group(1)
-
-            btcurrency = re.search('<td headers="bTcurrency".*?>(.*?)</td>', line)
-            if (btcurrency):
-                currency = btcurrency.group(1).strip()
-
-            btintended_use2 = re.search('<td.*?>Verwendungszweck</td><td.*?>(.+?)<\/td>', line)
-            if (btintended_use2):
-                intended_use2 = htmlescape.unescape(btintended_use2.group(1).strip())
-
-            btiban = re.search('<td.*?>IBAN</td><td.*?>(.+?)<\/td>', line)
-            if (btiban):
-                iban = btiban.group(1).strip()
-
-            btbic = re.search('<td.*?>BIC</td><td.*?>(.+?)<\/td>', line)
-            if (btbic):
-                bic = btbic.group(1).strip()
-
-            btcustomer_reference = re.search('<td.*?>Kundenreferenz</td><td.*?>(.+?)<\/td>', line)
-            if (btcustomer_reference):
-                customer_reference = btcustomer_reference.group(1).strip()
-
-            btmandate_reference = re.search('<td.*?>Mandatsreferenz</td><td.*?>(.+?)<\/td>', line)
-            if (btmandate_reference):
-                mandate_reference = btmandate_reference.group(1).strip()
-
-            btcreditor_id = re.search('<td.*?>Gl.*?ubiger ID</td><td.*?>(.+?)<\/td>', line)
-            if (btcreditor_id):
-                creditor_id = btcreditor_id.group(1).strip()
+    account_data['bookings'] = None
+    account_data['fingerprint'] = None
+    account_data['unchanged'] = False
+
+    # the lines before the header contain the date range, they are not part of the fingerprint
+    reader = csv.reader(lines, delimiter = ';')
+    columns = None
+    for row in reader:
+        if (len(row) == 0):
+            continue
+        first = row[0].lstrip('\ufeff').strip()
+        if (first == 'Buchungstag'):
+            columns = {}
+            for position, name in enumerate(row):
+                columns[name.strip()] = position
+            for check in ['Wert', 'Umsatzart', 'Verwendungszweck', 'IBAN', 'BIC', 'Soll', 'Haben', 'W\u00e4hrung']:
+                if (check not in columns):
+                    logging.error("Missing column '" + check + "' in CSV export")
+                    sys.exit(1)
+            break
+        if (first.startswith('<')):
+            # HTML content, the export is not available
+            return None
 
-    else:
-        logging.error("")
-        logging.error("Missing bookings in retrieved data")
-        sys.exit(1)
+    if (columns is None):
+        return None
 
+    # the rest of the file is read by the generators
+    rows = csv_booking_rows(reader, account_data, previous_fingerprint)
+    account_data['bookings'] = BookingStream(csv_bookings(rows, columns))
 
-    current_amount = re.search('>Aktueller Kontostand<.+?class="balance credit"><strong>\s*([0-9,\.\-]+)\s*<\/strong>', req_data, re.DOTALL | re.MULTILINE)
-    if (current_amount):
-        #print(fix_punctation(current_amount.group(1)))
-        account_data['bank_balance'] = str(fix_punctation(current_amount.group(1)))
-    else:
-        logging.error("")
-        logging.error("Missing current amount in retrieved data")
-        sys.exit(1)
+    return account_data
 
 
-    current_amount_currency = re.search('>Aktueller Kontostand<.+?class="balance credit">.+?<\/strong>.+?<strong.*?><acronym.*?>(.+?)<\/acronym', req_data, re.DOTALL | re.MULTILINE)
-    if (current_amount_currency):
-        account_data['bank_balance_currency'] = str(current_amount_currency.group(1))
-    else:
-        logging.error("")
-        logging.error("Missing current amount currency in retrieved data")
-        sys.exit(1)
 
+# csv_booking_rows()
+#
+# return the rows with bookings from the CSV export, after the header line
+# the balance, the fingerprint and 'unchanged' are set once all rows are read
+#
+# parameter:
+#  - CSV reader
+#  - dictionary with account data
+#  - fingerprint of the previous result (optional)
+# return:
+#  - generator with rows
+def csv_booking_rows(reader, account_data, previous_fingerprint = None):
+    fingerprint = hashlib.sha256()
+    for row in reader:
+        if (len(row) == 0):
+            continue
+        first = row[0].strip()
+
+        if (first == 'Kontostand'):
+            # the balance is the last amount in the line, followed by the currency
+            values = [value.strip() for value in row[1:] if len(value.strip()) > 0]
+            if (len(values) >= 2):
+                account_data['bank_balance'] = str(fix_punctation(values[-2]))
+                account_data['bank_balance_currency'] = values[-1]
+            continue
+
+        if (re.match(r'[0-9]{2}\.[0-9]{2}\.[0-9]{4}$', first) is None):
+            continue
+
+        fingerprint.update((';'.join(row) + "\n").encode('utf-8'))
+        yield row
 
     if (account_data['bank_balance'] is None or account_data['bank_balance_currency'] is None):
         logging.error("Could not extract current balance or currency")
@@ -1248,8 +4859,48 @@ def retrieve_bank_account_data(account, session):
 
     logging.debug("Current account balance: " + str(account_data['bank_balance']) + " " + str(account_data['bank_balance_currency']))
 
-    #sys.exit(0)
-    return account_data
+    fingerprint.update(("\n" + account_data['bank_balance'] + " " + account_data['bank_balance_currency']).encode('utf-8'))
+    account_data['fingerprint'] = fingerprint.hexdigest()
+    if (account_data['fingerprint'] == previous_fingerprint):
+        logging.debug("Bookings are unchanged")
+        account_data['unchanged'] = True
+
+
+
+# csv_bookings()
+#
+# create the bookings from the rows of the CSV export, while they are saved
+#
+# parameter:
+#  - iterable with rows
+#  - dictionary with column positions
+# return:
+#  - generator with booking objects
+def csv_bookings(rows, columns):
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    for row in rows:
+        if (len(csv_column(row, columns, 'Soll')) > 0):
+            amount = fix_punctation(csv_column(row, columns, 'Soll'))
+        else:
+            amount = fix_punctation(csv_column(row, columns, 'Haben'))
+        booking = Booking(row[0].strip(),
+                          csv_column(row, columns, 'Wert'),
+                          (csv_column(row, columns, 'Umsatzart') + ' ' + csv_column(row, columns, 'Beg\u00fcnstigter / Auftraggeber')).strip(),
+                          csv_column(row, columns, 'Verwendungszweck'),
+                          csv_column(row, columns, 'IBAN'),
+                          csv_column(row, columns, 'BIC'),
+                          csv_column(row, columns, 'Kundenreferenz'),
+                          csv_column(row, columns, 'Mandatsreferenz'),
+                          csv_column(row, columns, 'Gl\u00e4ubiger ID'),
+                          amount,
+                          csv_column(row, columns, 'W\u00e4hrung'))
+        if (len(booking.amount) == 0 or len(booking.currency) == 0):
+            logging.error("Could not extract currency or amount!")
+            sys.exit(1)
+        if (debug is True):
+            logging.debug("Found booking entry: %s/%s: %s %s (%s)", booking.date_of_bookkeeping, booking.date_of_value,
+                          booking.amount, booking.currency, booking.intended_use)
+        yield booking
 
 
 
@@ -1276,28 +4927,119 @@ def fix_punctation(amount):
 # return:
 #  - HTML content
 def remove_cookie_consent_box(content):
-    content = re.sub(r'<div id="cookieConsentBox">.+?<form.*?</form>.*?</div>.*?</div>', '', content, flags=re.DOTALL)
+    # same as removing '<div id="cookieConsentBox">.+?<form.*?</form>.*?</div>.*?</div>',
+    # but every search continues at the previous offset, which keeps this linear
+    result = []
+    position = 0
+    while True:
+        start = content.find('<div id="cookieConsentBox">', position)
+        if (start == -1):
+            break
+        end = start + len('<div id="cookieConsentBox">') + 1
+        for marker in ['<form', '</form>', '</div>', '</div>']:
+            end = content.find(marker, end)
+            if (end == -1):
+                break
+            end += len(marker)
+        if (end == -1):
+            break
+        result.append(content[position:start])
+        position = end
+    result.append(content[position:])
 
-    return content
+    return ''.join(result)
 
 
 
-#######################################################################
-# main program
+# find_tag_starts()
+#
+# find the offsets of all opening tags of a type
+#
+# parameter:
+#  - HTML content
+#  - tag name
+# return:
+#  - list with offsets
+def find_tag_starts(content, tag):
+    starts = []
+    open_tag = '<' + tag
+    position = 0
+    while True:
+        start = content.find(open_tag, position)
+        if (start == -1):
+            break
+        position = start + len(open_tag)
+        # '<a' must not match '<abbr'
+        if (content[position:position + 1] in [' ', '\t', '\r', '\n', '>', '/']):
+            starts.append(start)
 
-config = Config()
-config.parse_parameters()
-config.load_config()
+    return starts
+
+
+
+# find_tag_blocks()
+#
+# find all '<tag ...>...</tag>' blocks in one linear pass
+# blocks are not nested, a block ends at the first closing tag
+#
+# parameter:
+#  - HTML content
+#  - tag name
+# return:
+#  - list with (start, end) offsets
+def find_tag_blocks(content, tag):
+    blocks = []
+    close_tag = '</' + tag + '>'
+    position = 0
+    for start in find_tag_starts(content, tag):
+        if (start < position):
+            # opening tag inside the previous block
+            continue
+        end = content.find(close_tag, start)
+        if (end == -1):
+            # no more closing tags, searching again for every opening tag would be quadratic
+            break
+        position = end + len(close_tag)
+        blocks.append((start, position))
+
+    return blocks
+
+
+
+# html_opening_tag()
+#
+# return the opening tag which starts at an offset
+#
+# parameter:
+#  - HTML content
+#  - offset of the tag
+# return:
+#  - opening tag, including '<' and '>'
+def html_opening_tag(content, start):
+    end = content.find('>', start)
+    if (start == -1 or end == -1):
+        return ''
+
+    return content[start:end + 1]
 
-database = Database(config)
 
-logging.debug("urllib version: " + str(_urllib_version))
-# loop over the accounts in the config file
-for account in config.configfile['accounts']:
-    if (config.configfile['accounts'][account]['enabled'] != True):
-        logging.debug("Account '" + str(account) + "' is disabled in config")
-        continue
 
+# process_account()
+#
+# retrieve the data for one account, store it in the database and send the notification
+# every run is logged in the 'bank_access_logs' table
+#
+# parameter:
+#  - config object
+#  - database object
+#  - account name (from config file)
+#  - requests session
+#  - mailer object
+# return:
+#  none
+def process_account(config, database, account, session, mailer):
+    log_context['account'] = account
+    log_context['phase'] = None
     logging.info("Account: " + str(account))
     logging.debug("Information recipient: " + str(config.configfile['accounts'][account]['recipients']))
     account_id = database.get_account_id(account,
@@ -1305,23 +5047,168 @@ for account in config.configfile['accounts']:
                                          config.configfile['accounts'][account]['sub_account'],
                                          config.configfile['accounts'][account]['branch_code'])
     logging.debug("Database id for account is: " + str(account_id))
-    session = requests.session()
-    account_data = retrieve_bank_account_data(config.configfile['accounts'][account], session)
 
-    database.save_account_amount(account_id, account_data['bank_balance'], account_data['bank_balance_currency'])
-    database.save_account_transactions(account_id, account_data['bookings'])
+    telemetry = RunTelemetry()
+    try:
+        if (use_stored_data(config, database, account, account_id) is True):
+            # no login, the notification is built from the database
+            start = time.time()
+            alerts = database.check_recurring_payments(account_id)
+            unseen = (database.last_statement_id(account_id) or 0) > (database.last_seen_statement(account_id) or 0)
+            if (config.arguments.report_only is False and unseen is False and len(alerts) == 0):
+                logging.info("Stored data is recent, and has no new transactions, account: " + str(account))
+                telemetry.db_time += time.time() - start
+                telemetry.outcome = 'stored'
+                return
+        else:
+            # the session is shared between accounts and runs (connection pool),
+            # but every login starts without cookies
+            session.cookies.clear()
+            account_data = retrieve_bank_account_data(config.configfile['accounts'][account], session,
+                                                      database.turnovers_fingerprint(account_id), telemetry)
+
+            start = time.time()
+            log_context['phase'] = 'save'
+            # the bookings are parsed while they are saved, afterwards the balance (the CSV
+            # export has it at the end) is known, and if the bookings are unchanged
+            new_statements = database.save_account_transactions(account_id, account_data,
+                                                                 config.configfile['accounts'][account]['budgets'])
+            database.save_account_amount(account_id, account_data['bank_balance'], account_data['bank_balance_currency'],
+                                         config.configfile['accounts'][account]['min_balance'])
+            telemetry.bookings_parsed = account_data['bookings'].count
+            if (account_data['unchanged'] is True):
+                database.save_fetch_statistics(account_id, datetime.datetime.now(), False)
+                # same bookings and balance as in the last run, only an overdue recurring payment is reported
+                alerts = database.check_recurring_payments(account_id)
+                if (len(alerts) == 0):
+                    logging.info("No changes for account: " + str(account))
+                    telemetry.db_time += time.time() - start
+                    telemetry.outcome = 'unchanged'
+                    return
+            else:
+                database.save_turnovers_fingerprint(account_id, account_data['fingerprint'])
+                telemetry.bookings_inserted = len(new_statements)
+                database.save_fetch_statistics(account_id, datetime.datetime.now(), len(new_statements) > 0)
+                database.score_statements(account_id, new_statements, config.configfile['anomalies'],
+                                          config.configfile['anomalies']['enabled'])
+                alerts = database.update_recurring_payments(account_id, new_statements)
+                alerts += database.check_recurring_payments(account_id)
+
+        message = build_notification(database, account_id)
+        if (message is not None and len(alerts) > 0):
+            message += format_recurring_alerts(alerts)
+        if (message is not None and config.configfile['accounts'][account]['analysis'] is True):
+            if (numpy is None):
+                logging.error("'analysis' requires NumPy, account: " + str(account))
+            else:
+                analysis = analyze_account(database, account_id)
+                if (analysis is not None):
+                    message += "\n" + format_analysis(account, analysis, last_months = 12)
+        telemetry.db_time += time.time() - start
+        if (message is None):
+            telemetry.outcome = 'no data'
+            return
+
+        start = time.time()
+        log_context['phase'] = 'notify'
+        send_notification(config, account, mailer, message)
+        telemetry.smtp_time += time.time() - start
+        telemetry.outcome = 'ok'
+    except BaseException:
+        telemetry.outcome = 'error'
+        raise
+    finally:
+        telemetry.finish()
+        database.save_access_log(account_id, telemetry)
+        logging.debug("Account processed: %s", telemetry.outcome, extra = {'phase': None, 'duration': telemetry.duration})
+
+
+
+# use_stored_data()
+#
+# decide if the notification for an account is built from the database, without logging in
+# this is the case with --report-only, if the last fetch is more recent than 'fetch_interval',
+# or if the fetch statistics say that new bookings are unlikely (adaptive fetching)
+#
+# parameter:
+#  - config object
+#  - database object
+#  - account name (from config file)
+#  - account ID
+# return:
+#  - True/False
+def use_stored_data(config, database, account, account_id):
+    if (config.arguments.report_only is True):
+        return True
+    age = database.minutes_since_last_fetch(account_id)
+    if (age is None):
+        return False
+    fetch_interval = config.configfile['accounts'][account]['fetch_interval']
+    if (age < fetch_interval):
+        logging.debug("Last fetch is " + str(int(age)) + " minutes old, account: " + str(account))
+        return True
+
+    # skip accounts which rarely have new bookings at this time, unless the data is too old
+    adaptive = config.configfile['adaptive']
+    if (adaptive['enabled'] is True and age < adaptive['max_staleness']):
+        probability = database.fetch_probability(account_id, datetime.datetime.now(), adaptive['min_samples'])
+        if (probability is not None and probability < adaptive['min_probability']):
+            logging.info("New bookings are unlikely (" + str(round(probability * 100, 1)) + "%), skip fetch, account: " + str(account))
+            return True
+
+    return False
+
+
+
+# build_notification()
+#
+# build the notification with the current balance and all unseen transactions
+# this moves the "unseen" pointer
+#
+# parameter:
+#  - database object
+#  - account ID
+# return:
+#  - message, or None if there is no data for the account
+def build_notification(database, account_id):
     message = '' + "\n"
     message += '' + "\n"
     last_account_balance = database.last_account_balance(account_id)
-    if (len(last_account_balance) == 0):
+    if (last_account_balance is None):
         # no data at all
-        continue
+        return None
+    unseen_data = database.unseen_transactions(account_id)
+
+    # flagged transactions are shown first
+    flagged = [line for line in unseen_data if line['anomaly'] is not None]
+    if (len(flagged) > 0):
+        reasons = {'amount': 'ungewöhnlich hoher Betrag', 'duplicate': 'doppelte Abbuchung', 'new_payee': 'neuer Empfänger'}
+        message += 'Auffällige Buchungen:' + "\n"
+        for line in flagged:
+            message += '   ' + str(line['date_of_bookkeeping']) + ': ' + str(line['amount']) + ' ' + str(line['currency']) + \
+                       ', ' + str(line['intended_use']) + ' (' + ', '.join([reasons.get(reason, reason) for reason in line['anomaly'].split(',')]) + ')' + "\n"
+        message += '' + "\n"
+        message += '' + "\n"
+
+    # crossed balance thresholds and budgets
+    threshold_alerts = database.unreported_threshold_alerts(account_id)
+    if (len(threshold_alerts) > 0):
+        message += 'Grenzwerte:' + "\n"
+        for alert in threshold_alerts:
+            if (alert['type'] == 'balance'):
+                message += '   Kontostand unter ' + ('%.2f' % alert['threshold']) + ': ' + ('%.2f' % alert['value']) + ' ' + str(alert['currency']) + "\n"
+            else:
+                name = alert['category'] if (len(alert['category']) > 0) else 'alle Abbuchungen'
+                message += '   Budget ' + name + ' (' + str(alert['month']) + '): ' + ('%.2f' % alert['value']) + ' von ' + \
+                           ('%.2f' % alert['threshold']) + ' ' + str(alert['currency']) + "\n"
+        message += '' + "\n"
+        message += '' + "\n"
+
     message += 'Datum: ' + last_account_balance['added_ts'] + "\n"
     message += 'Kontostand: ' + str(last_account_balance['account_balance']) + ' ' + last_account_balance['account_balance_currency'] + "\n"
     message += '' + "\n"
     message += '' + "\n"
 
-    unseen_data = database.unseen_transactions(account_id)
     for line in unseen_data:
         message += '            Betrag: ' + str(line['amount']) + ' ' + str(line['currency']) + "\n"
         message += '     Buchungsdatum: ' + str(line['date_of_bookkeeping']) + "\n"
@@ -1332,8 +5219,49 @@ for account in config.configfile['accounts']:
         message += '' + "\n"
         message += '' + "\n"
 
+    return message
+
+
+
+# format_recurring_alerts()
+#
+# format missing or unusual recurring payments for the notification
+#
+# parameter:
+#  - list with alerts
+# return:
+#  - text
+def format_recurring_alerts(alerts):
+    message = 'Wiederkehrende Zahlungen:' + "\n"
+    for alert in alerts:
+        payee = alert['creditor_id'] if (len(alert['creditor_id']) > 0) else alert['iban']
+        if (len(alert['mandate_reference']) > 0):
+            payee += ' (Mandat: ' + alert['mandate_reference'] + ')'
+        if (alert['type'] == 'missing'):
+            message += '   Fehlt: ' + payee + ', erwartet am ' + str(alert['date']) + ': ' + \
+                       str(alert['expected_amount']) + ' ' + str(alert['currency']) + "\n"
+        else:
+            message += '   Abweichung: ' + payee + ', am ' + str(alert['date']) + ': ' + str(alert['amount']) + \
+                       ' statt ' + str(alert['expected_amount']) + ' ' + str(alert['currency']) + "\n"
+    message += '' + "\n"
+
+    return message
+
+
+
+# send_notification()
+#
+# send the notification email for an account
+#
+# parameter:
+#  - config object
+#  - account name (from config file)
+#  - mailer object
+#  - message
+# return:
+#  none
+def send_notification(config, account, mailer, message):
     try:
-        email = smtplib.SMTP('localhost')
         msg = MIMEText(message, 'plain', 'utf8')
         #msg.set_charset('utf8')
         msg['Subject'] = 'Konto Informationen: %s (%s/%s/%s)' % (str(account),
@@ -1341,11 +5269,644 @@ for account in config.configfile['accounts']:
                                                                  str(config.configfile['accounts'][account]['account_number']),
                                                                  str(config.configfile['accounts'][account]['sub_account']))
         msg['To'] = str(config.configfile['accounts'][account]['recipients'])
-        msg['From'] = str(config.configfile['sender_address'])
-        email.sendmail(str(config.configfile['sender_address']), str(config.configfile['accounts'][account]['recipients']).split(','), msg.as_string())
-        email.quit()
+        msg['From'] = str(config.configfile['accounts'][account]['sender_address'])
+        mailer.send(str(config.configfile['accounts'][account]['sender_address']), str(config.configfile['accounts'][account]['recipients']).split(','), msg.as_string())
     except smtplib.SMTPServerDisconnected:
         logging.error("Unable to send email!")
         sys.exit(1)
     #print(message)
 
+
+
+# percentile()
+#
+# return a percentile from a sorted list (nearest rank)
+#
+# parameter:
+#  - sorted list with values
+#  - percentile (0 - 100)
+# return:
+#  - value, or None for an empty list
+def percentile(values, p):
+    if (len(values) == 0):
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+
+# show_statistics()
+#
+# print percentiles and weekly trends from the 'bank_access_logs' table
+#
+# parameter:
+#  - database object
+#  - number of days to include
+# return:
+#  none
+def show_statistics(database, days):
+    logs = database.access_logs(days)
+    if (len(logs) == 0):
+        print("No runs in the last " + str(days) + " days")
+        return
+
+    accounts = collections.OrderedDict()
+    for row in logs:
+        accounts.setdefault(row['name'], []).append(row)
+
+    for account in accounts:
+        rows = accounts[account]
+        outcomes = collections.Counter([row['outcome'] for row in rows])
+        print("")
+        print("Account: " + str(account) + " (" + str(len(rows)) + " runs in the last " + str(days) + " days: " +
+              ', '.join([str(outcomes[outcome]) + " " + outcome for outcome in sorted(outcomes)]) + ")")
+        print("%-24s %10s %10s %10s %10s" % ('', 'p50', 'p90', 'p99', 'max'))
+
+        series = collections.OrderedDict()
+        series['duration (s)'] = [row['duration'] for row in rows]
+        series['http time (s)'] = [row['http_time'] for row in rows]
+        steps = collections.OrderedDict()
+        for row in rows:
+            for step in json.loads(row['http_steps']):
+                steps.setdefault(step['step'], {'duration': [], 'bytes': []})
+                steps[step['step']]['duration'].append(step['duration'])
+                steps[step['step']]['bytes'].append(step['bytes'])
+        for step in steps:
+            series['  ' + str(step) + ' (s)'] = steps[step]['duration']
+            series['  ' + str(step) + ' (KB)'] = [size / 1024.0 for size in steps[step]['bytes']]
+        series['db time (s)'] = [row['db_time'] for row in rows]
+        series['smtp time (s)'] = [row['smtp_time'] for row in rows]
+        series['bookings parsed'] = [row['bookings_parsed'] for row in rows]
+        series['bookings inserted'] = [row['bookings_inserted'] for row in rows]
+        series['bookings skipped'] = [row['bookings_skipped'] for row in rows]
+        for name in series:
+            values = sorted([value for value in series[name] if value is not None])
+            if (len(values) == 0):
+                continue
+            print("%-24s %10.2f %10.2f %10.2f %10.2f" % (name, percentile(values, 50), percentile(values, 90),
+                                                          percentile(values, 99), values[-1]))
+
+        # trend: median per week
+        weeks = collections.OrderedDict()
+        for row in rows:
+            weeks.setdefault(row['week'], []).append(row)
+        print("")
+        print("%-10s %6s %14s %14s %14s" % ('week', 'runs', 'duration p50', 'http p50', 'bookings p50'))
+        for week in weeks:
+            durations = sorted([row['duration'] for row in weeks[week]])
+            http_times = sorted([row['http_time'] for row in weeks[week]])
+            bookings = sorted([row['bookings_parsed'] for row in weeks[week]])
+            print("%-10s %6d %14.2f %14.2f %14d" % (week, len(weeks[week]), percentile(durations, 50),
+                                                    percentile(http_times, 50), percentile(bookings, 50)))
+
+
+
+# analyze_account()
+#
+# analyze the full statement history of an account, all calculations are done on NumPy arrays
+#
+# parameter:
+#  - database object
+#  - account ID
+#  - number of top counterparties (optional)
+# return:
+#  - dictionary with 'currency', 'statements', 'monthly', 'top_counterparties' and 'balance_percentiles',
+#    or None if the account has no statements
+def analyze_account(database, account_id, top = 10):
+    days, amounts, counterparties, balances, currency = database.statement_history(account_id)
+    if (len(days) == 0):
+        return None
+    days = numpy.array(days, dtype = numpy.int64)
+    amounts = numpy.array(amounts, dtype = numpy.float64)
+    counterparties = numpy.array(counterparties, dtype = numpy.int64)
+    # missing running balances become NaN
+    balances = numpy.array(balances, dtype = numpy.float64)
+
+    # months as consecutive numbers, months without statements are included
+    month_numbers = (days // 10000) * 12 + (days // 100) % 100 - 1
+    first_month = month_numbers.min()
+    month_index = month_numbers - first_month
+    month_count = int(month_index.max()) + 1
+    incoming = numpy.bincount(month_index, weights = numpy.where(amounts > 0, amounts, 0.0), minlength = month_count)
+    outgoing = numpy.bincount(month_index, weights = numpy.where(amounts < 0, amounts, 0.0), minlength = month_count)
+    net = incoming + outgoing
+    # rolling averages over the net amount, from the cumulative sum
+    cumulative = numpy.concatenate(([0.0], numpy.cumsum(net)))
+    rolling = {}
+    for window in [3, 12]:
+        average = numpy.full(month_count, numpy.nan)
+        if (month_count >= window):
+            average[window - 1:] = (cumulative[window:] - cumulative[:-window]) / window
+        rolling[window] = average
+    months = numpy.arange(first_month, first_month + month_count)
+    monthly = {'month': ['%04d-%02d' % (month // 12, month % 12 + 1) for month in months.tolist()],
+               'incoming': incoming, 'outgoing': outgoing, 'net': net,
+               'average_3': rolling[3], 'average_12': rolling[12]}
+
+    # top counterparties by outgoing amount, without the empty counterparty (card payments, cash)
+    unique_counterparties, counterparty_index = numpy.unique(counterparties, return_inverse = True)
+    spent = numpy.bincount(counterparty_index, weights = numpy.where(amounts < 0, -amounts, 0.0))
+    received = numpy.bincount(counterparty_index, weights = numpy.where(amounts > 0, amounts, 0.0))
+    statements = numpy.bincount(counterparty_index)
+    details = database.counterparty_details(unique_counterparties.tolist())
+    named = numpy.array([details[counterparty]['iban'] != '' or details[counterparty]['creditor_id'] != ''
+                         for counterparty in unique_counterparties.tolist()], dtype = bool)
+    order = numpy.argsort(-numpy.where(named, spent, -1.0), kind = 'stable')[:top]
+    top_counterparties = []
+    for index in order.tolist():
+        if (named[index] == False or spent[index] == 0):
+            continue
+        counterparty = details[int(unique_counterparties[index])]
+        top_counterparties.append({'iban': counterparty['iban'], 'creditor_id': counterparty['creditor_id'],
+                                   'statements': int(statements[index]), 'outgoing': float(spent[index]),
+                                   'incoming': float(received[index])})
+
+    # balance percentiles, from the running balance
+    balance_percentiles = {}
+    if (numpy.isnan(balances).all() == False):
+        for p, value in zip([0, 5, 25, 50, 75, 95, 100], numpy.nanpercentile(balances, [0, 5, 25, 50, 75, 95, 100]).tolist()):
+            balance_percentiles[p] = value
+
+    return {'currency': currency, 'statements': len(days), 'monthly': monthly,
+            'top_counterparties': top_counterparties, 'balance_percentiles': balance_percentiles}
+
+
+
+# format_analysis()
+#
+# format the result of analyze_account() as text or CSV
+#
+# parameter:
+#  - account name
+#  - analysis result
+#  - format: 'text' or 'csv'
+#  - include the CSV header (optional)
+#  - only show the last months in the text report (optional)
+# return:
+#  - report
+def format_analysis(account, analysis, output_format = 'text', header = True, last_months = None):
+    monthly = analysis['monthly']
+
+    if (output_format == 'csv'):
+        output = StringIO()
+        writer = csv.writer(output)
+        if (header is True):
+            writer.writerow(['account', 'section', 'key', 'incoming', 'outgoing', 'net', 'average_3', 'average_12', 'statements'])
+        for i in range(len(monthly['month'])):
+            writer.writerow([account, 'month', monthly['month'][i], '%.2f' % monthly['incoming'][i], '%.2f' % monthly['outgoing'][i],
+                             '%.2f' % monthly['net'][i], '' if numpy.isnan(monthly['average_3'][i]) else '%.2f' % monthly['average_3'][i],
+                             '' if numpy.isnan(monthly['average_12'][i]) else '%.2f' % monthly['average_12'][i], ''])
+        for counterparty in analysis['top_counterparties']:
+            writer.writerow([account, 'counterparty', counterparty['iban'] or counterparty['creditor_id'],
+                             '%.2f' % counterparty['incoming'], '%.2f' % -counterparty['outgoing'], '', '', '', counterparty['statements']])
+        for p in analysis['balance_percentiles']:
+            writer.writerow([account, 'balance_percentile', p, '', '', '%.2f' % analysis['balance_percentiles'][p], '', '', ''])
+        return output.getvalue()
+
+    currency = str(analysis['currency'])
+    lines = []
+    lines.append('Analyse: ' + str(account) + ' (' + str(analysis['statements']) + ' Buchungen)')
+    lines.append('')
+    lines.append('%-8s %14s %14s %14s %14s %14s' % ('Monat', 'Eingang', 'Ausgang', 'Saldo', 'Schnitt 3M', 'Schnitt 12M'))
+    first = 0 if (last_months is None) else max(len(monthly['month']) - last_months, 0)
+    for i in range(first, len(monthly['month'])):
+        lines.append('%-8s %14.2f %14.2f %14.2f %14s %14s' % (monthly['month'][i], monthly['incoming'][i], monthly['outgoing'][i], monthly['net'][i],
+                                                           '' if numpy.isnan(monthly['average_3'][i]) else '%.2f' % monthly['average_3'][i],
+                                                           '' if numpy.isnan(monthly['average_12'][i]) else '%.2f' % monthly['average_12'][i]))
+    if (len(analysis['top_counterparties']) > 0):
+        lines.append('')
+        lines.append('Top Empfaenger (' + currency + '):')
+        for counterparty in analysis['top_counterparties']:
+            lines.append('  %-34s %14.2f %6d Buchungen' % (counterparty['iban'] or counterparty['creditor_id'],
+                                                          -counterparty['outgoing'], counterparty['statements']))
+    if (len(analysis['balance_percentiles']) > 0):
+        lines.append('')
+        lines.append('Kontostand (' + currency + '): ' +
+                     ', '.join(['p' + str(p) + ': %.2f' % analysis['balance_percentiles'][p] for p in analysis['balance_percentiles']]))
+
+    return "\n".join(lines) + "\n"
+
+
+
+# account_database()
+#
+# return the database for an account, every database file is opened once
+#
+# parameter:
+#  - config object
+#  - dictionary with the open databases (database file -> database object)
+#  - account name (from config file)
+# return:
+#  - database object
+def account_database(config, databases, account):
+    database_file = config.configfile['accounts'][account]['database_file']
+    if (database_file not in databases):
+        logging.debug("Database for account '" + str(account) + "': " + database_file)
+        databases[database_file] = Database(config, database_file)
+
+    return databases[database_file]
+
+
+
+# report_database()
+#
+# open the database files of all accounts read only, for reports over all accounts
+# the first file is opened, the other files are attached to the same connection
+#
+# parameter:
+#  - config object
+# return:
+#  - database object
+def report_database(config):
+    database_files = config.database_files(existing = True)
+    if (len(database_files) == 0):
+        logging.error("Database does not exist: " + ", ".join(config.database_files()))
+        sys.exit(1)
+
+    return Database(config, database_files[0], read_only = True, attach = database_files[1:])
+
+
+
+# tail_change_log()
+#
+# print the change log as JSON lines, over a read only connection
+# every database file has its own sequence numbers, each line names its file
+#
+# parameter:
+#  - config object
+#  - first sequence number per database file name (None: the only file)
+#  - True: keep waiting for new entries
+# return:
+#  none
+def tail_change_log(config, first_seq, follow):
+    database = report_database(config)
+    # the files with 'shard' are all in one directory, the file name is unique
+    names = dict([(schema, os.path.basename(database.schemas[schema])) for schema in database.schemas])
+    if (None in first_seq and len(names) > 1):
+        logging.error("Every database file has its own sequence numbers, use --from <database>:<seq>,... (" + ", ".join(names.values()) + ")")
+        sys.exit(1)
+    unknown = [str(name) for name in first_seq if (name is not None and name not in names.values())]
+    if (len(unknown) > 0):
+        logging.error("Unknown database file in --from: " + ", ".join(unknown) + " (" + ", ".join(names.values()) + ")")
+        sys.exit(1)
+    # a database file without a cursor (e.g. a new shard) starts at the beginning
+    next_seq = dict([(schema, first_seq.get(names[schema], first_seq.get(None, 0))) for schema in database.schemas])
+    while True:
+        for schema in database.schemas:
+            for entry in database.change_log_entries(next_seq[schema], schema):
+                # the payload is already JSON
+                sys.stdout.write('{"database": ' + json.dumps(names[schema]) + ', "seq": ' + str(entry['seq']) +
+                                 ', "ts": ' + json.dumps(entry['added_ts']) +
+                                 ', "account": ' + json.dumps(entry['account']) + ', "type": ' + json.dumps(entry['type']) +
+                                 ', "data": ' + entry['payload'] + "}\n")
+                next_seq[schema] = entry['seq'] + 1
+        sys.stdout.flush()
+        if (follow is False):
+            return
+        # wait until another connection writes to the database
+        data_version = database.data_version()
+        while (database.data_version() == data_version):
+            time.sleep(1)
+
+
+
+# run_account()
+#
+# process one account, errors are contained and do not stop the other accounts
+# most errors are already logged and end with sys.exit(), this is caught here as well
+#
+# parameter:
+#  - config object
+#  - database object
+#  - account name (from config file)
+#  - requests session
+#  - mailer object
+# return:
+#  - True if the account was processed, False if it failed
+def run_account(config, database, account, session, mailer):
+    try:
+        process_account(config, database, account, session, mailer)
+    except (SystemExit, Exception) as e:
+        # the phase is still set from the step which failed
+        phase = log_context['phase']
+        if (not isinstance(e, SystemExit)):
+            logging.exception("Unexpected error")
+        logging.error("Processing account '" + str(account) + "' failed" + ("" if phase is None else " (" + str(phase) + ")"))
+        # an error before the access log is saved can leave an open transaction behind
+        database.connection.rollback()
+        database.save_run_state(account, 'failed', phase)
+        return False
+    finally:
+        log_context['account'] = None
+        log_context['phase'] = None
+    database.save_run_state(account, 'ok')
+
+    return True
+
+
+
+# run_daemon()
+#
+# keep running, and process every account according to its schedule
+# the database connections and the HTTP connection pool stay open between runs
+# SIGHUP reloads the config file, SIGTERM and SIGINT stop the daemon
+#
+# parameter:
+#  - config object
+#  - dictionary with the open databases (database file -> database object)
+# return:
+#  none
+def run_daemon(config, databases):
+    signals = {'reload': False, 'stop': False}
+
+    def handle_sighup(signum, frame):
+        signals['reload'] = True
+
+    def handle_stop(signum, frame):
+        signals['stop'] = True
+
+    signal.signal(signal.SIGHUP, handle_sighup)
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+
+    session = requests.session()
+    mailer = Mailer()
+    scheduler = Scheduler(config.configfile['daemon']['jitter'])
+    scheduler.load(config.configfile['accounts'])
+    logging.info("Daemon started, " + str(len(scheduler)) + " account(s) scheduled")
+
+    while (signals['stop'] is False):
+        if (signals['reload'] is True):
+            signals['reload'] = False
+            logging.info("SIGHUP received, reloading config file")
+            try:
+                config.load_config()
+            except SystemExit:
+                # errors are already printed, keep running with the previous config
+                logging.error("Reloading config file failed, keep previous config")
+            scheduler.jitter = config.configfile['daemon']['jitter']
+            scheduler.load(config.configfile['accounts'])
+            logging.info(str(len(scheduler)) + " account(s) scheduled")
+
+        account = scheduler.due_account()
+        if (account is None):
+            # don't keep the SMTP connection open while idle
+            mailer.close()
+            # sleep in small steps, signals must not wait for the next account
+            time.sleep(min(max(scheduler.seconds_until_next(), 0.1), 1.0))
+            continue
+
+        # a failed account is tried again at the next scheduled time
+        database = account_database(config, databases, account)
+        run_account(config, database, account, session, mailer)
+        scheduler.reschedule(account)
+        database.incremental_vacuum(config.configfile['maintenance']['vacuum_pages'])
+
+    mailer.close()
+    logging.info("Daemon stopped")
+
+
+
+# query_api_result()
+#
+# run the query for an API path
+#
+# parameter:
+#  - database object (read only, with all database files)
+#  - URL path
+#  - dictionary with URL parameters
+# return:
+#  - HTTP status, result (JSON serializable)
+def query_api_result(database, path, parameters):
+    parts = [urllib.parse.unquote(part) for part in path.strip('/').split('/')]
+
+    if (parts == ['accounts']):
+        # the schema is internal, and the IDs are only unique per schema
+        return 200, [dict([(key, row[key]) for key in row.keys() if key != 'shard']) for row in database.list_accounts()]
+
+    if (len(parts) != 3 or parts[0] != 'accounts'):
+        return 404, {'error': 'unknown path'}
+
+    account = database.find_account(parts[1])
+    if (account is None):
+        return 404, {'error': 'unknown account'}
+    account_id = account['id']
+    # the queries for one account run on the file of the account
+    database = database.shard_database(account['shard'])
+
+    if (parts[2] == 'balance' and 'date' in parameters):
+        try:
+            date = datetime.datetime.strptime(parameters['date'][0], '%Y-%m-%d').date()
+        except ValueError:
+            return 400, {'error': 'invalid date'}
+        balance = database.balance_at(account_id, date)
+        if (balance is None or balance['running_balance'] is None):
+            return 404, {'error': 'no balance available'}
+        return 200, dict(balance)
+
+    if (parts[2] == 'balance'):
+        balance = database.last_account_balance(account_id)
+        if (balance is None):
+            return 404, {'error': 'no balance available'}
+        return 200, dict(balance)
+
+    if (parts[2] == 'transactions'):
+        try:
+            limit = int(parameters.get('limit', ['20'])[0])
+        except ValueError:
+            return 400, {'error': 'invalid limit'}
+        limit = min(max(limit, 1), 1000)
+        return 200, [dict(row) for row in database.last_transactions(account_id, limit)]
+
+    if (parts[2] == 'monthly'):
+        return 200, [dict(row) for row in database.monthly_totals(account_id)]
+
+    if (parts[2] == 'payees'):
+        return 200, [dict(row) for row in database.payee_totals(account_id)]
+
+    if (parts[2] == 'recurring'):
+        return 200, [dict(row) for row in database.recurring_payments(account_id)]
+
+    return 404, {'error': 'unknown path'}
+
+
+
+# run_query_api()
+#
+# serve the most common queries as a local HTTP/JSON API, over a read only connection
+# results are cached until another connection commits new data
+#
+# parameter:
+#  - config object
+# return:
+#  none
+def run_query_api(config):
+    database = report_database(config)
+    cache = QueryCache(config.configfile['serve']['cache_entries'])
+    state = {'data_version': database.data_version()}
+
+    class QueryRequestHandler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            # new data was written since the results were cached
+            data_version = database.data_version()
+            if (data_version != state['data_version']):
+                state['data_version'] = data_version
+                cache.clear()
+
+            entry = cache.get(self.path)
+            if (entry is None):
+                url = urllib.parse.urlsplit(self.path)
+                status, result = query_api_result(database, url.path, urllib.parse.parse_qs(url.query))
+                body = json.dumps(result, indent = 1).encode('utf-8')
+                entry = {'status': status, 'body': body,
+                         'etag': '"' + hashlib.sha1(body).hexdigest() + '"'}
+                if (status == 200):
+                    cache.put(self.path, entry)
+
+            if (entry['status'] == 200 and self.headers.get('If-None-Match') == entry['etag']):
+                self.send_response(304)
+                self.send_header('ETag', entry['etag'])
+                self.end_headers()
+                return
+
+            self.send_response(entry['status'])
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(entry['body'])))
+            self.send_header('ETag', entry['etag'])
+            self.end_headers()
+            self.wfile.write(entry['body'])
+
+        def log_message(self, format, *args):
+            logging.debug("serve: " + (format % args))
+
+    server = http.server.HTTPServer((config.configfile['serve']['listen'], config.configfile['serve']['port']),
+                                    QueryRequestHandler)
+    logging.info("Serving queries on http://" + str(config.configfile['serve']['listen']) + ":" +
+                 str(config.configfile['serve']['port']) + "/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+
+#######################################################################
+# main program
+
+config = Config()
+config.parse_parameters()
+config.load_config()
+
+if (config.arguments.command == 'serve'):
+    run_query_api(config)
+    sys.exit(0)
+
+if (config.arguments.command == 'tail'):
+    try:
+        tail_change_log(config, config.arguments.from_value, config.arguments.follow)
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
+
+if (config.arguments.command == 'stats'):
+    show_statistics(report_database(config), config.arguments.days)
+    sys.exit(0)
+
+if (config.arguments.command == 'analyze'):
+    database = report_database(config)
+    header = True
+    for account in database.list_accounts():
+        analysis = analyze_account(database.shard_database(account['shard']), account['id'])
+        if (analysis is None):
+            logging.info("No statements for account: " + str(account['name']))
+            continue
+        sys.stdout.write(format_analysis(account['name'], analysis, config.arguments.format, header))
+        if (config.arguments.format == 'text'):
+            sys.stdout.write("\n")
+        header = False
+    sys.exit(0)
+
+# the database files are opened on first use, every file once
+databases = {}
+
+if (config.arguments.command == 'maintenance'):
+    for database_file in config.database_files(existing = True):
+        if (config.configfile['database']['shard'] != 'none'):
+            logging.info("Database: " + database_file)
+        database = Database(config, database_file)
+        database.maintenance(config.configfile['maintenance'])
+    sys.exit(0)
+
+if (config.arguments.command == 'categorize'):
+    for database_file in config.database_files(existing = True):
+        if (config.configfile['database']['shard'] != 'none'):
+            logging.info("Database: " + database_file)
+        database = Database(config, database_file)
+        total, changed = database.recategorize(config.categorizer)
+        logging.info("Categorized " + str(total) + " statements, " + str(changed) + " changed")
+        if (changed > 0):
+            # the baseline for the anomaly detection depends on the categories
+            for account in database.list_accounts():
+                database.rebuild_amount_statistics(account['id'])
+                database.rebuild_monthly_spending(account['id'])
+    sys.exit(0)
+
+logging.debug("urllib version: " + str(_urllib_version))
+
+if (config.arguments.daemon is True):
+    run_daemon(config, databases)
+    sys.exit(0)
+
+if (config.arguments.command == 'backfill'):
+    session = requests.session()
+    for account in config.configfile['accounts']:
+        if (config.configfile['accounts'][account]['enabled'] != True):
+            logging.debug("Account '" + str(account) + "' is disabled in config")
+            continue
+        backfill_account(config, account_database(config, databases, account), account, session, config.arguments.from_value)
+    sys.exit(0)
+
+# all accounts from all config files share the HTTP session and the SMTP connection,
+# and the database unless 'shard' is set in the 'database' section
+session = requests.session()
+mailer = Mailer()
+enabled_accounts = []
+for account in config.configfile['accounts']:
+    if (config.configfile['accounts'][account]['enabled'] != True):
+        logging.debug("Account '" + str(account) + "' is disabled in config")
+        continue
+    enabled_accounts.append(account)
+
+# every database file keeps the run state of its own accounts
+shard_accounts = collections.OrderedDict()
+for account in enabled_accounts:
+    shard_accounts.setdefault(account_database(config, databases, account), []).append(account)
+finished_accounts = set()
+for database in shard_accounts:
+    if (config.arguments.resume is True):
+        # accounts which are not in the last run are processed as well
+        finished_accounts |= database.finished_accounts()
+    else:
+        database.start_run(shard_accounts[database])
+
+# loop over the accounts in the config file, a failed account does not stop the others
+failed_accounts = []
+for account in enabled_accounts:
+    if (account in finished_accounts):
+        logging.debug("Account '" + str(account) + "' was already processed in the last run")
+        continue
+    if (run_account(config, account_database(config, databases, account), account, session, mailer) is False):
+        failed_accounts.append(account)
+mailer.close()
+
+# release some of the free pages, the full compaction is done by 'maintenance'
+for database_file in databases:
+    databases[database_file].incremental_vacuum(config.configfile['maintenance']['vacuum_pages'])
+
+if (len(failed_accounts) > 0):
+    logging.error("Failed accounts: " + ", ".join(failed_accounts) + ", retry with --resume")
+    sys.exit(1)
+
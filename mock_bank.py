@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+#
+# local test server, which emulates the pages of the bank used by account_statement.py
+# homepage, login form, account overview, turnovers form and turnovers (HTML and CSV)
+#
+# the bookings are generated, and are the same for every start with the same parameters
+#
+
+import sys
+import time
+import random
+import logging
+import argparse
+import datetime
+import threading
+import collections
+import http.server
+import http.cookies
+import urllib.parse
+import html as htmlescape
+
+
+# start with 'info', can be overriden by '-q' later on
+logging.basicConfig(level = logging.INFO,
+		    format = '%(levelname)s: %(message)s')
+
+
+
+
+
+#######################################################################
+# MockBank class
+
+class MockBank:
+
+    # counterparties: name, kind of booking, IBAN, BIC, creditor ID, mandate reference, minimum and maximum amount
+    counterparties = [
+        ['Stadtwerke Musterstadt', 'SEPA-Lastschrift', 'DE02120300000000202051', 'BYLADEM1001', 'DE98ZZZ09999999999', 'SW-10001', -180, -60],
+        ['Mobilfunk GmbH', 'SEPA-Lastschrift', 'DE02500105170137075030', 'INGDDEFFXXX', 'DE12ZZZ00000012345', 'MF-555', -45, -20],
+        ['Versicherung AG', 'SEPA-Lastschrift', 'DE02100100100006820101', 'PBNKDEFFXXX', 'DE77ZZZ00000098765', 'V-2020-17', -95, -95],
+        ['Supermarkt', 'Kartenzahlung', 'DE02300209000106531065', 'CMCIDEDD', '', '', -120, -5],
+        ['Tankstelle', 'Kartenzahlung', 'DE02600100700599540705', 'PBNKDEFFXXX', '', '', -90, -30],
+        ['Vermieter', 'SEPA-Dauerauftrag', 'DE02700100800030876808', 'PBNKDEFFXXX', '', '', -950, -950],
+        ['Arbeitgeber', 'SEPA-Gutschrift', 'DE88100900001234567892', 'BEVODEBBXXX', '', '', 2500, 3500],
+    ]
+
+    def __init__(self, accounts, bookings, days, branch_code, seed):
+        self.branch_code = branch_code
+        # account number -> list with bookings (newest first) and balance
+        self.accounts = collections.OrderedDict()
+        today = datetime.date.today()
+        for number in range(accounts):
+            account_number = str(1000001 + number)
+            rng = random.Random(str(seed) + ':' + account_number)
+            entries = []
+            balance = 1000.0
+            for n in range(bookings):
+                entry = {}
+                counterparty = rng.choice(self.counterparties)
+                entry['date'] = today - datetime.timedelta(days = rng.randint(0, max(days - 1, 0)))
+                entry['name'] = counterparty[0]
+                entry['kind'] = counterparty[1]
+                entry['iban'] = counterparty[2]
+                entry['bic'] = counterparty[3]
+                entry['creditor_id'] = counterparty[4]
+                entry['mandate_reference'] = counterparty[5]
+                entry['amount'] = round(rng.uniform(counterparty[6], counterparty[7]), 2)
+                entry['purpose'] = 'Referenz ' + account_number + '-' + str(n)
+                balance += entry['amount']
+                entries.append(entry)
+            entries.sort(key = lambda entry: entry['date'], reverse = True)
+            self.accounts[account_number] = {'bookings': entries, 'balance': round(balance, 2)}
+
+
+
+    # bookings()
+    #
+    # return the bookings of an account in a date range
+    #
+    # parameter:
+    #  - self
+    #  - account number
+    #  - first day (datetime.date)
+    #  - last day (datetime.date)
+    # return:
+    #  - list with bookings, newest first
+    def bookings(self, account_number, first_day, last_day):
+        return [entry for entry in self.accounts[account_number]['bookings'] if (first_day <= entry['date'] <= last_day)]
+
+
+
+# end MockBank class
+#######################################################################
+
+
+
+
+
+# german_amount()
+#
+# format an amount the way the bank does: dot for thousands, comma for the cents
+#
+# parameter:
+#  - amount (float)
+# return:
+#  - formatted amount
+def german_amount(amount):
+    return '{:,.2f}'.format(amount).replace(',', 'X').replace('.', ',').replace('X', '.')
+
+
+
+# page()
+#
+# wrap content into a HTML page
+#
+# parameter:
+#  - content
+# return:
+#  - HTML page
+def page(content):
+    return ('<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"><title>Mock Bank</title></head>\n<body>\n' +
+            content + '\n</body>\n</html>\n')
+
+
+
+# turnovers_html()
+#
+# render the turnovers page, with the balance and the bookings table
+#
+# parameter:
+#  - list with bookings
+#  - balance
+# return:
+#  - HTML page
+def turnovers_html(bookings, balance):
+    lines = []
+    lines.append('<table class="balance"><tr><td>Aktueller Kontostand</td>' +
+                 '<td class="balance credit"><strong>' + german_amount(balance) + '</strong></td>' +
+                 '<td><strong><acronym title="Euro">EUR</acronym></strong></td></tr></table>')
+    lines.append('<!-- Display bookedTurnovers -->')
+    lines.append('<table id="bookings">')
+    lines.append('<tr class="headline"><th>Ums&auml;tze</th></tr>')
+    lines.append('<tr><th id="bTentry">Buchungstag</th><th id="bTvalue">Wert</th><th id="bTpurpose">Verwendungszweck</th>' +
+                 '<th id="bTdebit">Soll</th><th id="bTcredit">Haben</th><th id="bTcurrency">W&auml;hrung</th></tr>')
+    for entry in bookings:
+        lines.append('<tr>')
+        lines.append('<td headers="bTentry">' + entry['date'].strftime('%d.%m.%Y') + '</td>')
+        lines.append('<td headers="bTvalue">' + entry['date'].strftime('%d.%m.%Y') + '</td>')
+        lines.append('<td headers="bTpurpose">' + htmlescape.escape(entry['kind'] + ' ' + entry['name']) + '</td>')
+        if (entry['amount'] < 0):
+            lines.append('<td headers="bTdebit">' + german_amount(entry['amount']) + '</td>')
+            lines.append('<td headers="bTcredit"></td>')
+        else:
+            lines.append('<td headers="bTdebit"></td>')
+            lines.append('<td headers="bTcredit">' + german_amount(entry['amount']) + '</td>')
+        lines.append('<td headers="bTcurrency">EUR</td>')
+        lines.append('</tr>')
+        lines.append('<tr><td>Verwendungszweck</td><td>' + htmlescape.escape(entry['purpose']) + '</td></tr>')
+        lines.append('<tr><td>IBAN</td><td>' + entry['iban'] + '</td></tr>')
+        lines.append('<tr><td>BIC</td><td>' + entry['bic'] + '</td></tr>')
+        if (len(entry['mandate_reference']) > 0):
+            lines.append('<tr><td>Mandatsreferenz</td><td>' + entry['mandate_reference'] + '</td></tr>')
+            lines.append('<tr><td>Gläubiger ID</td><td>' + entry['creditor_id'] + '</td></tr>')
+    lines.append('</table>')
+    lines.append('<!-- If there are no turnovers existent -->')
+
+    return page("\n".join(lines))
+
+
+
+# turnovers_csv()
+#
+# render the CSV export of the turnovers
+#
+# parameter:
+#  - list with bookings
+#  - balance
+#  - first day (datetime.date)
+#  - last day (datetime.date)
+# return:
+#  - CSV content
+def turnovers_csv(bookings, balance, first_day, last_day):
+    lines = []
+    lines.append('Umsätze Girokonto;;;;;;;;;;;;;;;;;')
+    lines.append(first_day.strftime('%d.%m.%Y') + ' - ' + last_day.strftime('%d.%m.%Y') + ';;;;;;;;;;;;;;;;;')
+    lines.append('Buchungstag;Wert;Umsatzart;Begünstigter / Auftraggeber;Verwendungszweck;IBAN;BIC;Kundenreferenz;' +
+                 'Mandatsreferenz;Gläubiger ID;Fremde Gebühren;Betrag;Abweichender Empfänger;' +
+                 'Anzahl der Aufträge;Anzahl der Schecks;Soll;Haben;Währung')
+    for entry in bookings:
+        debit = german_amount(entry['amount']) if (entry['amount'] < 0) else ''
+        credit = german_amount(entry['amount']) if (entry['amount'] >= 0) else ''
+        lines.append(';'.join([entry['date'].strftime('%d.%m.%Y'), entry['date'].strftime('%d.%m.%Y'), entry['kind'],
+                               entry['name'], entry['purpose'], entry['iban'], entry['bic'], '',
+                               entry['mandate_reference'], entry['creditor_id'], '', '', '', '', '', debit, credit, 'EUR']))
+    lines.append('Kontostand;' + last_day.strftime('%d.%m.%Y') + ';;;' + german_amount(balance) + ';EUR')
+
+    return "\n".join(lines) + "\n"
+
+
+
+# date_range()
+#
+# extract the date range from the turnovers form
+#
+# parameter:
+#  - dictionary with form fields
+# return:
+#  - first day, last day (datetime.date)
+def date_range(fields):
+    today = datetime.date.today()
+    if (fields.get('period') == 'dateRange'):
+        first_day = datetime.date(int(fields['periodStartYear']), int(fields['periodStartMonth']), int(fields['periodStartDay']))
+        last_day = datetime.date(int(fields['periodEndYear']), int(fields['periodEndMonth']), int(fields['periodEndDay']))
+    else:
+        first_day = today - datetime.timedelta(days = int(fields.get('periodDays') or 85))
+        last_day = today
+
+    return first_day, last_day
+
+
+
+# run_server()
+#
+# serve the mock bank pages
+#
+# parameter:
+#  - parsed arguments
+#  - MockBank object
+# return:
+#  none
+def run_server(args, bank):
+    # session cookie -> account number, old sessions are dropped
+    sessions = collections.OrderedDict()
+    lock = threading.Lock()
+    rng = random.Random()
+    counter = {'requests': 0, 'errors': 0}
+
+    class MockBankRequestHandler(http.server.BaseHTTPRequestHandler):
+        # keep the connection open, like the real website
+        protocol_version = 'HTTP/1.1'
+        # headers and body are written separately, don't wait for the delayed ACK
+        disable_nagle_algorithm = True
+
+        def handle(self):
+            try:
+                http.server.BaseHTTPRequestHandler.handle(self)
+            except ConnectionError:
+                # the client closed a connection which was kept open
+                pass
+
+        def do_GET(self):
+            self.handle_request(None)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length).decode('utf-8')
+            self.handle_request(dict(urllib.parse.parse_qsl(body, keep_blank_values = True)))
+
+        def handle_request(self, fields):
+            if (args.latency > 0 or args.jitter > 0):
+                time.sleep(max(args.latency + rng.uniform(-args.jitter, args.jitter), 0) / 1000.0)
+            with lock:
+                counter['requests'] += 1
+                fail = (rng.random() < args.error_rate)
+                if (fail is True):
+                    counter['errors'] += 1
+            if (fail is True):
+                self.respond(args.error_status, page('<p>Service Unavailable</p>'))
+                return
+
+            path = urllib.parse.urlsplit(self.path).path
+            base = 'http://' + str(self.headers.get('Host'))
+            if (path == '/' and fields is None):
+                self.respond(200, page('<a class="button online-banking-theme" href="' + base + '/trxm/db/">Online-Banking</a>'))
+            elif (path == '/trxm/db/' and fields is None):
+                self.respond(200, page('<form id="loginForm" action="/trxm/db/login.do" method="post">\n' +
+                                       '<input type="hidden" name="gotoUrl" value="">\n' +
+                                       '<input type="text" name="branch" value="">\n' +
+                                       '<input type="text" name="account" value="">\n' +
+                                       '<input type="text" name="subaccount" value="">\n' +
+                                       '<input type="password" name="pin" value="">\n' +
+                                       '</form>'))
+            elif (path == '/trxm/db/login.do' and fields is not None):
+                self.login(fields)
+            elif (path == '/trxm/db/accounts' and fields is None):
+                if (self.session() is None):
+                    return
+                self.respond(200, page('<form id="accountTurnoversForm" action="/trxm/db/turnovers" method="post">\n' +
+                                       '<select name="subaccountAndCurrency"><option value="00" selected="selected">00 EUR</option></select>\n' +
+                                       '<input type="radio" name="period" value="fixedRange" checked="checked">\n' +
+                                       '<input type="radio" name="period" value="dateRange">\n' +
+                                       '<input type="text" name="periodDays" value="30">\n' +
+                                       '<input type="text" name="periodStartDay" value="">\n' +
+                                       '<input type="text" name="periodStartMonth" value="">\n' +
+                                       '<input type="text" name="periodStartYear" value="">\n' +
+                                       '<input type="text" name="periodEndDay" value="">\n' +
+                                       '<input type="text" name="periodEndMonth" value="">\n' +
+                                       '<input type="text" name="periodEndYear" value="">\n' +
+                                       '<input type="hidden" name="outputFormat" value="html">\n' +
+                                       '</form>'))
+            elif (path == '/trxm/db/turnovers' and fields is not None):
+                account_number = self.session()
+                if (account_number is None):
+                    return
+                try:
+                    first_day, last_day = date_range(fields)
+                except (KeyError, ValueError):
+                    self.respond(400, page('<p>Invalid date range</p>'))
+                    return
+                bookings = bank.bookings(account_number, first_day, last_day)
+                balance = bank.accounts[account_number]['balance']
+                if (fields.get('outputFormat') == 'csv' and args.no_csv is False):
+                    self.respond(200, turnovers_csv(bookings, balance, first_day, last_day), 'text/csv')
+                else:
+                    self.respond(200, turnovers_html(bookings, balance))
+            else:
+                self.respond(404, page('<p>Not Found</p>'))
+
+        def login(self, fields):
+            account_number = fields.get('account')
+            if (fields.get('branch') != bank.branch_code or account_number not in bank.accounts or
+                fields.get('subaccount') != '00' or len(fields.get('pin', '')) == 0):
+                self.respond(401, page('<p>Login failed</p>'))
+                return
+            token = '%032x' % random.getrandbits(128)
+            with lock:
+                sessions[token] = account_number
+                while (len(sessions) > 10000):
+                    sessions.popitem(last = False)
+            self.respond(200, page('<ul><li><a href="/trxm/db/accounts">Konten</a></li></ul>'),
+                         cookie = 'session=' + token + '; Path=/')
+
+        def session(self):
+            cookies = http.cookies.SimpleCookie(self.headers.get('Cookie') or '')
+            account_number = None
+            if ('session' in cookies):
+                with lock:
+                    account_number = sessions.get(cookies['session'].value)
+            if (account_number is None):
+                self.respond(401, page('<p>Session expired</p>'))
+            return account_number
+
+        def respond(self, status, content, content_type = 'text/html', cookie = None):
+            body = content.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type + '; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            if (cookie is not None):
+                self.send_header('Set-Cookie', cookie)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("mock bank: " + (format % args))
+
+    server = http.server.ThreadingHTTPServer((args.listen, args.port), MockBankRequestHandler)
+    server.daemon_threads = True
+    logging.info("Mock bank on http://" + str(args.listen) + ":" + str(args.port) + "/, " +
+                 str(len(bank.accounts)) + " account(s) with " + str(args.bookings) + " booking(s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    logging.info(str(counter['requests']) + " request(s), " + str(counter['errors']) + " injected error(s)")
+
+
+
+# print_config()
+#
+# print a config file for account_statement.py, with all accounts of the mock bank
+#
+# parameter:
+#  - parsed arguments
+#  - MockBank object
+# return:
+#  none
+def print_config(args, bank):
+    print("sender_address: " + args.recipient)
+    print("bank_url: http://" + str(args.listen) + ":" + str(args.port) + "/")
+    print("accounts:")
+    for account_number in bank.accounts:
+        print("    Mock " + account_number + ":")
+        print("        enabled: true")
+        print("        account_number: " + account_number)
+        print("        sub_account: 0")
+        print("        branch_code: " + bank.branch_code)
+        print("        password: mock")
+        print("        recipients: " + args.recipient)
+        if (args.no_csv is False):
+            print("        turnovers_format: csv")
+
+
+
+
+
+#######################################################################
+# main program
+
+parser = argparse.ArgumentParser(description = 'Mock bank server for account_statement.py')
+parser.add_argument('--listen', default = '127.0.0.1', help = 'listen address (default: 127.0.0.1)')
+parser.add_argument('--port', default = 8480, type = int, help = 'port (default: 8480)')
+parser.add_argument('--accounts', default = 1, type = int, help = 'number of accounts (default: 1)')
+parser.add_argument('--bookings', default = 50, type = int, help = 'number of bookings per account (default: 50)')
+parser.add_argument('--days', default = 85, type = int, help = 'the bookings are spread over this many days (default: 85)')
+parser.add_argument('--branch-code', default = '100', dest = 'branch_code', help = 'branch code of all accounts (default: 100)')
+parser.add_argument('--seed', default = 1, type = int, help = 'seed for the generated bookings (default: 1)')
+parser.add_argument('--latency', default = 0, type = int, help = 'delay for every request, in ms (default: 0)')
+parser.add_argument('--jitter', default = 0, type = int, help = 'random variation of the delay, in ms (default: 0)')
+parser.add_argument('--error-rate', default = 0.0, type = float, dest = 'error_rate', help = 'fraction of requests which fail (default: 0)')
+parser.add_argument('--error-status', default = 503, type = int, dest = 'error_status', help = 'HTTP status of failed requests (default: 503)')
+parser.add_argument('--no-csv', default = False, dest = 'no_csv', action = 'store_true', help = 'do not offer the CSV export')
+parser.add_argument('--print-config', default = False, dest = 'print_config', action = 'store_true', help = 'print a config file for all accounts, and exit')
+parser.add_argument('--recipient', default = 'your@email.address', help = "email address in the config file for '--print-config'")
+parser.add_argument('-v', '--verbose', default = False, dest = 'verbose', action = 'store_true', help = 'log every request')
+args = parser.parse_args()
+
+if (args.accounts < 1 or args.bookings < 0 or args.days < 1):
+    print("")
+    print("Error: --accounts and --days must be at least 1, --bookings must not be negative")
+    sys.exit(1)
+if (args.error_rate < 0 or args.error_rate > 1):
+    print("")
+    print("Error: --error-rate must be between 0 and 1")
+    sys.exit(1)
+
+if (args.verbose is True):
+    logging.getLogger().setLevel(logging.DEBUG)
+
+bank = MockBank(args.accounts, args.bookings, args.days, args.branch_code, args.seed)
+
+if (args.print_config is True):
+    print_config(args, bank)
+    sys.exit(0)
+
+run_server(args, bank)
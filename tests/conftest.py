@@ -0,0 +1,86 @@
+#
+# shared fixtures for the tests
+#
+
+import os
+import types
+import pytest
+
+
+# account_statement()
+#
+# account_statement.py is a script, only the definitions in front of the
+# main program are loaded (no config file, no database, no network)
+#
+# parameter:
+#  none
+# return:
+#  - module with the classes and functions of account_statement.py
+@pytest.fixture(scope = 'session')
+def account_statement():
+    filename = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'account_statement.py')
+    with open(filename, 'r') as source:
+        content = source.read()
+    content = content[:content.index("# main program")]
+
+    module = types.ModuleType('account_statement')
+    module.__file__ = filename
+    exec(compile(content, filename, 'exec'), module.__dict__)
+
+    return module
+
+
+
+# database_config()
+#
+# the database only needs the categorizer from the config object
+#
+# parameter:
+#  - account_statement module
+# return:
+#  - config object without categorization rules
+@pytest.fixture
+def database_config(account_statement):
+    return types.SimpleNamespace(categorizer = account_statement.Categorizer([]))
+
+
+
+# database()
+#
+# a new database in the temporary directory of the test
+#
+# parameter:
+#  - account_statement module
+#  - config object
+#  - temporary directory
+# return:
+#  - database object
+@pytest.fixture
+def database(account_statement, database_config, tmp_path):
+    return account_statement.Database(database_config, str(tmp_path / 'db_accounts'))
+
+
+
+# account_data()
+#
+# account data as it is returned by the parsers
+#
+# parameter:
+#  - account_statement module
+# return:
+#  - function: list with (date, purpose, amount) or (date, purpose, amount, (IBAN, BIC, creditor ID)),
+#    and the balance -> dictionary with account data
+@pytest.fixture
+def account_data(account_statement):
+    def create(bookings, bank_balance = '1000.00'):
+        result = []
+        for booking in bookings:
+            iban, bic, creditor_id = booking[3] if (len(booking) > 3) else ('DE02120300000000202051', 'BYLADEM1001', '')
+            result.append(account_statement.Booking(booking[0], booking[0], booking[1], '', iban, bic, '', '', creditor_id,
+                                                    booking[2], 'EUR'))
+        return {'bookings': result,
+                'bank_balance': bank_balance,
+                'bank_balance_currency': 'EUR',
+                'unchanged': False}
+
+    return create
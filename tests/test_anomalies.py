@@ -0,0 +1,51 @@
+#
+# tests for the anomaly flags of new debits: unusual amount, duplicate
+# charge and high debit to a new payee
+#
+
+SETTINGS = {'enabled': True, 'min_samples': 5, 'threshold': 3.0, 'min_difference': 10.0, 'new_payee_amount': 500.0}
+
+ENERGY = ('DE02120300000000202051', 'BYLADEM1001', 'DE98ZZZ09999999999')
+SHOP = ('DE88100900001234567892', 'BEVODEBBXXX', '')
+NEW_PAYEE = ('DE12500105170648489890', 'INGDDEFFXXX', '')
+CARD = ('', '', '')
+
+
+def save(database, account_data, account_id, bookings, score = True):
+    new_statements = database.save_account_transactions(account_id, account_data(bookings))
+    database.score_statements(account_id, new_statements, SETTINGS, score)
+    query = "SELECT intended_use, anomaly FROM account_statements WHERE id BETWEEN ? AND ? ORDER BY id"
+
+    return dict([(row['intended_use'], row['anomaly']) for row in
+                 database.execute_query(query, [min(new_statements), max(new_statements)])])
+
+
+def test_unusual_debits_are_flagged(database, account_data):
+    account_id = database.get_account_id('Account 1', 'acc-1', 0, 100)
+
+    # the history is only added to the baseline (like a backfill)
+    history = [('15.%02d.2026' % month, 'energy ' + str(month), '-%.2f' % (80 + month % 3), ENERGY) for month in range(1, 9)]
+    history += [('20.%02d.2026' % month, 'shop ' + str(month), '-%.2f' % (30 + month), SHOP) for month in range(1, 9)]
+    assert set(save(database, account_data, account_id, history, False).values()) == set([None])
+
+    flags = save(database, account_data, account_id, [
+        ('15.09.2026', 'energy normal', '-81.00', ENERGY),
+        ('16.09.2026', 'energy high', '-240.00', ENERGY),
+        ('17.09.2026', 'shop twice', '-25.00', SHOP),
+        ('19.09.2026', 'shop twice again', '-25.00', SHOP),
+        ('20.09.2026', 'new payee', '-750.00', NEW_PAYEE),
+        ('21.09.2026', 'new payee small', '-20.00', ('DE75512108001245126199', 'SOGEDEFFXXX', '')),
+        ('22.09.2026', 'card payment', '-900.00', CARD),
+        ('23.09.2026', 'refund', '240.00', ENERGY)])
+    assert flags == {'energy normal': None,
+                     'energy high': 'amount',
+                     'shop twice': 'duplicate',
+                     'shop twice again': 'duplicate',
+                     'new payee': 'new_payee',
+                     'new payee small': None,
+                     'card payment': None,
+                     'refund': None}
+
+    # the flagged debits are part of the baseline now, the same payee is not new anymore
+    flags = save(database, account_data, account_id, [('20.10.2026', 'new payee again', '-750.00', NEW_PAYEE)])
+    assert flags == {'new payee again': None}
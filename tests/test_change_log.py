@@ -0,0 +1,58 @@
+#
+# tests for the change feed ('tail'): every database file has its own
+# sequence numbers, each line names its file and --from is per file
+#
+
+import json
+
+import pytest
+
+
+def sharded_config(account_statement, config, tmp_path):
+    files = []
+    for name, balances in [('Account_1', ['10.00', '11.00', '12.00']), ('Account_2', ['20.00'])]:
+        database_file = str(tmp_path / (name + '.db'))
+        database = account_statement.Database(config, database_file)
+        account_id = database.get_account_id(name, name, 0, 100)
+        for balance in balances:
+            database.save_account_amount(account_id, balance, 'EUR')
+        database.connection.close()
+        files.append(database_file)
+    config.database_files = lambda existing = False: files
+
+    return config
+
+
+def tail(account_statement, capsys, config, first_seq):
+    account_statement.tail_change_log(config, first_seq, False)
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+def test_tail_names_the_database_file(account_statement, database_config, capsys, tmp_path):
+    config = sharded_config(account_statement, database_config, tmp_path)
+    entries = tail(account_statement, capsys, config, {})
+    assert [(entry['database'], entry['seq']) for entry in entries] == \
+           [('Account_1.db', 1), ('Account_1.db', 2), ('Account_1.db', 3), ('Account_2.db', 1)]
+
+
+def test_tail_cursor_per_database_file(account_statement, database_config, capsys, tmp_path):
+    config = sharded_config(account_statement, database_config, tmp_path)
+    entries = tail(account_statement, capsys, config, {'Account_1.db': 3, 'Account_2.db': 2})
+    assert [(entry['database'], entry['seq']) for entry in entries] == [('Account_1.db', 3)]
+
+    # a file without a cursor starts at the beginning
+    entries = tail(account_statement, capsys, config, {'Account_1.db': 4})
+    assert [(entry['database'], entry['seq']) for entry in entries] == [('Account_2.db', 1)]
+
+
+def test_tail_rejects_one_sequence_for_several_files(account_statement, database_config, capsys, tmp_path):
+    config = sharded_config(account_statement, database_config, tmp_path)
+    with pytest.raises(SystemExit):
+        tail(account_statement, capsys, config, {None: 2})
+    with pytest.raises(SystemExit):
+        tail(account_statement, capsys, config, {'Account_3.db': 1})
+
+    # with one file a plain number works
+    config.database_files = lambda existing = False: [str(tmp_path / 'Account_1.db')]
+    entries = tail(account_statement, capsys, config, {None: 2})
+    assert [entry['seq'] for entry in entries] == [2, 3]
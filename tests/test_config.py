@@ -0,0 +1,48 @@
+#
+# tests for the config files: the database location
+#
+
+import os
+import types
+
+
+CONFIG = """accounts:
+    Account 1:
+        account_number: 1234567
+        sub_account: 0
+        branch_code: 100
+        password: secret
+        recipients: your@email.address
+        enabled: true
+sender_address: sender@email.address
+database:
+    file: accounts.db
+"""
+
+
+def load_config(account_statement, tmp_path, content):
+    filename = tmp_path / 'config' / 'account.yaml'
+    filename.parent.mkdir(parents = True)
+    filename.write_text(content)
+    os.chmod(str(filename), 0o600)
+    config = account_statement.Config()
+    config.arguments = types.SimpleNamespace(config = [str(filename)])
+    config.load_config()
+
+    return config
+
+
+def test_relative_database_file_is_relative_to_the_config_file(account_statement, tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    config = load_config(account_statement, tmp_path, CONFIG)
+    assert config.database_files() == [str(tmp_path / 'config' / 'accounts.db')]
+
+    config = load_config(account_statement, tmp_path / 'shard', CONFIG + "    shard: account\n")
+    assert config.database_files() == [str(tmp_path / 'shard' / 'config' / 'accounts.db.d' / 'Account_1.db')]
+
+
+def test_database_file_in_the_current_directory(account_statement, database_config, tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    database = account_statement.Database(database_config, 'accounts.db')
+    assert database.get_account_id('Account 1', 'acc-1', 0, 100) > 0
+    assert os.path.isfile(str(tmp_path / 'accounts.db'))
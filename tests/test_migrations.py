@@ -0,0 +1,120 @@
+#
+# tests for the schema migrations: a database created by the first version
+# of the script must end up with the same schema as a new database, and
+# keep all statements
+#
+
+import sqlite3
+
+
+# the tables as they were created before the first migration (user_version 0)
+BASELINE_SCHEMA = """
+CREATE TABLE bank_accounts (
+    id INTEGER PRIMARY KEY NOT NULL,
+    added_ts DATETIME DEFAULT CURRENT_TIMESTAMP,
+    name TEXT NOT NULL UNIQUE,
+    account_number BIGINT,
+    sub_account INTEGER,
+    branch_code INTEGER
+    );
+CREATE TABLE account_balance (
+    id INTEGER PRIMARY KEY NOT NULL,
+    added_ts DATETIME DEFAULT CURRENT_TIMESTAMP,
+    bank_account INTEGER NOT NULL,
+    account_balance NUMERIC NOT NULL,
+    account_balance_currency TEXT NOT NULL,
+    FOREIGN KEY (bank_account) REFERENCES bank_accounts(id)
+    );
+CREATE TABLE account_statements (
+    id INTEGER PRIMARY KEY NOT NULL,
+    added_ts DATETIME DEFAULT CURRENT_TIMESTAMP,
+    date_of_bookkeeping DATE NOT NULL,
+    date_of_value DATE NOT NULL,
+    bank_account INTEGER NOT NULL,
+    intended_use TEXT NOT NULL,
+    intended_use2 TEXT NOT NULL,
+    iban TEXT NOT NULL,
+    bic TEXT NOT NULL,
+    customer_reference TEXT NOT NULL,
+    mandate_reference TEXT NOT NULL,
+    creditor_id TEXT NOT NULL,
+    amount NUMERIC NOT NULL,
+    currency TEXT NOT NULL,
+    FOREIGN KEY (bank_account) REFERENCES bank_accounts(id)
+    );
+CREATE TABLE user_information (
+    id INTEGER PRIMARY KEY NOT NULL,
+    added_ts DATETIME DEFAULT CURRENT_TIMESTAMP,
+    bank_account INTEGER NOT NULL,
+    last_seen_statement INTEGER NOT NULL,
+    FOREIGN KEY (bank_account) REFERENCES bank_accounts(id),
+    FOREIGN KEY (last_seen_statement) REFERENCES account_statements(id)
+    );
+"""
+
+# id, date, purpose, IBAN, BIC, mandate reference, creditor ID, amount (credits were stored as German text)
+BASELINE_STATEMENTS = [
+    (1, '02.10.2026', 'Abschlag 10/2026', 'DE02120300000000202051', 'BYLADEM1001', 'SW-10001', 'DE98ZZZ09999999999', -50.5),
+    (2, '05.10.2026', 'Lohn/Gehalt 10/2026', 'DE88100900001234567892', 'BEVODEBBXXX', '', '', '2.686,26'),
+    (3, '07.10.2026', 'Kartenzahlung', '', '', '', '', -42.38),
+    (4, '09.10.2026', 'Abschlag 11/2026', 'DE02120300000000202051', 'BYLADEM1001', 'SW-10001', 'DE98ZZZ09999999999', -50.5),
+]
+MIGRATED_AMOUNTS = [-50.5, 2686.26, -42.38, -50.5]
+
+
+def create_baseline_database(database_file):
+    connection = sqlite3.connect(database_file)
+    connection.executescript(BASELINE_SCHEMA)
+    connection.execute("""INSERT INTO bank_accounts (id, name, account_number, sub_account, branch_code)
+                               VALUES (1, 'Account 1', 1234567, 0, 100)""")
+    connection.execute("""INSERT INTO account_balance (bank_account, account_balance, account_balance_currency)
+                               VALUES (1, 1000.00, 'EUR')""")
+    for statement_id, date, purpose, iban, bic, mandate, creditor, amount in BASELINE_STATEMENTS:
+        connection.execute("""INSERT INTO account_statements
+                                          (id, date_of_bookkeeping, date_of_value, bank_account, intended_use, intended_use2,
+                                           iban, bic, customer_reference, mandate_reference, creditor_id, amount, currency)
+                                   VALUES (?, ?, ?, 1, ?, '', ?, ?, '', ?, ?, ?, 'EUR')""",
+                           [statement_id, date, date, purpose, iban, bic, mandate, creditor, amount])
+    connection.execute("INSERT INTO user_information (bank_account, last_seen_statement) VALUES (1, 3)")
+    connection.commit()
+    connection.close()
+
+
+def schema(database):
+    tables = {}
+    for table in database.execute_query("SELECT name FROM sqlite_master WHERE type = 'table'", []):
+        tables[table['name']] = set([column['name'] for column in
+                                     database.execute_query("PRAGMA table_info(" + table['name'] + ")", [])])
+    indexes = set([row['name'] for row in database.execute_query("SELECT name FROM sqlite_master WHERE type = 'index'", [])])
+
+    return tables, indexes
+
+
+def test_baseline_database_is_migrated(account_statement, database_config, tmp_path):
+    create_baseline_database(str(tmp_path / 'db_accounts'))
+    database = account_statement.Database(database_config, str(tmp_path / 'db_accounts'))
+    new_database = account_statement.Database(database_config, str(tmp_path / 'db_new'))
+
+    assert database.execute_one("PRAGMA user_version", [])[0] == new_database.execute_one("PRAGMA user_version", [])[0]
+    assert schema(database) == schema(new_database)
+    assert database.execute_one("PRAGMA integrity_check", [])[0] == 'ok'
+
+    # the statements keep their IDs, and reference the counterparties
+    query = """SELECT s.id, s.date_of_bookkeeping, s.intended_use, c.iban, c.bic, s.mandate_reference, c.creditor_id, s.amount
+                 FROM account_statements s
+                 JOIN counterparties c
+                   ON c.id = s.counterparty
+             ORDER BY s.id"""
+    assert [tuple(row) for row in database.execute_query(query, [])] == \
+           [statement[:7] + (amount,) for statement, amount in zip(BASELINE_STATEMENTS, MIGRATED_AMOUNTS)]
+    assert database.execute_one("SELECT COUNT(*) AS cnt FROM counterparties", [])['cnt'] == 3
+    assert database.last_seen_statement(1) == 3
+
+    # the running balance is anchored to the last balance of the account
+    query = "SELECT running_balance FROM account_statements ORDER BY id"
+    assert [row['running_balance'] for row in database.execute_query(query, [])] == [-1593.38, 1092.88, 1050.5, 1000.0]
+
+    # a second start does not change anything
+    database.connection.close()
+    database = account_statement.Database(database_config, str(tmp_path / 'db_accounts'))
+    assert schema(database) == schema(new_database)
@@ -0,0 +1,26 @@
+#
+# tests for the queries of the query API
+#
+
+
+def test_last_transactions_after_backfill(database, account_data):
+    account_id = database.get_account_id('Account 1', 'acc-1', 0, 100)
+
+    database.save_account_transactions(account_id, account_data([
+        ('18.10.2026', 'today', '-10.00'), ('17.10.2026', 'yesterday', '-20.00')], '100.00'))
+    # a backfill adds older bookings, with higher IDs
+    database.save_account_transactions(account_id, account_data([
+        ('22.05.2026', 'May', '-30.00'), ('21.05.2026', 'May', '-40.00')], '100.00'))
+
+    assert [row['intended_use'] for row in database.last_transactions(account_id, 2)] == ['today', 'yesterday']
+
+
+def test_monthly_totals_are_rounded(database, account_data):
+    account_id = database.get_account_id('Account 1', 'acc-1', 0, 100)
+
+    database.save_account_transactions(account_id, account_data([
+        ('03.10.2026', 'a', '-0.10'), ('02.10.2026', 'b', '-0.20'), ('01.10.2026', 'c', '0.70'), ('01.10.2026', 'd', '0.20')],
+        '100.00'))
+
+    totals = [dict(row) for row in database.monthly_totals(account_id)]
+    assert totals == [{'month': '2026-10', 'incoming': 0.9, 'outgoing': -0.3, 'currency': 'EUR'}]
@@ -0,0 +1,21 @@
+#
+# tests for the run state (--resume): every run only resets its own accounts
+#
+
+
+def test_start_run_keeps_other_accounts(database):
+    # first config file: one account ok, one failed
+    database.start_run(['Account 1', 'Account 2'])
+    database.save_run_state('Account 1', 'ok')
+    database.save_run_state('Account 2', 'failed', 'login')
+
+    # second config file, same database
+    database.start_run(['Account 3'])
+    database.save_run_state('Account 3', 'ok')
+    assert database.finished_accounts() == set(['Account 1', 'Account 3'])
+
+    # a new run of the first config file resets its accounts only
+    database.start_run(['Account 1', 'Account 2'])
+    assert database.finished_accounts() == set(['Account 3'])
+    row = database.execute_one("SELECT status, phase FROM run_state WHERE account = ?", ['Account 2'])
+    assert (row['status'], row['phase']) == ('pending', None)
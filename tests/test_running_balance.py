@@ -0,0 +1,79 @@
+#
+# tests for the running balance: the balance after every statement must
+# add up, in booking order, to the balance of the account
+#
+
+import datetime
+import random
+
+
+def running_balances(database, account_id):
+    query = """SELECT intended_use, running_balance
+                 FROM account_statements
+                WHERE bank_account = ?
+             ORDER BY """ + database.booking_day + """ ASC, id ASC"""
+    return [(row['intended_use'], row['running_balance']) for row in database.execute_query(query, [account_id])]
+
+
+def booking_day(date):
+    return date[6:10] + date[3:5] + date[0:2]
+
+
+def assert_consistent(database, account_id, bank_balance):
+    query = """SELECT amount, running_balance
+                 FROM account_statements
+                WHERE bank_account = ?
+             ORDER BY """ + database.booking_day + """ ASC, id ASC"""
+    rows = database.execute_query(query, [account_id])
+    for previous, row in zip(rows, rows[1:]):
+        assert round(float(previous['running_balance']) + float(row['amount']), 2) == round(float(row['running_balance']), 2)
+    assert round(float(rows[-1]['running_balance']), 2) == round(float(bank_balance), 2)
+
+
+def test_running_balance_is_consistent(database, account_data):
+    account_id = database.get_account_id('Account 1', 'acc-1', 0, 100)
+
+    rnd = random.Random(1)
+    first_day = datetime.date(2026, 1, 1)
+    bookings = []
+
+    def fetch(days):
+        # every fetch returns the bookings of the last days, newest first
+        balance = 1000.0 + sum([float(amount) for date, purpose, amount in bookings])
+        window = (first_day + datetime.timedelta(days = days - 30)).strftime('%Y%m%d')
+        fetched = [booking for booking in bookings if (booking_day(booking[0]) >= window)]
+        fetched.sort(key = lambda booking: booking_day(booking[0]), reverse = True)
+        database.save_account_transactions(account_id, account_data(fetched, '%.2f' % balance))
+        database.save_account_amount(account_id, '%.2f' % balance, 'EUR')
+        assert_consistent(database, account_id, balance)
+
+    for days in range(10, 130, 10):
+        for day in range(days - 10, days):
+            for number in range(rnd.randint(0, 3)):
+                bookings.append(((first_day + datetime.timedelta(days = day)).strftime('%d.%m.%Y'), 'b' + str(len(bookings)),
+                                 '%.2f' % rnd.uniform(-300, 200)))
+        fetch(days)
+        # a booking which shows up late, before the newest statement
+        bookings.append(((first_day + datetime.timedelta(days = days - 15)).strftime('%d.%m.%Y'), 'late' + str(days), '-12.34'))
+        fetch(days)
+
+    # nothing drifted, and the balance at the end of a day is known
+    assert database.repair_running_balance(account_id) == 0
+    day = first_day + datetime.timedelta(days = 50)
+    expected = 1000.0 + sum([float(amount) for date, purpose, amount in bookings if (booking_day(date) <= day.strftime('%Y%m%d'))])
+    assert round(float(database.balance_at(account_id, day)['running_balance']), 2) == round(expected, 2)
+
+
+def test_backfill_calculates_the_running_balance_once(database, account_data):
+    account_id = database.get_account_id('Account 1', 'acc-1', 0, 100)
+
+    # every chunk has the current balance, not the balance at the end of the chunk
+    chunks = [[('05.01.2026', 'a', '100.00'), ('20.01.2026', 'b', '-30.00')],
+              [('03.02.2026', 'c', '-20.00')],
+              [('01.03.2026', 'd', '50.00')]]
+    for chunk in chunks:
+        database.save_account_transactions(account_id, account_data(chunk, '1100.00'), running_balance = False)
+        assert set([balance for purpose, balance in running_balances(database, account_id)]) == set([None])
+
+    assert database.repair_running_balance(account_id, '1100.00') == 4
+    assert running_balances(database, account_id) == [('a', 1100.0 - 50 + 20 + 30), ('b', 1100.0 - 50 + 20), ('c', 1050.0), ('d', 1100.0)]
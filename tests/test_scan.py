@@ -0,0 +1,121 @@
+#
+# tests for the linear HTML scanners: find_tag_blocks(), find_tag_starts()
+# and remove_cookie_consent_box() must return the same result as the regular
+# expressions they replaced, and must stay fast on pathological pages
+#
+
+import re
+import time
+import random
+
+
+# the expressions which were used before the linear scanners
+OLD_LINKS = r'<a.+?<\/a>'
+OLD_COOKIE_BOX = r'<div id="cookieConsentBox">.+?<form.*?</form>.*?</div>.*?</div>'
+
+# upper bound for a pathological page, in seconds (the regular expressions need minutes)
+TIME_LIMIT = 2.0
+
+SAMPLE_PAGE = """<html>
+<head><title>Online-Banking</title></head>
+<body>
+<div id="cookieConsentBox">
+  <p>Wir verwenden Cookies.</p>
+  <form action="/cookies" method="post"><input type="submit" value="OK"></form>
+  <div class="details"><a href="/datenschutz">Datenschutz</a></div>
+</div>
+<div id="navigation">
+  <a href="/trxm/db/">Online-Banking</a>
+  <a
+     href="/trxm/db/accounts">Konten</a>
+  <a class="small" href="/impressum">Impressum</a><a href="/hilfe">Hilfe</a>
+</div>
+<form id="accountTurnoversForm" action="/trxm/db/turnovers" method="get">
+  <input type="hidden" name="account" value="1000001">
+  <a href="/help">?</a>
+</form>
+</body>
+</html>
+"""
+
+# building blocks for the random pages: '<a' is always followed by a
+# space or '>' (the old expression also matched '<abbr>', the scanner does not)
+FRAGMENTS = ['<a href="/x">', '<a>', '</a>', '<a\nhref="/y">', 'Konten', ' ', '\n', 'text',
+             '<div id="cookieConsentBox">', '<div>', '</div>', '<form action="/f">', '<form>', '</form>',
+             '<p>', '</p>', '<', '>']
+
+
+def random_pages(count, seed = 1):
+    rnd = random.Random(seed)
+    for i in range(count):
+        yield ''.join([rnd.choice(FRAGMENTS) for j in range(rnd.randint(0, 60))])
+
+
+def old_links(content):
+    return re.findall(OLD_LINKS, content, re.DOTALL)
+
+
+def new_links(module, content):
+    return [content[start:end] for start, end in module.find_tag_blocks(content, 'a')]
+
+
+def old_remove_cookie_consent_box(content):
+    return re.sub(OLD_COOKIE_BOX, '', content, flags = re.DOTALL)
+
+
+def test_links_sample_page(account_statement):
+    assert new_links(account_statement, SAMPLE_PAGE) == old_links(SAMPLE_PAGE)
+    assert len(new_links(account_statement, SAMPLE_PAGE)) == 6
+
+
+def test_links_random_pages(account_statement):
+    for page in random_pages(3000):
+        assert new_links(account_statement, page) == old_links(page), page
+
+
+def test_tag_starts_skip_longer_tags(account_statement):
+    page = '<abbr>x</abbr><a href="/1">1</a><address></address><a>2</a>'
+    assert account_statement.find_tag_starts(page, 'a') == [14, 51]
+    assert new_links(account_statement, page) == ['<a href="/1">1</a>', '<a>2</a>']
+
+
+def test_cookie_consent_box_sample_page(account_statement):
+    result = account_statement.remove_cookie_consent_box(SAMPLE_PAGE)
+    assert result == old_remove_cookie_consent_box(SAMPLE_PAGE)
+    assert 'cookieConsentBox' not in result
+    assert 'accountTurnoversForm' in result
+
+
+def test_cookie_consent_box_random_pages(account_statement):
+    for page in random_pages(3000, seed = 2):
+        assert account_statement.remove_cookie_consent_box(page) == old_remove_cookie_consent_box(page), page
+
+
+def test_unclosed_links_are_linear(account_statement):
+    page = '<a href="/x">' * 200000
+    start = time.time()
+    assert account_statement.find_tag_blocks(page, 'a') == []
+    assert time.time() - start < TIME_LIMIT
+
+
+def test_nested_links_are_linear(account_statement):
+    page = '<a href="/x">' * 200000 + '</a>' + '<a>' * 200000
+    start = time.time()
+    blocks = account_statement.find_tag_blocks(page, 'a')
+    assert time.time() - start < TIME_LIMIT
+    assert blocks == [(0, len('<a href="/x">') * 200000 + len('</a>'))]
+
+
+def test_unclosed_forms_are_linear(account_statement):
+    page = '<form action="/f"><a href="/x">' * 200000
+    start = time.time()
+    assert account_statement.find_tag_blocks(page, 'form') == []
+    assert len(account_statement.find_tag_starts(page, 'form')) == 200000
+    assert time.time() - start < TIME_LIMIT
+
+
+def test_unclosed_cookie_consent_boxes_are_linear(account_statement):
+    page = ('<div id="cookieConsentBox"><form>' + '</form>' + '<div>') * 200000
+    start = time.time()
+    assert account_statement.remove_cookie_consent_box(page) == page
+    assert time.time() - start < TIME_LIMIT
@@ -0,0 +1,179 @@
+#
+# tests for the turnovers parsers: the same bookings as HTML page and as
+# CSV export must result in the same rows, otherwise switching between
+# 'turnovers_format: html' and 'csv' stores all bookings a second time
+#
+
+import os
+
+import pytest
+
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# no fingerprint (first run), and a fingerprint of different bookings (every later run)
+PREVIOUS_FINGERPRINTS = [None, '0' * 64]
+
+
+def booking_values(module, booking):
+    return tuple([getattr(booking, field) for field in module.Booking.__slots__])
+
+
+def parse_html(module, chunk_size = 100, previous_fingerprint = None):
+    with open(os.path.join(DATA, 'turnovers.html'), 'r', encoding = 'utf-8') as page:
+        content = page.read()
+    parser = module.TurnoversParser(previous_fingerprint)
+    # the page arrives in chunks, which split lines and tags
+    for position in range(0, len(content), chunk_size):
+        parser.feed(content[position:position + chunk_size])
+
+    return parser.close()
+
+
+def parse_csv(module, previous_fingerprint = None):
+    with open(os.path.join(DATA, 'turnovers.csv'), 'r', encoding = 'utf-8') as export:
+        return module.parse_turnovers_csv(export.readlines(), previous_fingerprint)
+
+
+def test_html_bookings(account_statement):
+    account_data = parse_html(account_statement)
+    bookings = [booking_values(account_statement, booking) for booking in account_data['bookings']]
+
+    assert account_data['bank_balance'] == '12345.67'
+    assert account_data['bank_balance_currency'] == 'EUR'
+    assert bookings == [
+        ('19.10.2026', '20.10.2026', 'SEPA-Lastschrift von Stadtwerke München & Co. KG', 'Abschlag 10/2026 Vertrag 4711',
+         'DE02120300000000202051', 'BYLADEM1001', '', 'SW-10001', 'DE98ZZZ09999999999', '-1073.36', 'EUR'),
+        ('17.10.2026', '17.10.2026', 'SEPA-Gutschrift von Arbeitgeber GmbH', 'Lohn/Gehalt 10/2026',
+         'DE88100900001234567892', 'BEVODEBBXXX', 'LG-2026-10', '', '', '2686.26', 'EUR'),
+        ('16.10.2026', '15.10.2026', 'Kartenzahlung Tankstelle Aral', '2026-10-15T18:22 Karte 1 2029-12',
+         '', '', '', '', '', '-42.38', 'EUR')]
+
+
+def test_html_and_csv_bookings_are_identical(account_statement):
+    html_data = parse_html(account_statement)
+    csv_data = parse_csv(account_statement)
+
+    assert [booking_values(account_statement, booking) for booking in csv_data['bookings']] == \
+           [booking_values(account_statement, booking) for booking in html_data['bookings']]
+    # the balance of the CSV export is at the end, it is known once the bookings are read
+    assert csv_data['bank_balance'] == html_data['bank_balance']
+    assert csv_data['bank_balance_currency'] == html_data['bank_balance_currency']
+
+
+@pytest.mark.parametrize('previous_fingerprint', PREVIOUS_FINGERPRINTS)
+def test_html_bookings_while_downloading(account_statement, previous_fingerprint):
+    with open(os.path.join(DATA, 'turnovers.html'), 'r', encoding = 'utf-8') as page:
+        lines = page.readlines()
+    read = []
+
+    def chunks():
+        for line in lines:
+            read.append(line)
+            yield line
+
+    account_data = account_statement.TurnoversParser(previous_fingerprint).parse(chunks())
+    bookings = iter(account_data['bookings'])
+    next(bookings)
+    # a booking is complete when the next one starts, long before the page is complete
+    assert len(read) < len(lines) - 20
+    assert account_data['fingerprint'] is None
+    assert len(list(bookings)) == 2
+    assert len(read) == len(lines)
+    assert account_data['bank_balance'] == '12345.67'
+    assert account_data['fingerprint'] == parse_html(account_statement)['fingerprint']
+    assert account_data['unchanged'] is False
+
+
+@pytest.mark.parametrize('previous_fingerprint', PREVIOUS_FINGERPRINTS)
+def test_csv_bookings_while_downloading(account_statement, previous_fingerprint):
+    with open(os.path.join(DATA, 'turnovers.csv'), 'r', encoding = 'utf-8') as export:
+        lines = export.readlines()
+    read = []
+
+    def iter_lines():
+        for line in lines:
+            read.append(line)
+            yield line
+
+    account_data = account_statement.parse_turnovers_csv(iter_lines(), previous_fingerprint)
+    bookings = iter(account_data['bookings'])
+    next(bookings)
+    assert len(read) == 4
+    assert account_data['bank_balance'] is None
+    assert len(list(bookings)) == 2
+    assert account_data['bank_balance'] == '12345.67'
+    assert account_data['bank_balance_currency'] == 'EUR'
+    assert account_data['fingerprint'] is not None
+    assert account_data['unchanged'] is False
+
+
+def test_html_chunk_size_does_not_matter(account_statement):
+    expected = [booking_values(account_statement, booking) for booking in parse_html(account_statement)['bookings']]
+    for chunk_size in [1, 7, 64, 100000]:
+        account_data = parse_html(account_statement, chunk_size)
+        assert [booking_values(account_statement, booking) for booking in account_data['bookings']] == expected
+
+
+def test_csv_after_html_adds_no_statements(account_statement, database):
+    account_id = database.get_account_id('Account 1', 'acc-1', 0, 100)
+
+    html_data = parse_html(account_statement)
+    assert len(database.save_account_transactions(account_id, html_data)) == 3
+
+    csv_data = parse_csv(account_statement)
+    assert database.save_account_transactions(account_id, csv_data) == []
+
+
+def test_unchanged_bookings_while_downloading(account_statement):
+    with open(os.path.join(DATA, 'turnovers.html'), 'r', encoding = 'utf-8') as page:
+        lines = page.readlines()
+    read = []
+
+    def chunks():
+        for line in lines:
+            read.append(line)
+            yield line
+
+    # the previous fingerprint does not delay the parser, 'unchanged' is known at the end
+    fingerprint = parse_html(account_statement)['fingerprint']
+    account_data = account_statement.TurnoversParser(fingerprint).parse(chunks())
+    bookings = iter(account_data['bookings'])
+    next(bookings)
+    assert len(read) < len(lines) - 20
+    assert account_data['unchanged'] is False
+    assert len(list(bookings)) == 2
+    assert account_data['unchanged'] is True
+
+    with open(os.path.join(DATA, 'turnovers.csv'), 'r', encoding = 'utf-8') as export:
+        lines = export.readlines()
+    account_data = parse_csv(account_statement)
+    list(account_data['bookings'])
+    read = []
+    account_data = account_statement.parse_turnovers_csv(chunks(), account_data['fingerprint'])
+    bookings = iter(account_data['bookings'])
+    next(bookings)
+    assert len(read) == 4
+    assert account_data['unchanged'] is False
+    assert len(list(bookings)) == 2
+    assert account_data['unchanged'] is True
+
+
+def test_unchanged_turnovers_are_not_saved(account_statement, database):
+
+    for account, parse in [('Account 1', parse_html), ('Account 2', parse_csv)]:
+        account_id = database.get_account_id(account, account, 0, 100)
+        account_data = parse(account_statement)
+        assert len(database.save_account_transactions(account_id, account_data)) == 3
+        changes = database.execute_one("SELECT COUNT(*) AS cnt FROM change_log", [])['cnt']
+
+        account_data = parse(account_statement, previous_fingerprint = account_data['fingerprint'])
+        assert database.save_account_transactions(account_id, account_data) == []
+        assert account_data['unchanged'] is True
+        assert database.execute_one("SELECT COUNT(*) AS cnt FROM change_log", [])['cnt'] == changes
+        assert database.execute_one("SELECT COUNT(*) AS cnt FROM temp.new_statements", [])['cnt'] == 0
+
+    # with all chunks fed at once, the unchanged bookings are dropped in close()
+    account_data = parse_html(account_statement, previous_fingerprint = parse_html(account_statement)['fingerprint'])
+    assert account_data['unchanged'] is True
+    assert list(account_data['bookings']) == []